@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Microbenchmark — notification throughput of the thread pool listener vs the asyncio listener.
+Simulates a fleet of devices, each posting notifications on its own connection, and prints
+the notifications/sec absorbed by each listener. The thread pool listener closes the
+connection after every notification, the asyncio one keeps it open.
+
+Usage: python tests/bench_async_listener.py [devices] [notifications per device]
+"""
+import asyncio
+import sys
+import threading
+import time
+
+from wsd_scan import wsd_scan__events
+from wsd_scan.wsd_scan__async_events import AsyncEventListener
+
+EVENT_BODY = b'<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" ' \
+             b'xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing"><soap:Header>' \
+             b'<wsa:Action>http://example.com/OtherEvent</wsa:Action></soap:Header><soap:Body/></soap:Envelope>'
+REQUEST = b"POST /wsd HTTP/1.1\r\nContent-Type: application/soap+xml\r\nContent-Length: %d\r\n\r\n" \
+          % len(EVENT_BODY) + EVENT_BODY
+
+
+class QuietHandler(wsd_scan__events.RequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+async def device(port, notifications):
+    reader, writer = None, None
+    for _ in range(notifications):
+        if writer is None:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(REQUEST)
+        head = await reader.readuntil(b"\r\n\r\n")
+        if b"Connection: close" in head:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def fleet(port, devices, notifications):
+    await asyncio.gather(*[device(port, notifications) for _ in range(devices)])
+
+
+def measure(port, devices, notifications):
+    start = time.perf_counter()
+    asyncio.run(fleet(port, devices, notifications))
+    return devices * notifications / (time.perf_counter() - start)
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    notifications = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    context = {"queues": wsd_scan__events.QueuesSet()}
+
+    print("%d devices x %d notifications" % (devices, notifications))
+    print("%-28s %16s" % ("listener", "notifications/s"))
+
+    server = wsd_scan__events.HTTPServerWithContext(("127.0.0.1", 0), QuietHandler, context,
+                                                    workers=8, max_in_flight=devices * 2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("%-28s %16.0f" % ("thread pool, 8 workers", measure(server.server_address[1], devices, notifications)))
+    server.shutdown()
+    server.server_close()
+
+    listener = AsyncEventListener(("127.0.0.1", 0), context)
+    t = threading.Thread(target=listener.serve_forever, daemon=True)
+    t.start()
+    listener.started.wait()
+    print("%-28s %16.0f" % ("asyncio", measure(listener.server_address[1], devices, notifications)))
+    listener.shutdown()
+    t.join()
+
+
+if __name__ == "__main__":
+    main()
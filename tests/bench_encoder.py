@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Microbenchmark — page encoding throughput in the scan thread vs a process pool.
+Converts synthetic JPEG pages to PNG, the way concurrent scans from several devices would,
+and prints the pages/sec reached with an increasing number of encoder processes.
+
+Usage: python tests/bench_encoder.py [dpi] [pages] [max workers]
+"""
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from wsd_scan import wsd_scan__events
+from wsd_scan.image_encoder import ProcessPoolEncoder
+
+
+def make_page(dpi):
+    w, h = int(8.27 * dpi), int(11.69 * dpi)
+    img = Image.new("RGB", (w, h), "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(0, h, max(dpi // 6, 1)):
+        draw.line((dpi // 2, y, w - dpi // 2, y), fill=(20, 20, 20), width=max(dpi // 100, 1))
+    buf = BytesIO()
+    img.save(buf, format="jpeg", quality=85)
+    return buf.getvalue()
+
+
+def run_threads(data, profile, pages, threads):
+    """Concurrent scans encoding in their own thread, as without the process pool."""
+    def save(i):
+        wsd_scan__events.save_page(data, profile, "%s/t_%d.png" % (profile["target_folder"], i))
+
+    with ThreadPoolExecutor(threads) as ex:
+        list(ex.map(save, range(pages)))
+
+
+def run_pool(data, profile, pages, encoder):
+    futures = [encoder.submit(data, profile, "%s/p_%d.png" % (profile["target_folder"], i)) for i in range(pages)]
+    for f in futures:
+        f.result()
+
+
+def main():
+    dpi = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else (os.cpu_count() or 1)
+    data = make_page(dpi)
+
+    print("page: %d dpi, %d pages, %d CPUs" % (dpi, pages, os.cpu_count() or 1))
+    print("%-28s %10s" % ("method", "pages/s"))
+    with tempfile.TemporaryDirectory() as d:
+        profile = {"image_format": "png", "quality": 85, "target_folder": d}
+
+        start = time.perf_counter()
+        run_threads(data, profile, pages, max_workers)
+        print("%-28s %10.2f" % ("%d scan threads (GIL)" % max_workers, pages / (time.perf_counter() - start)))
+
+        workers = 1
+        while workers <= max_workers:
+            encoder = ProcessPoolEncoder(workers)
+            run_pool(data, profile, workers, encoder)  # warm up: spawn the workers
+            start = time.perf_counter()
+            run_pool(data, profile, pages, encoder)
+            print("%-28s %10.2f" % ("process pool, %d workers" % workers, pages / (time.perf_counter() - start)))
+            encoder.close()
+            workers *= 2
+
+
+if __name__ == "__main__":
+    main()
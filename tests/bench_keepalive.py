@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Microbenchmark — notification throughput of the listener with and without keep-alive.
+A local event generator plays a few devices sending JobStatus, ScannerStatusSummary and
+ScanAvailable-sized notifications back-to-back, and prints the events/sec absorbed when every
+notification opens a new connection and when connections are kept alive.
+
+Usage: python tests/bench_keepalive.py [devices] [events per device]
+"""
+import socket
+import sys
+import threading
+import time
+
+from wsd_scan import wsd_scan__events
+
+EVENT_BODY = b'<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" ' \
+             b'xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing"><soap:Header>' \
+             b'<wsa:Action>http://example.com/JobStatusEvent</wsa:Action></soap:Header><soap:Body/></soap:Envelope>'
+REQUEST = b"POST /wsd HTTP/1.1\r\nContent-Type: application/soap+xml\r\nContent-Length: %d\r\n\r\n" \
+          % len(EVENT_BODY) + EVENT_BODY
+
+
+class QuietHandler(wsd_scan__events.RequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def read_response(s):
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += s.recv(1024)
+    return data
+
+
+def device(port, events):
+    s = None
+    for _ in range(events):
+        if s is None:
+            s = socket.create_connection(("127.0.0.1", port))
+        s.sendall(REQUEST)
+        if b"Connection: close" in read_response(s):
+            s.close()
+            s = None
+    if s is not None:
+        s.close()
+
+
+def measure(keepalive_requests, devices, events):
+    server = wsd_scan__events.HTTPServerWithContext(("127.0.0.1", 0), QuietHandler,
+                                                    {"queues": wsd_scan__events.QueuesSet()},
+                                                    workers=devices, max_in_flight=devices * 4,
+                                                    keepalive_requests=keepalive_requests)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threads = [threading.Thread(target=device, args=(server.server_address[1], events)) for _ in range(devices)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+    return devices * events / elapsed
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    events = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    print("%d devices x %d back-to-back events" % (devices, events))
+    print("%-28s %12s" % ("listener", "events/s"))
+    print("%-28s %12.0f" % ("Connection: close", measure(1, devices, events)))
+    print("%-28s %12.0f" % ("keep-alive", measure(events, devices, events)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Microbenchmark — event handling latency under a burst, single-threaded vs pooled listener.
+A few clients open a connection and send their body slowly, while a burst of regular
+notifications is posted concurrently. Prints the latency percentiles of the regular
+notifications for the original single-threaded HTTPServer and for the pooled listener.
+
+Usage: python tests/bench_listener.py [burst size] [slow clients] [slow client delay s]
+"""
+import http.server
+import socket
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from wsd_scan import wsd_scan__events
+
+EVENT_BODY = b'<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" ' \
+             b'xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing"><soap:Header>' \
+             b'<wsa:Action>http://example.com/OtherEvent</wsa:Action></soap:Header><soap:Body/></soap:Envelope>'
+
+
+class QuietHandler(wsd_scan__events.RequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LegacyServer(http.server.HTTPServer):
+    """The original listener: one request at a time, no timeouts."""
+
+    def __init__(self, server_address, request_handler_class, context):
+        self.request_queue_size = 256  # same accept backlog, to compare only the request handling
+        super().__init__(server_address, request_handler_class)
+        self.context = context
+        self.read_timeout = None
+
+
+def post(port):
+    start = time.perf_counter()
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(b"POST /wsd HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(EVENT_BODY) + EVENT_BODY)
+        s.recv(1024)
+    return time.perf_counter() - start
+
+
+def slow_post(port, delay):
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        half = len(EVENT_BODY) // 2
+        s.sendall(b"POST /wsd HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(EVENT_BODY) + EVENT_BODY[:half])
+        time.sleep(delay)
+        s.sendall(EVENT_BODY[half:])
+        s.recv(1024)
+
+
+def run(server, burst, slow_clients, delay):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    slow = [threading.Thread(target=slow_post, args=(port, delay)) for _ in range(slow_clients)]
+    for t in slow:
+        t.start()
+    time.sleep(0.05)
+    with ThreadPoolExecutor(16) as ex:
+        latencies = sorted(ex.map(lambda _: post(port), range(burst)))
+    for t in slow:
+        t.join()
+    server.shutdown()
+    server.server_close()
+    return latencies
+
+
+def main():
+    burst = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    slow_clients = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    context = {"queues": wsd_scan__events.QueuesSet()}
+
+    print("burst: %d notifications, %d slow clients sending over %.1f s" % (burst, slow_clients, delay))
+    print("%-24s %10s %10s %10s %10s" % ("listener", "mean ms", "p50 ms", "p99 ms", "max ms"))
+    servers = [("single-threaded", LegacyServer(("127.0.0.1", 0), QuietHandler, context)),
+               ("pooled, 8 workers", wsd_scan__events.HTTPServerWithContext(("127.0.0.1", 0), QuietHandler, context,
+                                                                             workers=8, max_in_flight=burst))]
+    for name, server in servers:
+        lat = run(server, burst, slow_clients, delay)
+        print("%-24s %10.2f %10.2f %10.2f %10.2f" % (name, statistics.mean(lat) * 1000,
+                                                     statistics.median(lat) * 1000,
+                                                     lat[int(len(lat) * 0.99) - 1] * 1000, lat[-1] * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Microbenchmark — scanner elements parsing with ElementPath lookups vs compiled XPath queries,
+and with the original .// search based configuration and ticket parsers vs the single-pass ones.
+Parses the recorded GetScannerElements response in tests/fixtures/ the way
+wsd_get_scanner_elements() does, and prints the per-message cost of each combination.
+
+Usage: python tests/bench_parsers.py [iterations]
+"""
+import copy
+import os
+import sys
+import timeit
+
+import lxml.etree as etree
+
+from wsd_scan import wsd_common, wsd_scan__parsers, wsd_scan__structures
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "get_scanner_elements_response.xml")
+
+
+def legacy_xml_find(xml_tree, query):
+    """The original implementation: lxml tokenizes the query with NSMAP at every call."""
+    return xml_tree.find(query, wsd_common.NSMAP)
+
+
+def legacy_xml_findall(xml_tree, query):
+    return xml_tree.findall(query, wsd_common.NSMAP)
+
+
+# The original parsers, running one .// search per value
+
+
+def legacy_parse_scan_ticket(std_ticket):
+    st = wsd_scan__structures.ScanTicket()
+    st.job_name = wsd_common.xml_find(std_ticket, ".//sca:JobDescription/sca:JobName").text
+    st.job_user_name = wsd_common.xml_find(std_ticket, ".//sca:JobDescription/sca:JobOriginatingUserName").text
+    q = wsd_common.xml_find(std_ticket, ".//sca:JobDescription/sca:JobInformation")
+    if q is not None:
+        st.job_info = q.text
+    dps = wsd_common.xml_find(std_ticket, ".//sca:DocumentParameters")
+    st.doc_params = legacy_parse_document_params(dps)
+    return st
+
+
+def legacy_parse_media_side(ms):
+    s = wsd_scan__structures.MediaSide()
+    r = wsd_common.xml_find(ms, ".//sca:ScanRegion")
+    if r is not None:
+        q = wsd_common.xml_find(r, ".//sca:ScanRegionXOffset")
+        if q is not None:
+            s.offset = (int(q.text), s.offset[1])
+        q = wsd_common.xml_find(r, ".//sca:ScanRegionYOffset")
+        if q is not None:
+            s.offset = (s.offset[0], int(q.text))
+        v1 = wsd_common.xml_find(r, ".//sca:ScanRegionWidth")
+        v2 = wsd_common.xml_find(r, ".//sca:ScanRegionHeight")
+        s.size = (int(v1.text), int(v2.text))
+    q = wsd_common.xml_find(ms, ".//sca:ColorProcessing")
+    if q is not None:
+        s.color = q.text
+    q = wsd_common.xml_find(ms, ".//sca:Resolution/sca:Width")
+    s.res = (int(q.text), s.res[1])
+    q = wsd_common.xml_find(ms, ".//sca:Resolution/sca:Height")
+    s.res = (s.res[0], int(q.text))
+    return s
+
+
+def legacy_parse_document_params(dps):
+    dest = wsd_scan__structures.DocumentParams()
+    q = wsd_common.xml_find(dps, ".//sca:Format")
+    if q is not None:
+        dest.format = q.text
+    q = wsd_common.xml_find(dps, ".//sca:CompressionQualityFactor")
+    if q is not None:
+        dest.compression_factor = q.text
+    q = wsd_common.xml_find(dps, ".//sca:ImagesToTransfer")
+    if q is not None:
+        dest.images_num = int(q.text)
+    q = wsd_common.xml_find(dps, ".//sca:InputSource")
+    if q is not None:
+        dest.input_src = q.text
+    q = wsd_common.xml_find(dps, ".//sca:ContentType")
+    if q is not None:
+        dest.content_type = q.text
+    q = wsd_common.xml_find(dps, ".//sca:InputSize")
+    if q is not None:
+        autod = wsd_common.xml_find(q, ".//sca:DocumentAutoDetect")
+        if autod is not None:
+            dest.size_autodetect = True if autod.text == 'true' or autod.text == '1' else False
+        v1 = wsd_common.xml_find(q, ".//sca:InputMediaSize/sca:Width")
+        v2 = wsd_common.xml_find(q, ".//sca:InputMediaSize/sca:Height")
+        dest.input_size = (int(v1.text), int(v2.text))
+    q = wsd_common.xml_find(dps, ".//sca:Exposure")
+    if q is not None:
+        autod = wsd_common.xml_find(q, ".//sca:AutoExposure")
+        if autod is not None:
+            dest.auto_exposure = True if autod.text == 'true' or autod.text == '1' else False
+        dest.contrast = int(wsd_common.xml_find(q, ".//sca:ExposureSettings/sca:Contrast").text)
+        dest.brightness = int(wsd_common.xml_find(q, ".//sca:ExposureSettings/sca:Brightness").text)
+        dest.sharpness = int(wsd_common.xml_find(q, ".//sca:ExposureSettings/sca:Sharpness").text)
+    q = wsd_common.xml_find(dps, ".//sca:Scaling")
+    if q is not None:
+        v1 = wsd_common.xml_find(q, ".//sca:ScalingWidth")
+        v2 = wsd_common.xml_find(q, ".//sca:ScalingHeight")
+        dest.scaling = (int(v1.text), int(v2.text))
+    q = wsd_common.xml_find(dps, ".//sca:Rotation")
+    if q is not None:
+        dest.rotation = int(q.text)
+    q = wsd_common.xml_find(dps, ".//sca:MediaSides")
+    if q is not None:
+        f = wsd_common.xml_find(q, ".//sca:MediaFront")
+        dest.front = legacy_parse_media_side(f)
+
+        f = wsd_common.xml_find(q, ".//sca:MediaBack")
+        if f is not None:
+            dest.back = legacy_parse_media_side(f)
+        else:
+            dest.back = copy.deepcopy(dest.front)
+    return dest
+
+
+def legacy_parse_scanner_source_settings(se, name):
+    sss = wsd_scan__structures.ScannerSourceSettings()
+    v1 = wsd_common.xml_find(se, ".//sca:%sOpticalResolution/sca:Width" % name)
+    v2 = wsd_common.xml_find(se, ".//sca:%sOpticalResolution/sca:Height" % name)
+    sss.optical_res = (int(v1.text), int(v2.text))
+    q = wsd_common.xml_findall(se, ".//sca:%sResolutions/sca:Widths/sca:Width" % name)
+    sss.width_res = [x.text for x in q]
+    q = wsd_common.xml_findall(se, ".//sca:%sResolutions/sca:Heights/sca:Height" % name)
+    sss.height_res = [x.text for x in q]
+    q = wsd_common.xml_findall(se, ".//sca:%sColor/sca:ColorEntry" % name)
+    sss.color_modes = [x.text for x in q]
+    v1 = wsd_common.xml_find(se, ".//sca:%sMinimumSize/sca:Width" % name)
+    v2 = wsd_common.xml_find(se, ".//sca:%sMinimumSize/sca:Height" % name)
+    sss.min_size = (int(v1.text), int(v2.text))
+    v1 = wsd_common.xml_find(se, ".//sca:%sMaximumSize/sca:Width" % name)
+    v2 = wsd_common.xml_find(se, ".//sca:%sMaximumSize/sca:Height" % name)
+    sss.max_size = (int(v1.text), int(v2.text))
+    return sss
+
+
+def legacy_parse_scan_configuration(sca_config):
+    config = wsd_scan__structures.ScannerConfiguration()
+    ds = wsd_common.xml_find(sca_config, ".//sca:DeviceSettings")
+    pla = wsd_common.xml_find(sca_config, ".//sca:Platen")
+    adf = wsd_common.xml_find(sca_config, ".//sca:ADF")
+    # .//sca:Film omitted
+
+    s = wsd_scan__structures.ScannerSettings()
+    q = wsd_common.xml_findall(ds, ".//sca:FormatsSupported/sca:FormatValue")
+    s.formats = [x.text for x in q]
+    v1 = wsd_common.xml_find(ds, ".//sca:CompressionQualityFactorSupported/sca:MinValue")
+    v2 = wsd_common.xml_find(ds, ".//sca:CompressionQualityFactorSupported/sca:MaxValue")
+    s.compression_factor = (int(v1.text), int(v2.text))
+    q = wsd_common.xml_findall(ds, ".//sca:ContentTypesSupported/sca:ContentTypeValue")
+    s.content_types = [x.text for x in q]
+    q = wsd_common.xml_find(ds, ".//sca:DocumentSizeAutoDetectSupported")
+    s.size_autodetect_sup = True if q.text == 'true' or q.text == '1' else False
+    q = wsd_common.xml_find(ds, ".//sca:AutoExposureSupported")
+    s.auto_exposure_sup = True if q.text == 'true' or q.text == '1' else False
+    q = wsd_common.xml_find(ds, ".//sca:BrightnessSupported")
+    s.brightness_sup = True if q.text == 'true' or q.text == '1' else False
+    q = wsd_common.xml_find(ds, ".//sca:ContrastSupported")
+    s.contrast_sup = True if q.text == 'true' or q.text == '1' else False
+    v1 = wsd_common.xml_find(ds, ".//sca:ScalingRangeSupported/sca:ScalingWidth/sca:MinValue")
+    v2 = wsd_common.xml_find(ds, ".//sca:ScalingRangeSupported/sca:ScalingWidth/sca:MaxValue")
+    s.scaling_range_w = (int(v1.text), int(v2.text))
+    v1 = wsd_common.xml_find(ds, ".//sca:ScalingRangeSupported/sca:ScalingHeight/sca:MinValue")
+    v2 = wsd_common.xml_find(ds, ".//sca:ScalingRangeSupported/sca:ScalingHeight/sca:MaxValue")
+    s.scaling_range_h = (int(v1.text), int(v2.text))
+    q = wsd_common.xml_findall(ds, ".//sca:RotationsSupported/sca:RotationValue")
+    s.rotations = [x.text for x in q]
+    config.settings = s
+    if pla is not None:
+        config.platen = legacy_parse_scanner_source_settings(pla, "Platen")
+    if adf is not None:
+        q = wsd_common.xml_find(adf, ".//sca:ADFSupportsDuplex")
+        config.adf_duplex = True if q.text == 'true' or q.text == '1' else False
+        f = wsd_common.xml_find(adf, ".//sca:ADFFront")
+        bk = wsd_common.xml_find(adf, ".//sca:ADFBack")
+        if f is not None:
+            config.front_adf = legacy_parse_scanner_source_settings(f, "ADF")
+        if bk is not None:
+            config.back_adf = legacy_parse_scanner_source_settings(bk, "ADF")
+    return config
+
+
+def parse_elements(x, single_pass=True):
+    re = wsd_common.xml_find(x, ".//sca:ScannerElements")
+    wsd_scan__parsers.parse_scan_description(wsd_common.xml_find(re, ".//sca:ScannerDescription"))
+    wsd_scan__parsers.parse_scan_status(wsd_common.xml_find(re, ".//sca:ScannerStatus"))
+    if single_pass:
+        wsd_scan__parsers.parse_scan_configuration(wsd_common.xml_find(re, ".//sca:ScannerConfiguration"))
+        wsd_scan__parsers.parse_scan_ticket(wsd_common.xml_find(re, ".//sca:DefaultScanTicket"))
+    else:
+        legacy_parse_scan_configuration(wsd_common.xml_find(re, ".//sca:ScannerConfiguration"))
+        legacy_parse_scan_ticket(wsd_common.xml_find(re, ".//sca:DefaultScanTicket"))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    x = etree.parse(FIXTURE, wsd_common.parser).getroot()
+
+    compiled_find, compiled_findall = wsd_common.xml_find, wsd_common.xml_findall
+    wsd_common.xml_find, wsd_common.xml_findall = legacy_xml_find, legacy_xml_findall
+    legacy = timeit.timeit(lambda: parse_elements(x, False), number=iterations)
+    wsd_common.xml_find, wsd_common.xml_findall = compiled_find, compiled_findall
+    compiled = timeit.timeit(lambda: parse_elements(x, False), number=iterations)
+    single_pass = timeit.timeit(lambda: parse_elements(x), number=iterations)
+
+    print("%-40s %12s" % ("lookup", "us/message"))
+    print("%-40s %12.1f" % ("ElementPath + NSMAP", legacy / iterations * 1e6))
+    print("%-40s %12.1f" % ("compiled XPath (%d queries)" % len(wsd_common.queries), compiled / iterations * 1e6))
+    print("%-40s %12.1f" % ("compiled XPath + single-pass parsers", single_pass / iterations * 1e6))
+    print("speedup: %.1fx, then %.1fx" % (legacy / compiled, compiled / single_pass))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Microbenchmark — per-page CPU time of PIL decode + re-encode vs JPEG passthrough.
+Generates a synthetic A4 page at the requested resolution, encodes it as the device would,
+then saves it with both approaches and prints the CPU time spent per page.
+
+Usage: python tests/bench_passthrough.py [dpi] [pages]
+"""
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from wsd_scan import wsd_scan__events
+
+
+def make_page(dpi):
+    w, h = int(8.27 * dpi), int(11.69 * dpi)
+    img = Image.new("RGB", (w, h), "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(0, h, max(dpi // 6, 1)):
+        draw.line((dpi // 2, y, w - dpi // 2, y), fill=(20, 20, 20), width=max(dpi // 100, 1))
+    buf = BytesIO()
+    img.save(buf, format="jpeg", quality=85)
+    return buf.getvalue()
+
+
+def legacy_save(data, profile, picture_file):
+    """The original implementation: always decode and re-encode with PIL."""
+    img = Image.open(BytesIO(data))
+    img.save(picture_file, format=profile["image_format"], quality=profile["quality"])
+    return picture_file
+
+
+def measure(fn, data, profile, picture_file, pages):
+    start = time.process_time()
+    for _ in range(pages):
+        fn(data, profile, picture_file)
+    return (time.process_time() - start) / pages * 1000
+
+
+def main():
+    dpi = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    profile = {"image_format": "jpeg", "quality": 85}
+    data = make_page(dpi)
+
+    with tempfile.TemporaryDirectory() as d:
+        legacy_file = os.path.join(d, "legacy.jpeg")
+        passthrough_file = os.path.join(d, "passthrough.jpeg")
+        legacy = measure(legacy_save, data, profile, legacy_file, pages)
+        passthrough = measure(wsd_scan__events.save_page, data, profile, passthrough_file, pages)
+
+        print("page: %d dpi, %d bytes from device" % (dpi, len(data)))
+        print("%-24s %14s %12s" % ("method", "CPU ms/page", "file bytes"))
+        print("%-24s %14.2f %12d" % ("decode + re-encode", legacy, os.path.getsize(legacy_file)))
+        print("%-24s %14.2f %12d" % ("passthrough", passthrough, os.path.getsize(passthrough_file)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Microbenchmark — PDF assembly at the end of the job (img2pdf) vs incremental writing.
+Builds PDFs of an increasing number of synthetic JPEG pages and prints, for both approaches,
+the time spent after the last page is available and the peak memory allocated by Python.
+img2pdf is no longer a dependency; its column is skipped when it is not installed.
+
+Usage: python tests/bench_pdf.py [dpi] [max pages]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from wsd_scan.pdf_writer import StreamingPdfWriter
+
+try:
+    import img2pdf
+except ImportError:
+    img2pdf = None
+
+
+def make_page(dpi):
+    w, h = int(8.27 * dpi), int(11.69 * dpi)
+    img = Image.new("RGB", (w, h), "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(0, h, max(dpi // 6, 1)):
+        draw.line((dpi // 2, y, w - dpi // 2, y), fill=(20, 20, 20), width=max(dpi // 100, 1))
+    buf = BytesIO()
+    img.save(buf, format="jpeg", quality=85)
+    return buf.getvalue()
+
+
+def legacy(files, out):
+    """The original implementation: convert every page once the last one is saved."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(out, "wb") as f:
+        f.write(img2pdf.convert(files))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def streaming(files, out):
+    tracemalloc.start()
+    pdf = StreamingPdfWriter(out)
+    for f in files:
+        pdf.add_page(f)  # done while the next page is retrieved
+    start = time.perf_counter()
+    pdf.close()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    dpi = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    max_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    data = make_page(dpi)
+
+    print("page: %d dpi, %d bytes" % (dpi, len(data)))
+    print("%6s %18s %16s %18s %16s" % ("pages", "img2pdf ms", "img2pdf peak MB",
+                                       "streaming ms", "streaming peak MB"))
+    with tempfile.TemporaryDirectory() as d:
+        files = []
+        pages = 1
+        while pages <= max_pages:
+            while len(files) < pages:
+                files.append(os.path.join(d, "page_%d.jpeg" % len(files)))
+                with open(files[-1], "wb") as f:
+                    f.write(data)
+
+            if img2pdf is not None:
+                l_time, l_peak = legacy(files, os.path.join(d, "legacy.pdf"))
+                l_cols = "%18.2f %16.1f" % (l_time * 1000, l_peak / 1e6)
+            else:
+                l_cols = "%18s %16s" % ("-", "-")
+            s_time, s_peak = streaming(files, os.path.join(d, "streaming.pdf"))
+            print("%6d %s %18.2f %16.1f" % (pages, l_cols, s_time * 1000, s_peak / 1e6))
+            pages *= 2
+
+
+if __name__ == "__main__":
+    main()
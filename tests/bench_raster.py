@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Microbenchmark — saving tiff-single-uncompressed pages: PIL decode vs the numpy raster path.
+Generates a synthetic A4 page at the requested resolution as an uncompressed TIFF, like the
+device sends it, then converts it to several profile outputs with both approaches and prints
+the CPU time spent per page.
+
+Usage: python tests/bench_raster.py [dpi] [pages]
+"""
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from wsd_scan import raster, wsd_scan__events
+
+MODES = {"RGB24": "RGB", "Grayscale8": "L", "BlackAndWhite1": "1"}
+
+# device color, profile color, output format
+CASES = [("RGB24", "RGB24", "jpeg"),
+         ("RGB24", "Grayscale8", "jpeg"),
+         ("Grayscale8", "Grayscale8", "jpeg"),
+         ("Grayscale8", "BlackAndWhite1", "png"),
+         ("BlackAndWhite1", "BlackAndWhite1", "tiff")]
+
+
+def make_page(dpi, color):
+    w, h = int(8.27 * dpi), int(11.69 * dpi)
+    img = Image.new("RGB", (w, h), "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(0, h, max(dpi // 6, 1)):
+        draw.line((dpi // 2, y, w - dpi // 2, y), fill=(20, 20, 160), width=max(dpi // 100, 1))
+    img = img.convert(MODES[color])
+    buf = BytesIO()
+    img.save(buf, format="TIFF", compression="raw", dpi=(dpi, dpi))
+    return buf.getvalue()
+
+
+def legacy_save(data, profile, picture_file, geometry):
+    """The original implementation: decode the TIFF file with PIL, then convert and encode it."""
+    img = Image.open(BytesIO(data))
+    mode = MODES[profile["color"]]
+    if mode == "1" and profile["image_format"] == "jpeg":
+        mode = "L"
+    img = img.convert(mode, dither=Image.Dither.NONE)
+    img.save(picture_file, format=profile["image_format"], quality=profile["quality"])
+    return picture_file
+
+
+def measure(fn, data, profile, picture_file, geometry, pages):
+    start = time.process_time()
+    for _ in range(pages):
+        fn(data, profile, picture_file, geometry)
+    return (time.process_time() - start) / pages * 1000
+
+
+def main():
+    if not raster.is_available():
+        sys.exit("numpy is not installed")
+    dpi = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    print("page: A4, %d dpi" % dpi)
+    print("%-16s %-16s %-6s %14s %14s %8s" % ("device", "profile", "format", "PIL ms/page", "raster ms/page", "speedup"))
+    with tempfile.TemporaryDirectory() as d:
+        for device_color, profile_color, image_format in CASES:
+            data = make_page(dpi, device_color)
+            info = raster.parse_tiff_header(data)
+            geometry = (info.width, info.height, info.row_bytes)
+            profile = {"image_format": image_format, "quality": 85, "color": profile_color}
+            out = os.path.join(d, "page." + image_format)
+            legacy = measure(legacy_save, data, profile, out, geometry, pages)
+            fast = measure(wsd_scan__events.save_page, data, profile, out, geometry, pages)
+            print("%-16s %-16s %-6s %14.1f %14.1f %7.2fx"
+                  % (device_color, profile_color, image_format, legacy, fast, legacy / fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Microbenchmark — event admission with a full parse vs sniffing the SOAP header.
+Builds ScannerStatusConditionEvent notifications carrying many conditions, like the status
+events noisy devices send, and prints the cost of deciding to drop one when its action is not
+subscribed: parsing the whole message first, then reading the header, against parsing only
+until wsa:Action and wsa:MessageID are known. The cost of fully parsing an accepted event both
+ways is printed too.
+
+Timings are in us per event.
+
+Usage: python tests/bench_sniff.py [conditions,...] [iterations]
+"""
+import sys
+import timeit
+
+import lxml.etree as etree
+
+from wsd_scan import wsd_common
+
+CONDITION = '<sca:DeviceCondition Id="%d"><sca:Time>2026-10-17T08:55:01Z</sca:Time><sca:Name>Noise</sca:Name>' \
+            '<sca:Component>ADF</sca:Component><sca:Severity>Informational</sca:Severity></sca:DeviceCondition>'
+
+
+def make_event(conditions):
+    return ('<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" '
+            'xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing" '
+            'xmlns:sca="http://schemas.microsoft.com/windows/2006/08/wdp/scan"><soap:Header>'
+            '<wsa:Action>http://schemas.microsoft.com/windows/2006/08/wdp/scan/ScannerStatusConditionEvent</wsa:Action>'
+            '<wsa:MessageID>urn:uuid:1</wsa:MessageID></soap:Header><soap:Body><sca:ScannerStatusConditionEvent>%s'
+            '</sca:ScannerStatusConditionEvent></soap:Body></soap:Envelope>'
+            % "".join(CONDITION % i for i in range(conditions))).encode()
+
+
+def full_parse_action(message):
+    x = etree.fromstring(message)
+    header = wsd_common.xml_find(x, "soap:Header")
+    return wsd_common.xml_find(header, "wsa:Action").text
+
+
+def sniff_action(message):
+    return wsd_common.SoapHeaderSniffer(message).action
+
+
+def per_event(fn, iterations):
+    # best of several runs, the timings of a busy machine being noisy
+    return min(timeit.repeat(fn, number=iterations, repeat=5)) / iterations
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1].split(",")] if len(sys.argv) > 1 else [5, 10, 20, 40, 80, 160, 1000]
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    print("%-10s %12s %12s %12s %12s" % ("", "reject", "reject", "accept", "accept"))
+    print("%-10s %12s %12s %12s %12s" % ("bytes", "full parse", "sniff", "fromstring", "sniff+tree"))
+    for conditions in sizes:
+        message = make_event(conditions)
+        assert full_parse_action(message) == sniff_action(message)
+        n = max(iterations * 100 // conditions, 10)
+        full = per_event(lambda: full_parse_action(message), n)
+        sniff = per_event(lambda: sniff_action(message), n)
+        fromstring = per_event(lambda: etree.fromstring(message), n)
+        sniff_tree = per_event(lambda: wsd_common.SoapHeaderSniffer(message).tree(), n)
+        print("%-10d %12.1f %12.1f %12.1f %12.1f" % (len(message), full * 1e6, sniff * 1e6,
+                                                     fromstring * 1e6, sniff_tree * 1e6))
+
+
+if __name__ == "__main__":
+    main()
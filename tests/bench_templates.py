@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Microbenchmark — legacy per-request template substitution vs compiled templates.
+Renders every template in wsd_scan/templates/ with all its placeholders filled,
+and prints the per-render cost of both approaches.
+
+Usage: python tests/bench_templates.py [iterations]
+"""
+import os
+import re
+import sys
+import timeit
+
+from wsd_scan import wsd_common
+
+
+def legacy_message_from_file(fname, **kwargs):
+    """The original implementation: read, minify and str.replace() on every call."""
+    req = ''.join([l.strip() + '\n' for l in open(fname).readlines()]) \
+        .replace('\r', '')
+    for k in kwargs:
+        req = req.replace('{{' + k + '}}', str(kwargs[k]))
+    req = req.replace('{{MSG_ID}}', wsd_common.gen_urn())
+    return req.encode("ASCII")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    templates_dir = wsd_common.abs_path("templates")
+
+    print("%-48s %6s %12s %12s %8s" % ("template", "slots", "legacy us", "compiled us", "speedup"))
+    for fname in sorted(os.listdir(templates_dir)):
+        path = os.path.join(templates_dir, fname)
+        slots = set(re.findall(r"\{\{(\w+)\}\}", open(path).read())) - {"MSG_ID"}
+        fields = {k: "value-%s" % k.lower() for k in slots}
+
+        legacy = timeit.timeit(lambda: legacy_message_from_file(path, **fields), number=iterations)
+        compiled = timeit.timeit(lambda: wsd_common.render_template(fname, **fields), number=iterations)
+
+        print("%-48s %6d %12.2f %12.2f %7.1fx" % (fname, len(slots),
+                                                 legacy / iterations * 1e6,
+                                                 compiled / iterations * 1e6,
+                                                 legacy / compiled))
+
+
+if __name__ == "__main__":
+    main()
@@ -138,10 +138,11 @@ class ScanHandler(BaseHTTPRequestHandler):
                     more_images = False
 
             if picture_files and profile.get("use_pdf", False):
-                import img2pdf
+                from wsd_scan.pdf_writer import StreamingPdfWriter
                 pdf_file = "./scans/%s.pdf" % file_name
-                with open(pdf_file, "wb") as f:
-                    f.write(img2pdf.convert(picture_files))
+                with StreamingPdfWriter(pdf_file, profile["resolution"]) as pdf:
+                    for picture_file in picture_files:
+                        pdf.add_page(picture_file)
                 print("[SCAN] PDF saved: %s" % pdf_file)
 
             print("[SCAN] DONE. %d image(s) saved." % len(picture_files))
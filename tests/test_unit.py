@@ -3,17 +3,48 @@
 
 Covers:
   - Package data accessibility (templates, profiles)
-  - XML template loading and placeholder substitution
+  - XML template loading, placeholder substitution and escaping
   - Scan profile loading and required fields
   - ScanTicket.override_params logic
+  - Keep-alive HTTP session pool
+  - Pre-rendered CreateScanJob requests
+  - Scanner elements cache
+  - Streaming MTOM/XOP decoding of RetrieveImage responses
+  - JPEG passthrough of scanned pages
+  - Pipelined page saving with a bounded queue
+  - Process pool page encoding
+  - Streaming PDF assembly
+  - Concurrent event listener with timeouts and in-flight cap
+  - asyncio event listener
+  - Scan job scheduler
+  - Duplicate event suppression
+  - Keep-alive on the event listeners
+  - Compiled XPath query registry
+  - Single-pass scanner configuration and ticket parsers
+  - Lazily parsed scanner elements
+  - Event action sniffing before the full parse
+  - Per-thread XML parsers with size and depth limits
+  - Spooled page retrieval with a byte budget
+  - Raw raster path for uncompressed TIFF pages
+  - Blank page detection
+  - Color reduction of near-monochrome pages
+  - Output codecs per color mode, size targets and PDF embedding as is
 """
+import http.server
+import io
+import json
 import os
+import threading
 
 import pytest
 import yaml
 
-from wsd_scan import wsd_common, wsd_globals
+from wsd_scan import wsd_common, wsd_globals, wsd_scan__events, wsd_scan__operations, wsd_scan__parsers
+from wsd_scan import mime_helpers
+from wsd_scan.connection_pool import SessionPool
+from wsd_scan import wsd_scan__structures
 from wsd_scan.wsd_scan__structures import ScanTicket, DocumentParams, MediaSide
+from wsd_scan.wsd_transfer__structures import HostedService
 from wsd_scan.cli import read_profiles_from_yaml
 
 
@@ -82,6 +113,52 @@ class TestTemplateLoading:
         assert "{{MSG_ID}}" not in msg
 
 
+class TestCompiledTemplates:
+    """Verify compiled templates render like the original substitution, and escape values."""
+
+    @staticmethod
+    def legacy_render(fname, **kwargs):
+        req = ''.join([l.strip() + '\n' for l in open(fname).readlines()]).replace('\r', '')
+        for k in kwargs:
+            req = req.replace('{{' + k + '}}', str(kwargs[k]))
+        return req.encode("ASCII")
+
+    def test_all_templates_preloaded(self):
+        for fname in os.listdir(wsd_common.abs_path("templates")):
+            assert fname in wsd_common.templates
+
+    @pytest.mark.parametrize("template", sorted(os.listdir(wsd_common.abs_path("templates"))))
+    def test_same_output_as_legacy_substitution(self, template):
+        fields = {"MSG_ID": "urn:uuid:msg", "FROM": "urn:uuid:from", "TO": "http://10.0.0.1/wsd",
+                  "JOB_ID": 42, "INPUT_W": 8267}
+        expected = self.legacy_render(wsd_common.abs_path("templates/" + template), **fields)
+        assert wsd_common.render_template(template, **fields) == expected
+
+    def test_render_returns_bytes(self):
+        msg = wsd_common.render_template("ws-transfer__get.xml", FROM="a", TO="b")
+        assert isinstance(msg, bytes)
+        assert b"{{MSG_ID}}" not in msg
+
+    def test_values_are_escaped(self):
+        msg = wsd_common.render_template("ws-scan__scan_available_event_subscribe.xml",
+                                         DISPLAY_STR='Scan <A&B> "HQ"',
+                                         CONTEXT="caf\u00e9")
+        assert b"Scan &lt;A&amp;B&gt; &quot;HQ&quot;" in msg
+        assert b"caf&#233;" in msg
+
+    def test_apostrophes_are_escaped(self):
+        assert wsd_common.xml_escape("O'Brien's scanner") == b"O&apos;Brien&apos;s scanner"
+
+    def test_fragments_are_not_escaped(self):
+        msg = wsd_common.render_template("ws-eventing__subscribe.xml",
+                                         OPT_EXPIRATION=wsd_common.XmlFragment("<wse:Expires>PT1H</wse:Expires>"))
+        assert b"<wse:Expires>PT1H</wse:Expires>" in msg
+
+    def test_missing_values_left_untouched(self):
+        msg = wsd_common.render_template("ws-transfer__get.xml", FROM="a")
+        assert b"{{TO}}" in msg
+
+
 # --- Scan profiles ---
 
 REQUIRED_PROFILE_FIELDS = ["id", "name", "color", "format", "resolution",
@@ -205,3 +282,2000 @@ class TestScanTicketOverride:
         ticket.override_params(profile)
         assert ticket.doc_params.compression_factor == 100
         assert ticket.doc_params.images_num == 1
+
+
+# --- Keep-alive session pool ---
+
+class _KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["content-length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def keep_alive_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+class TestSessionPool:
+    """Verify sessions are shared per device endpoint and connections reused."""
+
+    def test_endpoint_key_ignores_path(self):
+        assert SessionPool.endpoint_of("http://10.0.0.1:8018/wsd") == \
+            SessionPool.endpoint_of("http://10.0.0.1:8018/wsd/scan")
+
+    def test_same_device_shares_session(self):
+        pool = SessionPool()
+        assert pool.get("http://10.0.0.1:8018/wsd") is pool.get("http://10.0.0.1:8018/wsd/scan")
+        assert pool.get("http://10.0.0.1:8018/wsd") is not pool.get("http://10.0.0.2:8018/wsd")
+        pool.close()
+
+    def test_connections_reused(self, keep_alive_server):
+        pool = SessionPool()
+        for _ in range(5):
+            assert pool.post(keep_alive_server + "/wsd/scan", data=b"x").content == b"ok"
+        st = pool.stats()[keep_alive_server]
+        assert st.requests == 5
+        assert st.connections == 1
+        assert st.reused == 4
+        pool.close()
+
+    def test_idle_sessions_evicted(self, keep_alive_server):
+        pool = SessionPool(idle_timeout=0)
+        first = pool.get(keep_alive_server)
+        pool.evict_idle()
+        assert pool.get(keep_alive_server) is not first
+        assert pool.stats()[keep_alive_server].evictions == 1
+        pool.close()
+
+    def test_reconfigure_waits_for_streamed_response(self, keep_alive_server):
+        pool = SessionPool()
+        with pool.post(keep_alive_server + "/wsd/scan", data=b"x", stream=True) as r:
+            session = pool.get(keep_alive_server)
+            pool.configure(pool_size=2)
+            assert session.get_adapter(keep_alive_server).poolmanager.pools
+            assert pool.get(keep_alive_server) is not session
+            assert r.content == b"ok"
+        assert not session.get_adapter(keep_alive_server).poolmanager.pools
+        pool.close()
+
+    def test_streamed_response_keeps_session(self, keep_alive_server):
+        pool = SessionPool(idle_timeout=0)
+        with pool.post(keep_alive_server + "/wsd/scan", data=b"x", stream=True) as r:
+            session = pool.get(keep_alive_server)
+            pool.evict_idle()
+            assert pool.get(keep_alive_server) is session
+            assert r.content == b"ok"
+        pool.evict_idle()
+        assert pool.stats()[keep_alive_server].evictions == 1
+        assert pool.get(keep_alive_server) is not session
+        pool.close()
+
+
+# --- Pre-rendered CreateScanJob requests ---
+
+def make_test_host(addr="http://10.0.0.1:8018/wsd/scan"):
+    host = HostedService()
+    host.ep_ref_addr = addr
+    return host
+
+
+class TestPreparedScanRequests:
+    """Verify pre-rendered CreateScanJob requests match fully rendered ones."""
+
+    PROFILE = {"id": "test_profile", "paper_size": "A4", "resolution": 300, "input_src": "Auto",
+               "color": "RGB24", "format": "jfif"}
+
+    def test_bind_then_render_equals_full_render(self):
+        t = wsd_common.get_template("ws-scan__create_scan_job.xml")
+        ticket = make_test_ticket()
+        ticket.override_params(self.PROFILE)
+        fields = {"FROM": "urn:uuid:from", "TO": "http://10.0.0.1/wsd", **ticket.as_map()}
+        bound = t.bind(**fields)
+        assert set(bound.slots) == {"MSG_ID", "SCAN_ID", "DEST_TOKEN"}
+        per_scan = {"MSG_ID": "urn:uuid:msg", "SCAN_ID": "scan-1", "DEST_TOKEN": "tok&1"}
+        assert bound.render(**per_scan) == t.render(**fields, **per_scan)
+
+    def test_prepared_request_keeps_template_name(self):
+        ticket = make_test_ticket()
+        ticket.override_params(self.PROFILE)
+        prepared = wsd_scan__operations.wsd_prepare_create_scan_job(make_test_host(), ticket)
+        assert prepared.name == "ws-scan__create_scan_job.xml"
+
+    @pytest.fixture(autouse=True)
+    def cached_device(self, monkeypatch):
+        host = make_test_host()
+        monkeypatch.setitem(wsd_scan__events.host_map, "test_profile", host)
+        monkeypatch.setitem(wsd_scan__events.profile_map, "test_profile", self.PROFILE)
+        monkeypatch.setattr(wsd_scan__operations, "scanner_elements_cache",
+                            wsd_scan__operations.ScannerElementsCache())
+        wsd_scan__operations.scanner_elements_cache.put(host, None, None, None, make_test_ticket())
+        return host
+
+    def test_cache_resolves_input_source(self, cached_device):
+        cache = wsd_scan__events.ProfileRequestCache()
+        cache.build("test_profile", cached_device, self.PROFILE)
+        adf_ticket, adf_request = cache.get("test_profile")
+        assert adf_ticket.doc_params.input_src == "ADF"
+        platen_ticket, platen_request = cache.get("test_profile", "Platen")
+        assert platen_ticket.doc_params.input_src == "Platen"
+        assert b"<wscn:InputSource>Platen</wscn:InputSource>" in platen_request.render(SCAN_ID="", DEST_TOKEN="")
+        assert cache.get("test_profile", "Platen")[1] is platen_request
+
+    def test_cache_invalidation_rebuilds(self, cached_device):
+        cache = wsd_scan__events.ProfileRequestCache()
+        cache.build("test_profile", cached_device, self.PROFILE)
+        first = cache.get("test_profile", "ADF")[1]
+        cache.invalidate("test_profile")
+        assert cache.get("test_profile", "ADF")[1] is not first
+
+    def test_new_default_ticket_rebuilds(self, cached_device):
+        cache = wsd_scan__events.ProfileRequestCache()
+        first = cache.get("test_profile", "ADF")[1]
+        assert cache.get("test_profile", "ADF")[1] is first
+        wsd_scan__operations.scanner_elements_cache.update("10.0.0.1", std_ticket=make_test_ticket())
+        assert cache.get("test_profile", "ADF")[1] is not first
+
+
+# --- Scanner elements cache ---
+
+class TestScannerElementsCache:
+    """Verify cached scanner elements are served without querying the device."""
+
+    @pytest.fixture
+    def fetches(self, monkeypatch):
+        calls = []
+
+        def fake_get_scanner_elements(host):
+            calls.append(host)
+            elements = ("descr-%d" % len(calls), "config", "status", make_test_ticket())
+            wsd_scan__operations.scanner_elements_cache.put(host, *elements)
+            return elements
+
+        monkeypatch.setattr(wsd_scan__operations, "wsd_get_scanner_elements", fake_get_scanner_elements)
+        monkeypatch.setattr(wsd_scan__operations, "scanner_elements_cache",
+                            wsd_scan__operations.ScannerElementsCache())
+        return calls
+
+    def test_fetched_once(self, fetches):
+        host = make_test_host()
+        first = wsd_scan__operations.scanner_elements_cache.get(host)
+        assert wsd_scan__operations.scanner_elements_cache.get(host) == first
+        assert len(fetches) == 1
+
+    def test_change_event_replaces_ticket(self, fetches):
+        host = make_test_host()
+        cache = wsd_scan__operations.scanner_elements_cache
+        cache.get(host)
+        new_ticket = make_test_ticket()
+        cache.update("10.0.0.1", std_ticket=new_ticket)
+        description, _, status, ticket = cache.get(host)
+        assert ticket is new_ticket
+        assert description == "descr-1"
+        assert status == "status"
+        assert len(fetches) == 1
+
+    def test_change_event_from_unknown_device_keeps_others(self, fetches):
+        host = make_test_host()
+        cache = wsd_scan__operations.scanner_elements_cache
+        cache.get(host)
+        cache.update("10.9.9.9", std_ticket=make_test_ticket())
+        cache.get(host)
+        assert len(fetches) == 1
+
+    def test_change_event_matches_resolved_host_name(self, fetches, monkeypatch):
+        monkeypatch.setattr(wsd_scan__operations.socket, "getaddrinfo",
+                            lambda host, *args, **kwargs: [(None, None, None, "", ("10.0.0.2", 0))])
+        host = make_test_host("http://scanner.lan:8018/wsd/scan")
+        cache = wsd_scan__operations.scanner_elements_cache
+        cache.get(host)
+        new_ticket = make_test_ticket()
+        cache.update("::ffff:10.0.0.2", std_ticket=new_ticket)
+        assert cache.get(host)[3] is new_ticket
+        assert len(fetches) == 1
+
+    def test_change_event_drops_unresolved_hosts(self, fetches, monkeypatch):
+        def fail(*args, **kwargs):
+            raise wsd_scan__operations.socket.gaierror("unknown host")
+
+        monkeypatch.setattr(wsd_scan__operations.socket, "getaddrinfo", fail)
+        unresolved = make_test_host("http://scanner.lan:8018/wsd/scan")
+        resolved = make_test_host()
+        cache = wsd_scan__operations.scanner_elements_cache
+        cache.get(unresolved)
+        cache.get(resolved)
+        cache.update("10.9.9.9", std_ticket=make_test_ticket())
+        cache.get(unresolved)
+        cache.get(resolved)
+        assert fetches == [unresolved, resolved, unresolved]
+
+    def test_ttl_expiry(self, fetches):
+        host = make_test_host()
+        cache = wsd_scan__operations.scanner_elements_cache
+        cache.ttl = 0
+        cache.get(host)
+        cache.get(host)
+        assert len(fetches) == 2
+
+
+# --- Streaming MTOM/XOP decoding ---
+
+MTOM_BOUNDARY = "uuid:0f3e0b8a-5b7c-4c1e-9d3a-5c6f7e8d9a0b"
+MTOM_CONTENT_TYPE = 'multipart/related; type="application/xop+xml"; boundary="%s"; ' \
+                    'start="<soap>"; start-info="application/soap+xml"' % MTOM_BOUNDARY
+
+
+def make_mtom_body(image, encoding="binary"):
+    envelope = b'<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope"><soap:Body/></soap:Envelope>'
+    if encoding == "base64":
+        import base64
+        image = base64.encodebytes(image)
+    return b"".join([
+        b"--" + MTOM_BOUNDARY.encode() + b"\r\n",
+        b"Content-Type: application/xop+xml; type=\"application/soap+xml\"\r\n",
+        b"Content-ID: <soap>\r\n\r\n",
+        envelope,
+        b"\r\n--" + MTOM_BOUNDARY.encode() + b"\r\n",
+        b"Content-Type: image/jpeg\r\n",
+        b"Content-Transfer-Encoding: " + encoding.encode() + b"\r\n",
+        b"Content-ID: <image>\r\n\r\n",
+        image,
+        b"\r\n--" + MTOM_BOUNDARY.encode() + b"--\r\n",
+    ])
+
+
+class TestMultipartStreamParser:
+    """Verify the incremental multipart parser splits parts at any chunk size."""
+
+    IMAGE = bytes(range(256)) * 300 + b"\r\n--not-the-boundary\r\n" + b"\xff\xd9"
+
+    @staticmethod
+    def parse(body, chunk_size):
+        sinks = []
+
+        def factory(index, headers):
+            sinks.append(io.BytesIO())
+            return sinks[-1]
+
+        mp = mime_helpers.MultipartStreamParser(mime_helpers.get_boundary(MTOM_CONTENT_TYPE), factory)
+        for i in range(0, len(body), chunk_size):
+            mp.feed(body[i:i + chunk_size])
+        mp.close()
+        return mp, [x.getvalue() for x in sinks]
+
+    def test_boundary_from_content_type(self):
+        assert mime_helpers.get_boundary(MTOM_CONTENT_TYPE) == MTOM_BOUNDARY
+        assert mime_helpers.get_boundary("application/soap+xml") is None
+
+    @pytest.mark.parametrize("chunk_size", [1, 3, 17, 64, 1024, 1 << 20])
+    def test_parts_split_at_any_chunk_size(self, chunk_size):
+        mp, parts = self.parse(make_mtom_body(self.IMAGE), chunk_size)
+        assert len(parts) == 2
+        assert parts[0].endswith(b"</soap:Envelope>")
+        assert parts[1] == self.IMAGE
+        assert mp.parts[1][0].get_content_type() == "image/jpeg"
+
+    @pytest.mark.parametrize("chunk_size", [5, 4096])
+    def test_base64_parts_decoded(self, chunk_size):
+        _, parts = self.parse(make_mtom_body(self.IMAGE, "base64"), chunk_size)
+        assert parts[1] == self.IMAGE
+
+
+    @pytest.mark.parametrize("cut", [-len(MTOM_BOUNDARY) - 6, -2000, 40])
+    def test_truncated_body_rejected(self, cut):
+        with pytest.raises(ValueError):
+            self.parse(make_mtom_body(self.IMAGE)[:cut], 1024)
+
+
+class _RetrieveImageHandler(_KeepAliveHandler):
+    body = b""
+    content_type = ""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["content-length"]))
+        self.send_response(200)
+        self.send_header("Content-Type", self.content_type)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+
+class TestRetrieveImage:
+    """Verify RetrieveImage responses are streamed into the sink."""
+
+    @pytest.fixture
+    def device(self):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RetrieveImageHandler)
+        t = threading.Thread(target=server.serve_forever, daemon=True)
+        t.start()
+        yield make_test_host("http://127.0.0.1:%d/wsd/scan" % server.server_address[1])
+        server.shutdown()
+        server.server_close()
+
+    @staticmethod
+    def make_job():
+        job = wsd_scan__structures.ScanJob()
+        job.id = 1
+        job.token = "token"
+        return job
+
+    def test_image_streamed_to_sink(self, device, monkeypatch):
+        image = TestMultipartStreamParser.IMAGE
+        monkeypatch.setattr(_RetrieveImageHandler, "body", make_mtom_body(image))
+        monkeypatch.setattr(_RetrieveImageHandler, "content_type", MTOM_CONTENT_TYPE)
+        sink = io.BytesIO()
+        content_type = wsd_scan__operations.wsd_retrieve_image_data(device, self.make_job(), "doc", sink)
+        assert content_type == "image/jpeg"
+        assert sink.getvalue() == image
+
+    def test_truncated_image_discarded(self, device, monkeypatch, tmp_path):
+        body = make_mtom_body(TestMultipartStreamParser.IMAGE)[:-2000]
+        monkeypatch.setattr(_RetrieveImageHandler, "body", body)
+        monkeypatch.setattr(_RetrieveImageHandler, "content_type", MTOM_CONTENT_TYPE)
+        with pytest.raises(ValueError):
+            wsd_scan__operations.wsd_retrieve_image_to_file(device, self.make_job(), "doc", str(tmp_path))
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_no_images_available(self, device, monkeypatch):
+        fault = b'<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope"><soap:Body><soap:Fault>' \
+                b'<soap:Code><soap:Value>soap:Sender</soap:Value><soap:Subcode>' \
+                b'<soap:Value>wscn:ClientErrorNoImagesAvailable</soap:Value></soap:Subcode></soap:Code>' \
+                b'</soap:Fault></soap:Body></soap:Envelope>'
+        monkeypatch.setattr(_RetrieveImageHandler, "body", fault)
+        monkeypatch.setattr(_RetrieveImageHandler, "content_type", "application/soap+xml")
+        assert wsd_scan__operations.wsd_retrieve_image_data(device, self.make_job(), "doc", io.BytesIO()) is None
+
+
+# --- JPEG passthrough ---
+
+def make_test_jpeg(size=(64, 48)):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(buf, format="jpeg", quality=90)
+    return buf.getvalue()
+
+
+class TestJpegPassthrough:
+    """Verify device JPEGs are written as they are when no conversion is needed."""
+
+    def test_jpeg_written_verbatim(self, tmp_path):
+        data = make_test_jpeg()
+        profile = {"image_format": "jpeg", "quality": 20}
+        out = tmp_path / "page.jpeg"
+        assert wsd_scan__events.save_page(data, profile, str(out)) == data
+        assert out.read_bytes() == data
+
+    def test_conversion_decodes(self, tmp_path):
+        from PIL import Image
+        profile = {"image_format": "png", "quality": 90}
+        out = tmp_path / "page.png"
+        assert wsd_scan__events.save_page(make_test_jpeg(), profile, str(out)) == str(out)
+        assert Image.open(str(out)).format == "PNG"
+
+    def test_non_jpeg_data_not_passed_through(self):
+        assert not wsd_scan__events.is_passthrough_page(b"II*\x00", {"image_format": "jpeg"})
+        assert wsd_scan__events.is_passthrough_page(make_test_jpeg(), {"image_format": "JPG"})
+
+
+# --- Pipelined page saving ---
+
+class TestPageSaveStage:
+    """Verify pages are saved in order by the save stage, with a bounded queue."""
+
+    def test_pages_saved_in_order(self, tmp_path):
+        data = make_test_jpeg()
+        profile = {"image_format": "jpeg", "quality": 70, "target_folder": str(tmp_path)}
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", depth=2)
+        for i in range(5):
+            stage.put(i, data)
+        stage.finish()
+        assert stage.picture_files == ["%s/scan_%d.jpeg" % (tmp_path, i) for i in range(5)]
+        stage.finish()
+
+    def test_backpressure(self, tmp_path, monkeypatch):
+        release = threading.Event()
+
+        def slow_save(data, profile, picture_file, geometry=None, mode=None):
+            release.wait(5)
+            return picture_file
+
+        monkeypatch.setattr(wsd_scan__events, "save_page", slow_save)
+        profile = {"image_format": "jpeg", "quality": 70, "target_folder": str(tmp_path)}
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", depth=1)
+
+        def producer():
+            for i in range(3):
+                stage.put(i, b"")
+
+        t = threading.Thread(target=producer, daemon=True)
+        t.start()
+        # one page is being saved, one is queued, the third put must block
+        t.join(0.3)
+        assert t.is_alive()
+        release.set()
+        t.join(5)
+        stage.finish()
+        assert len(stage.picture_files) == 3
+
+
+# --- Process pool encoding ---
+
+@pytest.fixture(scope="module")
+def encoder():
+    from wsd_scan.image_encoder import ProcessPoolEncoder
+    enc = ProcessPoolEncoder(2)
+    yield enc
+    enc.close()
+
+
+class TestProcessPoolEncoder:
+    """Verify pages are encoded by worker processes through temporary files."""
+
+    def test_pages_encoded_in_order(self, tmp_path, encoder):
+        from PIL import Image
+        profile = {"image_format": "png", "quality": 90, "target_folder": str(tmp_path)}
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", depth=2, encoder=encoder)
+        for i in range(3):
+            stage.put(i, make_test_jpeg())
+        stage.finish()
+        assert stage.picture_files == ["%s/scan_%d.png" % (tmp_path, i) for i in range(3)]
+        assert all(Image.open(f).format == "PNG" for f in stage.picture_files)
+        # the temporary files handed to the workers are gone
+        assert sorted(os.listdir(str(tmp_path))) == ["scan_0.png", "scan_1.png", "scan_2.png"]
+
+    def test_passthrough_skips_pool(self, tmp_path, encoder):
+        data = make_test_jpeg()
+        profile = {"image_format": "jpeg", "quality": 90, "target_folder": str(tmp_path)}
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", encoder=encoder)
+        stage.put(0, data)
+        stage.finish()
+        assert (tmp_path / "scan_0.jpeg").read_bytes() == data
+
+
+# --- Streaming PDF assembly ---
+
+def check_pdf_xref(path):
+    """Verify every xref entry points to the start of its object, and return the number of pages."""
+    import re
+    raw = open(path, "rb").read()
+    assert raw.startswith(b"%PDF-1.4") and raw.rstrip().endswith(b"%%EOF")
+    xref = int(raw[raw.rindex(b"startxref") + 9:].split()[0])
+    assert raw[xref:xref + 4] == b"xref"
+    entries = re.findall(rb"(\d{10}) 00000 n ", raw[xref:])
+    for num, offset in enumerate(entries, start=1):
+        assert raw[int(offset):].startswith(b"%d 0 obj" % num)
+    return int(re.search(rb"/Type /Pages /Kids \[[^]]*\] /Count (\d+)", raw).group(1))
+
+
+class TestStreamingPdfWriter:
+    """Verify the incremental PDF writer output."""
+
+    def test_jpeg_embedded_verbatim(self, tmp_path):
+        from wsd_scan.pdf_writer import StreamingPdfWriter
+        data = make_test_jpeg()
+        path = str(tmp_path / "out.pdf")
+        with StreamingPdfWriter(path) as pdf:
+            pdf.add_page(data)
+            pdf.add_page(data)
+        raw = open(path, "rb").read()
+        assert raw.count(data) == 2
+        assert b"/DCTDecode" in raw
+        assert check_pdf_xref(path) == 2
+
+    def test_page_size_from_resolution(self, tmp_path):
+        from PIL import Image
+        from wsd_scan.pdf_writer import StreamingPdfWriter
+        png = tmp_path / "page.png"
+        Image.new("1", (300, 600), 1).save(str(png))
+        path = str(tmp_path / "out.pdf")
+        with StreamingPdfWriter(path, default_dpi=150) as pdf:
+            pdf.add_page(str(png))
+        raw = open(path, "rb").read()
+        assert b"/MediaBox [0 0 144.0000 288.0000]" in raw
+        assert b"/FlateDecode" in raw and b"/BitsPerComponent 1" in raw
+        assert check_pdf_xref(path) == 1
+
+    def test_readable_by_pdf_library(self, tmp_path):
+        from PIL import Image
+        from wsd_scan.pdf_writer import StreamingPdfWriter
+        pikepdf = pytest.importorskip("pikepdf")
+        png = tmp_path / "page.png"
+        Image.new("RGB", (40, 30), (0, 128, 255)).save(str(png))
+        path = str(tmp_path / "out.pdf")
+        with StreamingPdfWriter(path) as pdf:
+            pdf.add_page(make_test_jpeg())
+            pdf.add_page(str(png))
+        with pikepdf.open(path) as doc:
+            assert len(doc.pages) == 2
+            image = pikepdf.PdfImage(doc.pages[1].Resources.XObject["/Im0"]).as_pil_image()
+            assert image.getpixel((0, 0)) == (0, 128, 255)
+
+    def test_finish_once(self, tmp_path, caplog):
+        import logging
+        pdf_file = str(tmp_path / "scan.pdf")
+        profile = {"image_format": "jpeg", "quality": 70, "target_folder": str(tmp_path), "resolution": 300}
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", pdf_file=pdf_file)
+        stage.put(0, make_test_jpeg())
+        with caplog.at_level(logging.INFO, logger="wsd_scan"):
+            stage.finish()
+            stage.finish()
+        assert caplog.text.count("Saved PDF") == 1
+        assert check_pdf_xref(pdf_file) == 1
+
+    def test_pages_appended_while_saving(self, tmp_path):
+        data = make_test_jpeg()
+        pdf_file = str(tmp_path / "scan.pdf")
+        profile = {"image_format": "jpeg", "quality": 70, "target_folder": str(tmp_path), "resolution": 300}
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", pdf_file=pdf_file)
+        for i in range(3):
+            stage.put(i, data)
+        stage.finish()
+        assert open(pdf_file, "rb").read().count(data) == 3
+        assert check_pdf_xref(pdf_file) == 3
+
+
+# --- Concurrent event listener ---
+
+EVENT_BODY = b'<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" ' \
+             b'xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing"><soap:Header>' \
+             b'<wsa:Action>http://example.com/OtherEvent</wsa:Action></soap:Header><soap:Body/></soap:Envelope>'
+
+
+def post_event(port, body=EVENT_BODY, timeout=5):
+    import socket
+    with socket.create_connection(("127.0.0.1", port), timeout=timeout) as s:
+        s.sendall(b"POST /wsd HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/soap+xml\r\n"
+                  b"Content-Length: %d\r\n\r\n" % len(body) + body)
+        return s.recv(1024).split(b"\r\n")[0]
+
+
+class TestEventListener:
+    """Verify the event listener handles notifications concurrently, with timeouts and a cap."""
+
+    @pytest.fixture
+    def listener(self):
+        servers = []
+
+        def start(**kw):
+            server = wsd_scan__events.HTTPServerWithContext(("127.0.0.1", 0), wsd_scan__events.RequestHandler,
+                                                            {"queues": wsd_scan__events.QueuesSet()}, **kw)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers.append(server)
+            return server
+
+        yield start
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    @staticmethod
+    def stall(port):
+        import socket
+        s = socket.create_connection(("127.0.0.1", port))
+        s.sendall(b"POST /wsd HTTP/1.1\r\nContent-Length: 100\r\n\r\n<soap")
+        return s
+
+    def test_stalled_client_does_not_block(self, listener):
+        server = listener(workers=4, read_timeout=5)
+        stalled = self.stall(server.server_address[1])
+        try:
+            assert post_event(server.server_address[1], timeout=2) == b"HTTP/1.1 202 Accepted"
+        finally:
+            stalled.close()
+
+    def test_read_timeout_drops_connection(self, listener):
+        server = listener(read_timeout=0.2)
+        stalled = self.stall(server.server_address[1])
+        stalled.settimeout(3)
+        assert stalled.recv(1024) == b""
+        stalled.close()
+
+    def test_requests_over_cap_rejected(self, listener):
+        server = listener(workers=1, max_in_flight=1, read_timeout=5)
+        stalled = self.stall(server.server_address[1])
+        try:
+            assert post_event(server.server_address[1]) == b"HTTP/1.1 503 Service Unavailable"
+            assert server.rejected == 1
+        finally:
+            stalled.close()
+
+
+# --- asyncio event listener ---
+
+STATUS_EVENT_BODY = b'<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" ' \
+                    b'xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing" ' \
+                    b'xmlns:sca="http://schemas.microsoft.com/windows/2006/08/wdp/scan"><soap:Header>' \
+                    b'<wsa:Action>http://schemas.microsoft.com/windows/2006/08/wdp/scan/ScannerStatusSummaryEvent' \
+                    b'</wsa:Action></soap:Header><soap:Body><sca:ScannerStatusSummaryEvent><sca:StatusSummary>' \
+                    b'<sca:ScannerState>Idle</sca:ScannerState></sca:StatusSummary>' \
+                    b'</sca:ScannerStatusSummaryEvent></soap:Body></soap:Envelope>'
+
+
+class TestAsyncEventListener:
+    """Verify the asyncio listener framing and event dispatching."""
+
+    @pytest.fixture
+    def listener(self):
+        from wsd_scan.wsd_scan__async_events import AsyncEventListener
+        listener = AsyncEventListener(("127.0.0.1", 0), {"queues": wsd_scan__events.QueuesSet()}, read_timeout=0.5)
+        t = threading.Thread(target=listener.serve_forever, daemon=True)
+        t.start()
+        assert listener.started.wait(5)
+        yield listener
+        listener.shutdown()
+        t.join(5)
+
+    def test_event_dispatched(self, listener):
+        assert post_event(listener.server_address[1], STATUS_EVENT_BODY) == b"HTTP/1.1 202 Accepted"
+        assert listener.context["queues"].sc_stat_sum_q.get(timeout=5) == ("Idle", [])
+
+    def test_keep_alive(self, listener):
+        import socket
+        request = b"POST /wsd HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(EVENT_BODY) + EVENT_BODY
+        with socket.create_connection(("127.0.0.1", listener.server_address[1]), timeout=5) as s:
+            for _ in range(3):
+                s.sendall(request)
+                assert s.recv(1024).startswith(b"HTTP/1.1 202 Accepted")
+        assert listener.handled == 3
+
+    def test_oversized_body_rejected(self, listener):
+        import socket
+        with socket.create_connection(("127.0.0.1", listener.server_address[1]), timeout=5) as s:
+            s.sendall(b"POST /wsd HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (listener.MAX_BODY + 1))
+            assert s.recv(1024).startswith(b"HTTP/1.1 413")
+
+    def test_idle_connection_closed(self, listener):
+        import socket
+        with socket.create_connection(("127.0.0.1", listener.server_address[1]), timeout=5) as s:
+            s.sendall(b"POST /wsd HTTP/1.1\r\n")
+            assert s.recv(1024) == b""
+
+
+# --- Scan job scheduler ---
+
+class TestScanJobScheduler:
+    """Verify the scan job scheduler limits, ordering and metrics."""
+
+    @staticmethod
+    def tracker():
+        lock = threading.Lock()
+        state = {"running": {}, "peak": {}, "total": 0, "peak_total": 0, "order": []}
+
+        def job(device, name, delay=0.05):
+            with lock:
+                state["running"][device] = state["running"].get(device, 0) + 1
+                state["total"] += 1
+                state["peak"][device] = max(state["peak"].get(device, 0), state["running"][device])
+                state["peak_total"] = max(state["peak_total"], state["total"])
+                state["order"].append(name)
+            import time
+            time.sleep(delay)
+            with lock:
+                state["running"][device] -= 1
+                state["total"] -= 1
+
+        return state, job
+
+    def test_per_device_limit(self):
+        from wsd_scan.job_scheduler import ScanJobScheduler
+        scheduler = ScanJobScheduler(max_workers=4, per_device=1)
+        state, job = self.tracker()
+        for i in range(4):
+            scheduler.submit("a", job, "a", i)
+            scheduler.submit("b", job, "b", i)
+        assert scheduler.join(5)
+        assert state["peak"] == {"a": 1, "b": 1}
+        assert state["peak_total"] == 2
+
+    def test_global_cap(self):
+        from wsd_scan.job_scheduler import ScanJobScheduler
+        scheduler = ScanJobScheduler(max_workers=2, per_device=1)
+        state, job = self.tracker()
+        for device in "abcdef":
+            scheduler.submit(device, job, device, device)
+        assert scheduler.join(5)
+        assert state["peak_total"] == 2
+        assert scheduler.stats().completed == 6
+
+    def test_priority_then_fifo(self):
+        from wsd_scan.job_scheduler import ScanJobScheduler
+        scheduler = ScanJobScheduler(max_workers=1, per_device=1)
+        state, job = self.tracker()
+        release = threading.Event()
+        scheduler.submit("a", release.wait, 5)
+        import time
+        deadline = time.monotonic() + 5
+        while scheduler.stats().running == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        scheduler.submit("a", job, "a", "low-1")
+        scheduler.submit("a", job, "a", "low-2")
+        scheduler.submit("a", job, "a", "high", priority=5)
+        assert scheduler.queue_depth() == 3
+        assert scheduler.queue_depth("b") == 0
+        release.set()
+        assert scheduler.join(5)
+        assert state["order"] == ["high", "low-1", "low-2"]
+
+    def test_wait_metrics_and_failures(self):
+        from wsd_scan.job_scheduler import ScanJobScheduler
+        scheduler = ScanJobScheduler(max_workers=1)
+        state, job = self.tracker()
+
+        def fail():
+            raise RuntimeError("device offline")
+
+        scheduler.submit("a", job, "a", 0, 0.1)
+        scheduler.submit("a", fail)
+        assert scheduler.join(5)
+        stats = scheduler.stats()
+        assert (stats.submitted, stats.completed, stats.failed, stats.queued, stats.running) == (2, 1, 1, 0, 0)
+        assert stats.max_wait >= 0.09
+
+
+# --- Duplicate event suppression ---
+
+def make_event(action, body, msg_id):
+    return ('<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" '
+            'xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing" '
+            'xmlns:sca="http://schemas.microsoft.com/windows/2006/08/wdp/scan"><soap:Header>'
+            '<wsa:Action>http://schemas.microsoft.com/windows/2006/08/wdp/scan/%s</wsa:Action>'
+            '<wsa:MessageID>%s</wsa:MessageID></soap:Header><soap:Body>%s</soap:Body></soap:Envelope>'
+            % (action, msg_id, body)).encode()
+
+
+def make_scan_available_event(msg_id, scan_identifier, client_context="ctx"):
+    return make_event("ScanAvailableEvent",
+                      '<sca:ScanAvailableEvent><sca:ClientContext>%s</sca:ClientContext>'
+                      '<sca:ScanIdentifier>%s</sca:ScanIdentifier></sca:ScanAvailableEvent>'
+                      % (client_context, scan_identifier), msg_id)
+
+
+class TestRecentIds:
+    """Verify the bounded, time-limited set of recently seen identifiers."""
+
+    def test_duplicates_counted(self):
+        ids = wsd_common.RecentIds()
+        assert ids.check_and_add("a")
+        assert ids.check_and_add("b")
+        assert not ids.check_and_add("a")
+        assert ids.duplicates == 1
+
+    def test_capacity_evicts_least_recently_seen(self):
+        ids = wsd_common.RecentIds(capacity=2)
+        ids.check_and_add("a")
+        ids.check_and_add("b")
+        ids.check_and_add("a")  # "b" is now the least recently seen
+        ids.check_and_add("c")
+        assert len(ids) == 2
+        assert ids.check_and_add("b")
+
+    def test_ttl(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(wsd_common.time, "monotonic", lambda: now[0])
+        ids = wsd_common.RecentIds(ttl=10)
+        ids.check_and_add("a")
+        now[0] += 5
+        assert not ids.check_and_add("a")
+        now[0] += 11
+        assert ids.check_and_add("a")
+
+    def test_concurrent_sightings(self):
+        from concurrent.futures import ThreadPoolExecutor
+        ids = wsd_common.RecentIds(capacity=10000)
+        keys = ["urn:uuid:%d" % (i % 500) for i in range(4000)]
+        with ThreadPoolExecutor(8) as ex:
+            new = sum(ex.map(ids.check_and_add, keys))
+        assert new == 500
+        assert ids.duplicates == 3500
+
+    def test_shared_store(self, monkeypatch):
+        monkeypatch.setattr(wsd_common, "message_ids", wsd_common.RecentIds())
+        wsd_common.configure_message_ids(capacity=1)
+        assert wsd_common.record_message_id("urn:uuid:1")
+        assert not wsd_common.record_message_id("urn:uuid:1")
+        assert wsd_common.record_message_id(None)
+        assert wsd_common.record_message_id("urn:uuid:2")
+        assert wsd_common.record_message_id("urn:uuid:1")
+
+
+class TestDuplicateEvents:
+    """Verify retransmitted events are dropped before reaching the handlers."""
+
+    @pytest.fixture(autouse=True)
+    def fresh_state(self, monkeypatch):
+        submitted = []
+        monkeypatch.setattr(wsd_common, "message_ids", wsd_common.RecentIds())
+        monkeypatch.setattr(wsd_scan__events.scan_scheduler, "submit",
+                            lambda device, fn, *args, **kw: submitted.append(args))
+        monkeypatch.setitem(wsd_scan__events.host_map, "ctx", make_test_host())
+        return submitted
+
+    def test_same_message_id_dropped(self, fresh_state):
+        context = {"queues": wsd_scan__events.QueuesSet()}
+        body = '<sca:ScannerStatusSummaryEvent><sca:StatusSummary><sca:ScannerState>Idle</sca:ScannerState>' \
+               '</sca:StatusSummary></sca:ScannerStatusSummaryEvent>'
+        event = make_event("ScannerStatusSummaryEvent", body, "urn:uuid:1")
+        wsd_scan__events.RequestHandler.dispatch_event(context, event)
+        wsd_scan__events.RequestHandler.dispatch_event(context, event)
+        assert context["queues"].sc_stat_sum_q.qsize() == 1
+        assert wsd_common.message_ids.duplicates == 1
+
+    def test_same_scan_identifier_dropped(self, fresh_state):
+        context = {"queues": wsd_scan__events.QueuesSet()}
+        wsd_scan__events.RequestHandler.dispatch_event(context, make_scan_available_event("urn:uuid:1", "scan-1"))
+        wsd_scan__events.RequestHandler.dispatch_event(context, make_scan_available_event("urn:uuid:2", "scan-1"))
+        wsd_scan__events.RequestHandler.dispatch_event(context, make_scan_available_event("urn:uuid:3", "scan-2"))
+        assert [args[1] for args in fresh_state] == ["scan-1", "scan-2"]
+        assert wsd_common.message_ids.duplicates == 1
+
+
+# --- Keep-alive on the event listener ---
+
+class TestListenerKeepAlive:
+    """Verify persistent connections on the thread pool listener."""
+
+    REQUEST = b"POST /wsd HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(EVENT_BODY) + EVENT_BODY
+
+    @pytest.fixture
+    def listener(self):
+        servers = []
+
+        class QuietHandler(wsd_scan__events.RequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+        def start(**kw):
+            server = wsd_scan__events.HTTPServerWithContext(("127.0.0.1", 0), QuietHandler,
+                                                            {"queues": wsd_scan__events.QueuesSet()}, **kw)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers.append(server)
+            return server
+
+        yield start
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    @staticmethod
+    def read_response(s):
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = s.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_requests_share_connection(self, listener):
+        import socket
+        server = listener(keepalive_requests=3)
+        with socket.create_connection(("127.0.0.1", server.server_address[1]), timeout=5) as s:
+            for i in range(3):
+                s.sendall(self.REQUEST)
+                response = self.read_response(s)
+                assert response.startswith(b"HTTP/1.1 202")
+                assert (b"Connection: close" in response) == (i == 2)
+            assert s.recv(1024) == b""
+
+    def test_connection_close_honored(self, listener):
+        import socket
+        server = listener()
+        with socket.create_connection(("127.0.0.1", server.server_address[1]), timeout=5) as s:
+            s.sendall(self.REQUEST.replace(b"HTTP/1.1\r\n", b"HTTP/1.1\r\nConnection: close\r\n", 1))
+            assert b"Connection: close" in self.read_response(s)
+            assert s.recv(1024) == b""
+
+    def test_idle_connection_closed(self, listener):
+        import socket
+        server = listener(keepalive_timeout=0.2)
+        with socket.create_connection(("127.0.0.1", server.server_address[1]), timeout=5) as s:
+            s.sendall(self.REQUEST)
+            assert b"Connection: keep-alive" in self.read_response(s)
+            assert s.recv(1024) == b""
+
+    def test_idle_connections_leave_a_worker(self, listener):
+        import socket
+        server = listener(workers=2, keepalive_timeout=5.0)
+        clients = []
+        try:
+            responses = []
+            for _ in range(4):
+                s = socket.create_connection(("127.0.0.1", server.server_address[1]), timeout=2)
+                clients.append(s)
+                s.sendall(self.REQUEST)
+                # answered without waiting for the keep-alive timeout of the connections before
+                responses.append(self.read_response(s))
+            assert all(r.startswith(b"HTTP/1.1 202") for r in responses)
+            assert b"Connection: keep-alive" in responses[0]
+            assert all(b"Connection: close" in r for r in responses[1:])
+        finally:
+            for s in clients:
+                s.close()
+
+    def test_async_listener_request_cap(self):
+        import socket
+        from wsd_scan.wsd_scan__async_events import AsyncEventListener
+        listener = AsyncEventListener(("127.0.0.1", 0), {"queues": wsd_scan__events.QueuesSet()},
+                                      keepalive_requests=2)
+        t = threading.Thread(target=listener.serve_forever, daemon=True)
+        t.start()
+        assert listener.started.wait(5)
+        try:
+            with socket.create_connection(("127.0.0.1", listener.server_address[1]), timeout=5) as s:
+                s.sendall(self.REQUEST)
+                assert b"Connection: keep-alive" in self.read_response(s)
+                s.sendall(self.REQUEST)
+                assert b"Connection: close" in self.read_response(s)
+                assert s.recv(1024) == b""
+        finally:
+            listener.shutdown()
+            t.join(5)
+
+
+# --- Compiled XPath registry ---
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load_fixture(name):
+    from lxml import etree
+    return etree.parse(os.path.join(FIXTURES_DIR, name), wsd_common.parser).getroot()
+
+
+class TestCompiledQueries:
+    """Verify compiled queries select the same nodes as ElementPath lookups."""
+
+    QUERIES = [".//sca:ScannerConfiguration", ".//sca:Width", "soap:Header", "soap:Header/wsa:Action",
+               ".//sca:Platen/sca:PlatenResolutions/sca:Widths/sca:Width", ".//sca:ColorEntry",
+               ".//sca:ElementData[@Name='sca:ScannerStatus']", ".//sca:Missing", "sca:Missing"]
+
+    @pytest.mark.parametrize("query", QUERIES)
+    def test_same_nodes_as_element_path(self, query):
+        x = load_fixture("get_scanner_elements_response.xml")
+        assert wsd_common.xml_find(x, query) is x.find(query, wsd_common.NSMAP)
+        assert wsd_common.xml_findall(x, query) == x.findall(query, wsd_common.NSMAP)
+
+    def test_relative_to_element(self):
+        x = load_fixture("get_scanner_elements_response.xml")
+        dps = wsd_common.xml_find(x, ".//sca:DocumentParameters")
+        assert wsd_common.get_xml_str(dps, ".//sca:Format") == "jfif"
+        assert wsd_common.get_xml_int(dps, ".//sca:ExposureSettings/sca:Contrast") == 0
+        assert wsd_common.get_xml_str_set(x, ".//sca:ScannerInfo") == {"Samsung", "M288x", "Series"}
+        assert wsd_common.get_xml_str(dps, "sca:JobName") is None
+
+    def test_compiled_once(self):
+        registry = wsd_common.CompiledQueries(wsd_common.NSMAP)
+        assert registry.first(".//sca:JobId") is registry.first(".//sca:JobId")
+        assert registry.all(".//sca:JobId") is registry.all(".//sca:JobId")
+        assert len(registry) == 2
+
+
+# --- Single-pass parsers ---
+
+PARSED_FIXTURES = ["get_scanner_elements_response.xml", "get_scanner_elements_response_duplex.xml",
+                   "create_scan_job_response.xml"]
+
+
+def as_plain(o):
+    """Turn parsed structures into the dicts and lists of the recorded JSON results."""
+    if hasattr(o, "__dict__"):
+        return {k: as_plain(v) for k, v in sorted(vars(o).items())}
+    if isinstance(o, (list, tuple)):
+        return [as_plain(v) for v in o]
+    if isinstance(o, dict):
+        return {str(k): as_plain(v) for k, v in o.items()}
+    return o
+
+
+@pytest.fixture(scope="module")
+def recorded():
+    with open(os.path.join(FIXTURES_DIR, "parsed_elements.json")) as f:
+        return json.load(f)
+
+
+class TestSinglePassParsers:
+    """Verify the parsers give the results recorded with the original .// search based ones."""
+
+    @pytest.mark.parametrize("name", PARSED_FIXTURES)
+    def test_same_results_as_recorded(self, recorded, name):
+        x = load_fixture(name)
+        expected = recorded[name]
+        if "configuration" in expected:
+            config = wsd_common.xml_find(x, ".//sca:ScannerConfiguration")
+            ticket = wsd_common.xml_find(x, ".//sca:DefaultScanTicket")
+            assert as_plain(wsd_scan__parsers.parse_scan_configuration(config)) == expected["configuration"]
+            assert as_plain(wsd_scan__parsers.parse_scan_ticket(ticket)) == expected["ticket"]
+        if "job" in expected:
+            job = wsd_common.xml_find(x, ".//sca:CreateScanJobResponse")
+            assert as_plain(wsd_scan__parsers.parse_scan_job(job)) == expected["job"]
+
+    def test_duplex_back_side(self):
+        x = load_fixture("get_scanner_elements_response_duplex.xml")
+        config = wsd_scan__parsers.parse_scan_configuration(wsd_common.xml_find(x, ".//sca:ScannerConfiguration"))
+        assert config.adf_duplex is True
+        assert config.back_adf.width_res == ["75", "100", "150", "200"]
+        assert config.front_adf.max_size == (8500, 14000)
+        assert config.back_adf.max_size == (8500, 11690)
+        ticket = wsd_scan__parsers.parse_scan_ticket(wsd_common.xml_find(x, ".//sca:DefaultScanTicket"))
+        assert ticket.doc_params.size_autodetect is True
+        assert ticket.doc_params.back.offset == (100, 0)
+        assert ticket.doc_params.back.res == (300, 150)
+
+    def test_missing_back_side_copies_front(self):
+        x = load_fixture("get_scanner_elements_response.xml")
+        dps = wsd_common.xml_find(x, ".//sca:DocumentParameters")
+        params = wsd_scan__parsers.parse_document_params(dps)
+        assert params.back is not params.front
+        assert as_plain(params.back) == as_plain(params.front)
+
+    def test_source_settings_by_name(self):
+        x = load_fixture("get_scanner_elements_response.xml")
+        pla = wsd_common.xml_find(x, ".//sca:Platen")
+        sss = wsd_scan__parsers.parse_scanner_source_settings(pla, "Platen")
+        assert sss.optical_res == (600, 600)
+        assert sss.color_modes == ["BlackAndWhite1", "Grayscale8", "RGB24"]
+        assert wsd_scan__parsers.parse_scanner_source_settings(pla, "ADF").width_res == []
+
+    def test_first_match_in_document_order(self):
+        from lxml import etree
+        ns = wsd_common.NSMAP["sca"]
+        dps = etree.fromstring(
+            '<sca:DocumentParameters xmlns:sca="%s">'
+            '<sca:Wrapper><sca:Format>first</sca:Format></sca:Wrapper>'
+            '<sca:Format>second</sca:Format>'
+            '<sca:MediaSides><sca:MediaFront>'
+            '<sca:Wrapper><sca:Width>1</sca:Width></sca:Wrapper>'
+            '<sca:Resolution><sca:Width>200</sca:Width><sca:Height>100</sca:Height></sca:Resolution>'
+            '<sca:Resolution><sca:Width>300</sca:Width><sca:Height>300</sca:Height></sca:Resolution>'
+            '</sca:MediaFront></sca:MediaSides>'
+            '</sca:DocumentParameters>' % ns)
+        params = wsd_scan__parsers.parse_document_params(dps)
+        # a tag without a rule is searched in the descendants
+        assert params.format == "first"
+        # the steps of a path only match direct children
+        assert params.front.res == (200, 100)
+        assert as_plain(params.back) == as_plain(params.front)
+
+
+# --- Lazily parsed scanner elements ---
+
+def counting_parser(parser, calls):
+    def parse(x):
+        calls.append(parser.__name__)
+        return parser(x)
+    parse.__name__ = parser.__name__
+    return parse
+
+
+class TestParsedView:
+    """Verify scanner elements are parsed only when used, and only once."""
+
+    def test_parsed_on_first_access(self):
+        calls = []
+        x = load_fixture("get_scanner_elements_response.xml")
+        view = wsd_scan__parsers.ParsedView(counting_parser(wsd_scan__parsers.parse_scan_ticket, calls),
+                                            wsd_common.xml_find(x, ".//sca:DefaultScanTicket"))
+        assert not view.is_parsed
+        assert calls == []
+        assert view.job_name == "Scan"
+        assert view.doc_params.front.res == (300, 300)
+        assert view.is_parsed
+        assert calls == ["parse_scan_ticket"]
+
+    def test_same_results_as_recorded(self, recorded):
+        x = load_fixture("get_scanner_elements_response_duplex.xml")
+        view = wsd_scan__parsers.ParsedView(wsd_scan__parsers.parse_scan_configuration,
+                                            wsd_common.xml_find(x, ".//sca:ScannerConfiguration"))
+        expected = recorded["get_scanner_elements_response_duplex.xml"]["configuration"]
+        assert as_plain(view.materialize()) == expected
+        assert str(view) == str(view.materialize())
+
+    def test_writes_and_copies_use_the_parsed_structure(self):
+        x = load_fixture("get_scanner_elements_response.xml")
+        view = wsd_scan__parsers.ParsedView(wsd_scan__parsers.parse_scan_ticket,
+                                            wsd_common.xml_find(x, ".//sca:DefaultScanTicket"))
+        import copy
+        tkt = copy.deepcopy(view)
+        assert type(tkt) is wsd_scan__structures.ScanTicket
+        tkt.doc_params.format = "png"
+        assert view.doc_params.format == "jfif"
+        view.job_name = "Changed"
+        assert view.materialize().job_name == "Changed"
+
+    def test_concurrent_first_access(self):
+        from concurrent.futures import ThreadPoolExecutor
+        calls = []
+        x = load_fixture("get_scanner_elements_response.xml")
+        view = wsd_scan__parsers.ParsedView(counting_parser(wsd_scan__parsers.parse_scan_status, calls),
+                                            wsd_common.xml_find(x, ".//sca:ScannerStatus"))
+        with ThreadPoolExecutor(8) as ex:
+            states = list(ex.map(lambda _: view.state, range(32)))
+        assert states == ["Idle"] * 32
+        assert calls == ["parse_scan_status"]
+
+    def test_get_scanner_elements_is_lazy(self, monkeypatch):
+        calls = []
+        for name in ("parse_scan_description", "parse_scan_status", "parse_scan_configuration", "parse_scan_ticket"):
+            monkeypatch.setattr(wsd_scan__parsers, name, counting_parser(getattr(wsd_scan__parsers, name), calls))
+        monkeypatch.setattr(wsd_common, "submit_request",
+                            lambda *args: load_fixture("get_scanner_elements_response.xml"))
+        monkeypatch.setattr(wsd_scan__operations, "scanner_elements_cache",
+                            wsd_scan__operations.ScannerElementsCache())
+        description, config, status, ticket = wsd_scan__operations.wsd_get_scanner_elements(make_test_host())
+        assert calls == []
+        assert ticket.doc_params.input_src == "Platen"
+        assert calls == ["parse_scan_ticket"]
+        assert description.name.startswith("Samsung M288x")
+        assert calls == ["parse_scan_ticket", "parse_scan_description"]
+
+    def test_change_event_with_ticket_only(self, monkeypatch):
+        monkeypatch.setattr(wsd_scan__operations, "scanner_elements_cache",
+                            wsd_scan__operations.ScannerElementsCache())
+        host = make_test_host()
+        old = make_test_ticket()
+        wsd_scan__operations.scanner_elements_cache.put(host, "descr", "config", "status", old)
+        x = load_fixture("get_scanner_elements_response.xml")
+        ticket = wsd_common.xml_find(x, ".//sca:DefaultScanTicket")
+        from lxml import etree
+        body = '<sca:ScannerElementsChangeEvent><sca:ScannerElements><sca:ElementData Name="sca:DefaultScanTicket" ' \
+               'Valid="true">%s</sca:ElementData></sca:ScannerElements></sca:ScannerElementsChangeEvent>' \
+               % etree.tostring(ticket).decode()
+        queues = wsd_scan__events.QueuesSet()
+        wsd_scan__events.RequestHandler.dispatch_event(
+            {"queues": queues, "allow_device_initiated_scans": False},
+            make_event("ScannerElementsChangeEvent", body, "urn:uuid:lazy-1"), "10.0.0.1")
+        assert queues.sc_descr_q.empty() and queues.sc_conf_q.empty()
+        view = queues.sc_ticket_q.get_nowait()
+        assert not view.is_parsed
+        description, config, status, cached = wsd_scan__operations.scanner_elements_cache.get(host)
+        assert (description, config, status) == ("descr", "config", "status")
+        assert cached is view
+        assert cached.doc_params.format == "jfif"
+
+
+# --- Event action sniffing ---
+
+def make_large_status_event(msg_id, conditions=2000, action="ScannerStatusConditionEvent"):
+    condition = '<sca:DeviceCondition Id="%d"><sca:Time>2026-10-17T08:55:01Z</sca:Time><sca:Name>Noise</sca:Name>' \
+                '<sca:Component>ADF</sca:Component><sca:Severity>Informational</sca:Severity></sca:DeviceCondition>'
+    body = '<sca:%s>%s</sca:%s>' % (action, "".join(condition % i for i in range(conditions)), action)
+    return make_event(action, body, msg_id)
+
+
+class TestHeaderSniffing:
+    """Verify events are accepted or rejected from their SOAP header only."""
+
+    @pytest.fixture(autouse=True)
+    def trees(self, monkeypatch):
+        built = []
+        tree = wsd_common.SoapHeaderSniffer.tree
+
+        def counting_tree(sniffer):
+            built.append(sniffer.action)
+            return tree(sniffer)
+
+        monkeypatch.setattr(wsd_common.SoapHeaderSniffer, "tree", counting_tree)
+        monkeypatch.setattr(wsd_common, "message_ids", wsd_common.RecentIds())
+        return built
+
+    def test_stops_after_the_header(self):
+        event = make_large_status_event("urn:uuid:1")
+        sniffer = wsd_common.SoapHeaderSniffer(event)
+        assert sniffer.action.endswith("/ScannerStatusConditionEvent")
+        assert sniffer.message_id == "urn:uuid:1"
+        assert sniffer.bytes_parsed <= wsd_common.SoapHeaderSniffer.CHUNK_SIZE < len(event)
+
+    @pytest.mark.parametrize("conditions", [1, 100])
+    def test_tree_matches_full_parse(self, conditions):
+        from lxml import etree
+        event = make_large_status_event("urn:uuid:1", conditions=conditions)
+        sniffer = wsd_common.SoapHeaderSniffer(event)
+        assert sniffer.message_id == "urn:uuid:1"
+        assert etree.tostring(sniffer.tree()) == etree.tostring(etree.fromstring(event))
+        assert sniffer.tree() is sniffer.tree()
+
+    def test_parse_goes_on_after_sniffing(self, monkeypatch):
+        from lxml import etree
+        event = make_large_status_event("urn:uuid:1", conditions=45)
+        assert wsd_common.SoapHeaderSniffer.FULL_PARSE_SIZE < len(event)
+        sniffer = wsd_common.SoapHeaderSniffer(event)
+        assert len(event) - sniffer.bytes_parsed <= wsd_common.SoapHeaderSniffer.REPARSE_SIZE
+        monkeypatch.setattr(wsd_common, "parse_xml", None)
+        assert etree.tostring(sniffer.tree()) == etree.tostring(etree.fromstring(event))
+
+    def test_header_without_message_id(self):
+        sniffer = wsd_common.SoapHeaderSniffer(STATUS_EVENT_BODY)
+        assert sniffer.action.endswith("/ScannerStatusSummaryEvent")
+        assert sniffer.message_id is None
+        assert wsd_common.xml_find(sniffer.tree(), ".//sca:ScannerState").text == "Idle"
+
+    def test_scan_identifier_read_before_the_body(self, trees, monkeypatch):
+        submitted = []
+        monkeypatch.setattr(wsd_scan__events.scan_scheduler, "submit",
+                            lambda device, fn, *args, **kw: submitted.append(args))
+        monkeypatch.setitem(wsd_scan__events.host_map, "ctx", make_test_host())
+        padding = "<sca:Padding>%s</sca:Padding>" % ("x" * 20000)
+
+        def event(msg_id):
+            return make_event("ScanAvailableEvent",
+                              '<sca:ScanAvailableEvent><sca:ClientContext>ctx</sca:ClientContext>'
+                              '<sca:ScanIdentifier>scan-1</sca:ScanIdentifier>%s</sca:ScanAvailableEvent>'
+                              % padding, msg_id)
+
+        sniffer = wsd_common.SoapHeaderSniffer(event("urn:uuid:1"))
+        assert sniffer.scan_identifier == "scan-1"
+        assert sniffer.bytes_parsed < len(sniffer.message)
+        context = {"queues": wsd_scan__events.QueuesSet()}
+        wsd_scan__events.RequestHandler.dispatch_event(context, event("urn:uuid:1"))
+        # retransmitted with a new MessageID: dropped before the body is parsed
+        wsd_scan__events.RequestHandler.dispatch_event(context, event("urn:uuid:2"))
+        assert len(trees) == 1 and len(submitted) == 1
+
+    def test_scan_identifier_of_small_events(self):
+        sniffer = wsd_common.SoapHeaderSniffer(make_scan_available_event("urn:uuid:1", "scan-2"))
+        assert sniffer.scan_identifier == "scan-2"
+        assert wsd_common.SoapHeaderSniffer(STATUS_EVENT_BODY).scan_identifier is None
+
+    def test_unsubscribed_action_not_parsed(self, trees):
+        context = {"queues": wsd_scan__events.QueuesSet(), "actions": wsd_scan__events.DAEMON_ACTIONS}
+        wsd_scan__events.RequestHandler.dispatch_event(context, make_large_status_event("urn:uuid:1"))
+        assert trees == []
+        assert context["queues"].sc_cond_q.empty()
+        # rejected events do not fill the duplicate store
+        assert len(wsd_common.message_ids) == 0
+
+    def test_foreign_action_not_parsed(self, trees):
+        context = {"queues": wsd_scan__events.QueuesSet()}
+        event = make_event("Other", "<sca:Other/>", "urn:uuid:1") \
+            .replace(b"wdp/scan/Other", b"wdp/print/PrinterStatusSummaryEvent")
+        wsd_scan__events.RequestHandler.dispatch_event(context, event)
+        assert trees == []
+
+    def test_duplicate_not_parsed(self, trees):
+        context = {"queues": wsd_scan__events.QueuesSet()}
+        event = make_large_status_event("urn:uuid:1", conditions=3)
+        wsd_scan__events.RequestHandler.dispatch_event(context, event)
+        wsd_scan__events.RequestHandler.dispatch_event(context, event)
+        assert len(trees) == 1
+        assert context["queues"].sc_cond_q.qsize() == 1
+
+
+# --- Safe per-thread XML parsers ---
+
+def load_fixture_bytes(name):
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as f:
+        return f.read()
+
+
+class TestXmlParsers:
+    """Verify inbound messages are parsed with per-thread parsers and bounded input."""
+
+    @pytest.fixture
+    def parsers(self, monkeypatch):
+        parsers = wsd_common.XmlParsers(max_size=4096, max_depth=8)
+        monkeypatch.setattr(wsd_common, "xml_parsers", parsers)
+        return parsers
+
+    @staticmethod
+    def nested(depth):
+        return b"<a>" * depth + b"x" + b"</a>" * depth
+
+    def test_entities_not_expanded(self):
+        bomb = b'<?xml version="1.0"?><!DOCTYPE r [<!ENTITY a "aaaaaaaaaa">' \
+               b'<!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]><r>&b;</r>'
+        x = wsd_common.parse_xml(bomb)
+        assert "aaaa" not in (x.text or "")
+
+    def test_external_entities_not_loaded(self, tmp_path):
+        secret = tmp_path / "secret.txt"
+        secret.write_text("secret")
+        doc = b'<?xml version="1.0"?><!DOCTYPE r [<!ENTITY x SYSTEM "%s">]><r>&x;</r>' \
+              % secret.as_uri().encode()
+        x = wsd_common.parse_xml(doc)
+        assert "secret" not in (x.text or "")
+
+    def test_depth_limit(self, parsers):
+        assert wsd_common.parse_xml(self.nested(8)).tag == "a"
+        with pytest.raises(wsd_common.XmlLimitError):
+            wsd_common.parse_xml(self.nested(9))
+
+    def test_parser_reused_after_errors(self, parsers):
+        with pytest.raises(wsd_common.XmlLimitError):
+            wsd_common.parse_xml(self.nested(9))
+        with pytest.raises(Exception):
+            wsd_common.parse_xml(b"<a><b></a>")
+        assert wsd_common.parse_xml(self.nested(8)).tag == "a"
+        assert len(wsd_common.parse_xml(b"<r><s/><s/></r>")) == 2
+
+    def test_sniffed_header_depth_limit(self, parsers):
+        parsers.max_size = 1024 * 1024
+        header = "<wsa:To>%s</wsa:To>" % ("<a>" * 8 + "x" + "</a>" * 8)
+        event = make_large_status_event("urn:uuid:1", conditions=100) \
+            .replace(b"<soap:Header>", b"<soap:Header>" + header.encode())
+        with pytest.raises(wsd_common.XmlLimitError):
+            wsd_common.SoapHeaderSniffer(event)
+
+    def test_size_limit(self, parsers):
+        with pytest.raises(wsd_common.XmlLimitError):
+            wsd_common.parse_xml(b"<r>" + b"x" * 4096 + b"</r>")
+        with pytest.raises(wsd_common.XmlLimitError):
+            wsd_common.SoapHeaderSniffer(make_large_status_event("urn:uuid:1"))
+
+    def test_configure(self, parsers):
+        wsd_common.configure_xml_limits(max_depth=9)
+        assert wsd_common.parse_xml(self.nested(9)).tag == "a"
+        assert parsers.max_size == 4096
+
+    def test_one_parser_per_thread(self, parsers):
+        seen = []
+        barrier = threading.Barrier(4)
+
+        def work():
+            barrier.wait()
+            p = parsers.parser()
+            for _ in range(50):
+                assert wsd_common.parse_xml(load_fixture_bytes("create_scan_job_response.xml")) is not None
+            seen.append((p, parsers.parser()))
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        assert len(seen) == 4
+        assert all(first is again for first, again in seen)
+        assert len({id(first) for first, _ in seen}) == 4
+
+    def test_fixtures_parse_unchanged(self):
+        from lxml import etree
+        for name in ("get_scanner_elements_response.xml", "create_scan_job_response.xml"):
+            data = load_fixture_bytes(name)
+            assert etree.tostring(wsd_common.parse_xml(data)) == \
+                etree.tostring(etree.fromstring(data, parser=wsd_common.parser))
+
+    def test_listener_rejects_oversized_body(self, parsers):
+        import socket
+
+        class QuietHandler(wsd_scan__events.RequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+        server = wsd_scan__events.HTTPServerWithContext(("127.0.0.1", 0), QuietHandler,
+                                                        {"queues": wsd_scan__events.QueuesSet()})
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with socket.create_connection(("127.0.0.1", server.server_address[1]), timeout=5) as s:
+                s.sendall(b"POST /wsd HTTP/1.1\r\nContent-Length: 5000\r\n\r\n")
+                assert TestListenerKeepAlive.read_response(s).startswith(b"HTTP/1.1 413")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+# --- Spooled page retrieval ---
+
+def spool_page(folder, data, budget=None):
+    from wsd_scan import page_spool
+    spooler = page_spool.PageSpooler(str(folder), budget)
+    spooler.write(data)
+    return spooler.close("image/jpeg")
+
+
+class TestPageSpool:
+    """Verify pages spooled to disk are read lazily and charged to the byte budget."""
+
+    def test_budget_blocks_until_release(self, tmp_path):
+        from wsd_scan import page_spool
+        budget = page_spool.SpoolBudget(1000)
+        page = spool_page(tmp_path, b"x" * 1500, budget)
+        assert budget.used == 1500
+        assert not budget.wait(timeout=0.1)
+
+        started = threading.Event()
+        t = threading.Thread(target=lambda: (page_spool.PageSpooler(str(tmp_path), budget), started.set()),
+                             daemon=True)
+        t.start()
+        assert not started.wait(0.2)
+        page.release()
+        assert started.wait(5)
+        assert budget.used == 0
+        page.release()
+        assert budget.used == 0
+
+    def test_lazy_access(self, tmp_path):
+        data = make_test_jpeg()
+        page = spool_page(tmp_path, data)
+        assert page.size == len(data) and page.head(3) == b"\xff\xd8\xff"
+        mapped = page.mmap()
+        assert mapped[:] == data
+        mapped.close()
+        with page.open() as img:
+            assert img.size == (64, 48)
+        assert page.read() == data
+        page.release()
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_passthrough_moved(self, tmp_path):
+        from wsd_scan import page_spool
+        budget = page_spool.SpoolBudget(1 << 20)
+        data = make_test_jpeg()
+        page = spool_page(tmp_path, data, budget)
+        out = str(tmp_path / "page.jpeg")
+        assert wsd_scan__events.save_page(page, {"image_format": "jpeg", "quality": 20}, out) == out
+        assert os.listdir(str(tmp_path)) == ["page.jpeg"]
+        assert budget.used == 0
+
+    @pytest.mark.parametrize("image_format", ["jpeg", "png"])
+    def test_save_stage_releases_pages(self, tmp_path, image_format):
+        from wsd_scan import page_spool
+        budget = page_spool.SpoolBudget(1 << 20)
+        profile = {"image_format": image_format, "quality": 70, "target_folder": str(tmp_path),
+                   "resolution": 300}
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", pdf_file=str(tmp_path / "scan.pdf"))
+        for i in range(3):
+            stage.put(i, spool_page(tmp_path, make_test_jpeg(), budget))
+        stage.finish()
+        assert budget.used == 0
+        assert sorted(os.listdir(str(tmp_path))) == \
+            ["scan.pdf"] + ["scan_%d.%s" % (i, image_format) for i in range(3)]
+        assert check_pdf_xref(str(tmp_path / "scan.pdf")) == 3
+
+    def test_encoder_consumes_spool_file(self, tmp_path, encoder):
+        from wsd_scan import page_spool
+        budget = page_spool.SpoolBudget(1 << 20)
+        profile = {"image_format": "png", "quality": 90, "target_folder": str(tmp_path)}
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", encoder=encoder)
+        stage.put(0, spool_page(tmp_path, make_test_jpeg(), budget))
+        stage.finish()
+        assert os.listdir(str(tmp_path)) == ["scan_0.png"]
+        assert budget.used == 0
+
+    def test_encoder_gives_back_budget(self, tmp_path, encoder):
+        from wsd_scan import page_spool
+        # the budget only allows one page on disk: the next retrieval waits for the encoder
+        budget = page_spool.SpoolBudget(1)
+        profile = {"image_format": "png", "quality": 90, "target_folder": str(tmp_path)}
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", encoder=encoder)
+
+        def retrieve():
+            for i in range(3):
+                stage.put(i, spool_page(tmp_path, make_test_jpeg(), budget))
+            stage.finish()
+
+        t = threading.Thread(target=retrieve, daemon=True)
+        t.start()
+        t.join(60)
+        assert not t.is_alive()
+        assert sorted(os.listdir(str(tmp_path))) == ["scan_%d.png" % i for i in range(3)]
+        assert budget.used == 0
+
+    def test_retrieve_to_file(self, tmp_path, monkeypatch):
+        from wsd_scan import page_spool
+        image = TestMultipartStreamParser.IMAGE
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RetrieveImageHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        monkeypatch.setattr(_RetrieveImageHandler, "body", make_mtom_body(image))
+        monkeypatch.setattr(_RetrieveImageHandler, "content_type", MTOM_CONTENT_TYPE)
+        budget = page_spool.SpoolBudget(1 << 20)
+        try:
+            host = make_test_host("http://127.0.0.1:%d/wsd/scan" % server.server_address[1])
+            page = wsd_scan__operations.wsd_retrieve_image_to_file(host, TestRetrieveImage.make_job(), "doc",
+                                                                  str(tmp_path), budget)
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert page.content_type == "image/jpeg"
+        assert page.read() == image
+        assert budget.used == len(image)
+        page.release()
+        assert budget.used == 0 and os.listdir(str(tmp_path)) == []
+
+
+# --- Raw raster path for uncompressed TIFF pages ---
+
+def make_raw_tiff(mode, size=(53, 37), **params):
+    import numpy
+    from PIL import Image
+    rng = numpy.random.default_rng(0)
+    w, h = size
+    pixels = rng.integers(0, 256, (h, w, 3) if mode == "RGB" else (h, w), dtype=numpy.uint8)
+    img = Image.fromarray(pixels, "RGB" if mode == "RGB" else "L")
+    if mode == "1":
+        img = img.convert("1")
+    buf = io.BytesIO()
+    img.save(buf, format="TIFF", compression="raw", dpi=(200, 200), **params)
+    return buf.getvalue()
+
+
+class TestRasterPath:
+    """Verify uncompressed TIFF pages are read in place and converted like PIL does."""
+
+    @pytest.fixture(autouse=True)
+    def numpy(self):
+        return pytest.importorskip("numpy")
+
+    @staticmethod
+    def geometry(data):
+        from wsd_scan import raster
+        info = raster.parse_tiff_header(data)
+        return info.width, info.height, info.row_bytes
+
+    @pytest.mark.parametrize("mode", ["1", "L", "RGB"])
+    @pytest.mark.parametrize("params", [{}, {"tiffinfo": {278: 5}}])
+    def test_pixels_match_pil(self, mode, params):
+        from PIL import Image
+        from wsd_scan import raster
+        data = make_raw_tiff(mode, **params)
+        r = raster.decode_tiff_raster(data, *self.geometry(data))
+        reference = Image.open(io.BytesIO(data))
+        assert r.mode == mode and r.dpi == (200, 200)
+        assert r.to_image().tobytes() == reference.tobytes()
+        for target in ("1", "L", "RGB"):
+            expected = reference.convert(target, dither=Image.Dither.NONE)
+            assert raster.convert(r, target).to_image().tobytes() == expected.tobytes()
+
+    def test_contiguous_strips_not_copied(self, numpy):
+        from wsd_scan import raster
+        data = make_raw_tiff("L")
+        r = raster.decode_tiff_raster(data)
+        assert numpy.shares_memory(r.pixels, numpy.frombuffer(data, numpy.uint8))
+
+    def test_white_is_zero(self):
+        from PIL import Image
+        from wsd_scan import raster
+        data = make_raw_tiff("L", tiffinfo={262: 0})
+        expected = Image.open(io.BytesIO(data)).convert("L")
+        assert raster.decode_tiff_raster(data).to_image().tobytes() == expected.tobytes()
+
+    @pytest.mark.parametrize("geometry", [(54, 37, 54), (53, 38, 53), (53, 37, 56)])
+    def test_geometry_mismatch(self, geometry):
+        from wsd_scan import raster
+        with pytest.raises(ValueError):
+            raster.decode_tiff_raster(make_raw_tiff("L"), *geometry)
+
+    def test_unknown_length_not_checked(self):
+        from wsd_scan import raster
+        assert raster.decode_tiff_raster(make_raw_tiff("L"), 53, 0, 53).height == 37
+
+    def test_truncated_strips(self):
+        from wsd_scan import raster
+        with pytest.raises(ValueError):
+            raster.decode_tiff_raster(make_raw_tiff("L")[:-10])
+
+    @pytest.mark.parametrize("color,image_format,saved_mode", [
+        ("BlackAndWhite1", "png", "1"),
+        ("BlackAndWhite1", "jpeg", "L"),
+        ("Grayscale8", "jpeg", "L"),
+        ("RGB24", "png", "RGB"),
+    ])
+    def test_save_page(self, tmp_path, monkeypatch, color, image_format, saved_mode):
+        from PIL import Image
+        monkeypatch.setattr(Image, "open", pytest.fail)
+        data = make_raw_tiff("RGB")
+        profile = {"image_format": image_format, "quality": 90, "color": color}
+        out = str(tmp_path / ("page." + image_format))
+        assert wsd_scan__events.save_page(data, profile, out, self.geometry(data)) == out
+        monkeypatch.undo()
+        with Image.open(out) as img:
+            assert img.mode == saved_mode and img.size == (53, 37)
+
+    def test_spooled_page_mapped(self, tmp_path):
+        from PIL import Image
+        data = make_raw_tiff("L")
+        page = spool_page(tmp_path, data)
+        out = str(tmp_path / "page.png")
+        profile = {"image_format": "png", "quality": 90, "color": "Grayscale8"}
+        wsd_scan__events.save_page(page, profile, out, self.geometry(data))
+        assert os.listdir(str(tmp_path)) == ["page.png"]
+        assert Image.open(out).tobytes() == Image.open(io.BytesIO(data)).tobytes()
+
+    def test_mismatch_falls_back_to_pil(self, tmp_path):
+        from PIL import Image
+        data = make_raw_tiff("L")
+        out = str(tmp_path / "page.png")
+        profile = {"image_format": "png", "quality": 90, "color": "Grayscale8"}
+        wsd_scan__events.save_page(data, profile, out, (100, 37, 100))
+        assert Image.open(out).tobytes() == Image.open(io.BytesIO(data)).tobytes()
+
+    def test_spooled_page_save_error(self, tmp_path):
+        data = make_raw_tiff("RGB")
+        page = spool_page(tmp_path, data)
+        out = str(tmp_path / "missing" / "page.png")
+        # the error of the save, not the one of the memory map still viewed by the traceback
+        with pytest.raises(FileNotFoundError):
+            wsd_scan__events.save_page(page, {"image_format": "png", "quality": 90}, out, self.geometry(data))
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_spooled_page_falls_back_to_pil(self, tmp_path):
+        from PIL import Image
+        data = make_raw_tiff("L")
+        page = spool_page(tmp_path, data)
+        out = str(tmp_path / "page.png")
+        wsd_scan__events.save_page(page, {"image_format": "png", "quality": 90}, out, (100, 37, 100))
+        assert Image.open(out).tobytes() == Image.open(io.BytesIO(data)).tobytes()
+
+    def test_spooled_page_measure_error(self, tmp_path, monkeypatch, caplog):
+        from wsd_scan import raster
+
+        def fail(*args):
+            raise RuntimeError("cannot measure")
+
+        monkeypatch.setattr(raster, "ink_coverage", fail)
+        page = spool_page(tmp_path, make_raw_tiff("L"))
+        assert wsd_scan__events.blank_page_coverage(page, {"skip_blank_pages": True}) is None
+        assert "cannot measure" in caplog.text and "exported pointers" not in caplog.text
+        page.release()
+
+
+# --- Blank page detection ---
+
+def make_page_image(mode="L", size=(620, 877), lines=0, noise=0, shadow=False):
+    import numpy
+    from PIL import Image
+    w, h = size
+    pixels = numpy.full((h, w), 250, dtype=numpy.uint8)
+    rng = numpy.random.default_rng(1)
+    if noise:
+        # isolated dark specks, like dust on the glass
+        pixels.flat[rng.choice(w * h, noise, replace=False)] = 30
+    for i in range(lines):
+        y = h // 5 + i * 14
+        pixels[y:y + 4, w // 8:w - w // 8] = 20
+    if shadow:
+        pixels[:, :w // 40] = 40
+        pixels[:h // 40, :] = 40
+    return Image.fromarray(pixels, "L").convert(mode, dither=Image.Dither.NONE)
+
+
+def encode_page(img, image_format, **params):
+    buf = io.BytesIO()
+    img.save(buf, format=image_format, **params)
+    return buf.getvalue()
+
+
+class TestBlankPages:
+    """Verify near-blank pages are recognized on a downsampled view and dropped."""
+
+    PROFILE = {"skip_blank_pages": True, "image_format": "jpeg"}
+
+    @pytest.fixture(autouse=True)
+    def numpy(self):
+        return pytest.importorskip("numpy")
+
+    @pytest.mark.parametrize("mode,image_format,params", [
+        ("L", "jpeg", {"quality": 80}),
+        ("RGB", "jpeg", {"quality": 80}),
+        ("L", "tiff", {"compression": "raw"}),
+        ("RGB", "tiff", {"compression": "raw"}),
+        ("1", "tiff", {"compression": "raw"}),
+        ("L", "png", {}),
+    ])
+    def test_blank_and_written_pages(self, mode, image_format, params):
+        blank = encode_page(make_page_image(mode, noise=100, shadow=True), image_format, **params)
+        written = encode_page(make_page_image(mode, lines=3), image_format, **params)
+        assert wsd_scan__events.blank_page_coverage(blank, self.PROFILE) is not None
+        assert wsd_scan__events.blank_page_coverage(written, self.PROFILE) is None
+
+    def test_thumbnail_is_downsampled(self):
+        from wsd_scan import raster
+        jpeg = encode_page(make_page_image(), "jpeg")
+        tiff = encode_page(make_page_image(), "tiff", compression="raw")
+        # PIL rounds the size up, the in-place reduction drops the incomplete blocks
+        assert raster.gray_thumbnail(jpeg, 8).shape == (110, 78)
+        assert raster.gray_thumbnail(tiff, 8).shape == (109, 77)
+
+    def test_threshold_from_profile(self):
+        written = encode_page(make_page_image(lines=1), "jpeg")
+        assert wsd_scan__events.blank_page_coverage(written, self.PROFILE) is None
+        profile = dict(self.PROFILE, blank_page_threshold=5)
+        coverage = wsd_scan__events.blank_page_coverage(written, profile)
+        assert 0 < coverage < 0.05
+
+    def test_disabled_by_default(self):
+        blank = encode_page(make_page_image(), "jpeg")
+        assert wsd_scan__events.blank_page_coverage(blank, {"image_format": "jpeg"}) is None
+
+    def test_spooled_page(self, tmp_path):
+        page = spool_page(tmp_path, encode_page(make_page_image(), "tiff", compression="raw"))
+        assert wsd_scan__events.blank_page_coverage(page, self.PROFILE) == 0
+        page.release()
+
+    def test_worker_drops_blank_pages(self, tmp_path, monkeypatch):
+        pages = [encode_page(make_page_image(lines=3), "jpeg"),
+                 encode_page(make_page_image(noise=50), "jpeg"),
+                 encode_page(make_page_image(lines=5), "jpeg"),
+                 None]
+        profile = dict(self.PROFILE, quality=80, target_folder=str(tmp_path), use_pdf=False, send_email=False)
+        ticket = make_test_ticket()
+        ticket.doc_params.input_src = "ADF"
+        monkeypatch.setitem(wsd_scan__events.host_map, "ctx", make_test_host())
+        monkeypatch.setitem(wsd_scan__events.token_map, "ctx", "token")
+        monkeypatch.setitem(wsd_scan__events.profile_map, "ctx", profile)
+        monkeypatch.setattr(wsd_scan__events.request_cache, "get", lambda *args: (ticket, None))
+        monkeypatch.setattr(wsd_scan__operations, "wsd_create_scan_job",
+                            lambda *args, **kwargs: wsd_scan__structures.ScanJob())
+        monkeypatch.setattr(wsd_scan__events, "retrieve_page", lambda *args: pages.pop(0))
+        wsd_scan__events.device_initiated_scan_worker("ctx", "scan-id", "scan")
+        assert sorted(os.listdir(str(tmp_path))) == ["scan_0.jpeg", "scan_1.jpeg"]
+
+    def test_pages_measured_by_save_thread(self, tmp_path, monkeypatch):
+        threads = []
+        measure = wsd_scan__events.blank_page_coverage
+
+        def recording_coverage(data, profile):
+            threads.append(threading.current_thread())
+            return measure(data, profile)
+
+        monkeypatch.setattr(wsd_scan__events, "blank_page_coverage", recording_coverage)
+        profile = dict(self.PROFILE, quality=80, target_folder=str(tmp_path))
+        stage = wsd_scan__events.PageSaveStage(profile, "scan")
+        for i, page in enumerate([make_page_image(noise=50), make_page_image(lines=3)]):
+            stage.put(i, encode_page(page, "jpeg"))
+        stage.finish()
+        assert len(threads) == 2 and threading.current_thread() not in threads
+        assert stage.blank_pages == 1
+        assert stage.picture_files == ["%s/scan_0.jpeg" % tmp_path]
+
+
+# --- Color reduction ---
+
+def make_color_page(kind):
+    import numpy
+    from PIL import Image, ImageDraw
+    if kind == "photo":
+        ramp = numpy.tile(numpy.linspace(0, 255, 620, dtype=numpy.uint8), (877, 1))
+        return Image.fromarray(ramp, "L").convert("RGB")
+    img = make_page_image("RGB", lines=20)
+    if kind == "logo":
+        ImageDraw.Draw(img).rectangle((40, 40, 120, 90), fill=(200, 30, 30))
+    elif kind == "signature":
+        ImageDraw.Draw(img).line((100, 700, 400, 720), fill=(20, 40, 170), width=3)
+    elif kind == "tinted":
+        img = Image.fromarray((numpy.asarray(img) * numpy.array([1, 1, 0.85])).astype(numpy.uint8))
+    return img
+
+
+class TestColorReduction:
+    """Verify color pages without color are stored in grayscale or bilevel, the ticket being left as is."""
+
+    PROFILE = {"reduce_color": True, "color": "RGB24", "image_format": "png", "quality": 90}
+
+    @pytest.fixture(autouse=True)
+    def numpy(self):
+        return pytest.importorskip("numpy")
+
+    @pytest.mark.parametrize("kind,mode", [
+        ("text", "1"),
+        ("tinted", "1"),
+        ("photo", "L"),
+        ("logo", "RGB"),
+        ("signature", "RGB"),
+    ])
+    @pytest.mark.parametrize("image_format,params", [
+        ("jpeg", {"quality": 75}),
+        ("tiff", {"compression": "raw"}),
+    ])
+    def test_mode_chosen(self, kind, mode, image_format, params):
+        data = encode_page(make_color_page(kind), image_format, **params)
+        assert wsd_scan__events.color_reduction(data, self.PROFILE).mode == mode
+
+    @pytest.mark.parametrize("mode", ["1", "L", "RGB"])
+    def test_raw_tiff_sampled_in_place(self, mode):
+        from wsd_scan import raster
+        img = make_page_image(mode, lines=3)
+        in_place = raster.sample_pixels(encode_page(img, "tiff", compression="raw"))
+        decoded = raster.sample_pixels(encode_page(img, "png"))
+        assert in_place.shape == decoded.shape
+        assert (in_place == decoded).all()
+
+    def test_only_for_color_profiles(self):
+        data = encode_page(make_color_page("text"), "jpeg")
+        assert wsd_scan__events.color_reduction(data, dict(self.PROFILE, reduce_color=False)) is None
+        assert wsd_scan__events.color_reduction(data, dict(self.PROFILE, color="Grayscale8")) is None
+
+    @pytest.mark.parametrize("image_format,stored", [("png", "1"), ("jpeg", "L"), ("tiff", "1")])
+    @pytest.mark.parametrize("source", ["jpeg", "tiff"])
+    def test_stage_records_saving(self, tmp_path, image_format, stored, source):
+        from PIL import Image
+        data = encode_page(make_color_page("text"), source, **({"compression": "raw"} if source == "tiff" else {}))
+        profile = dict(self.PROFILE, image_format=image_format, target_folder=str(tmp_path))
+        stage = wsd_scan__events.PageSaveStage(profile, "scan")
+        stage.put(0, data, (0, 0, 0))
+        stage.finish()
+        saved, = stage.saved_pages
+        assert saved.color.mode == "1"
+        assert saved.received_bytes == len(data)
+        assert saved.saved_bytes == os.path.getsize(saved.picture_file)
+        if source == "tiff":
+            # measured against the received file: a small JPEG can grow as an uncompressed TIFF
+            assert saved.saving > 0.5
+        with Image.open(saved.picture_file) as img:
+            assert img.mode == stored
+
+    def test_spooled_page_converted_by_encoder(self, tmp_path):
+        from PIL import Image
+        from wsd_scan import image_encoder
+        page = spool_page(tmp_path, encode_page(make_color_page("photo"), "jpeg"))
+        choice = wsd_scan__events.color_reduction(page, self.PROFILE)
+        out = str(tmp_path / "page.png")
+        image_encoder.encode_file(page.path, out, self.PROFILE, choice.mode)
+        page.release()
+        with Image.open(out) as img:
+            assert img.mode == "L"
+
+    def test_spooled_page_read_from_its_file(self, tmp_path, monkeypatch):
+        from wsd_scan import raster
+        data = encode_page(make_color_page("photo"), "jpeg")
+        expected = wsd_scan__events.color_reduction(data, self.PROFILE)
+        page = spool_page(tmp_path, data)
+
+        def no_copy(data):
+            raise AssertionError("the page was copied into memory")
+
+        monkeypatch.setattr(raster, "BytesIO", no_copy)
+        try:
+            assert wsd_scan__events.color_reduction(page, self.PROFILE).mode == expected.mode == "L"
+            assert wsd_scan__events.blank_page_coverage(page, dict(self.PROFILE, skip_blank_pages=True)) is None
+        finally:
+            page.release()
+
+    def test_worker_leaves_ticket_in_color(self, tmp_path, monkeypatch):
+        from PIL import Image
+        pages = [encode_page(make_color_page("text"), "jpeg"),
+                 encode_page(make_color_page("logo"), "jpeg"),
+                 None]
+        profile = dict(self.PROFILE, image_format="jpeg", target_folder=str(tmp_path),
+                       use_pdf=False, send_email=False)
+        ticket = make_test_ticket()
+        ticket.doc_params.front.color = "RGB24"
+        ticket.doc_params.input_src = "ADF"
+        tickets = []
+
+        def fake_create_scan_job(host, std_ticket, *args, **kwargs):
+            tickets.append(std_ticket.doc_params.front.color)
+            return wsd_scan__structures.ScanJob()
+
+        monkeypatch.setitem(wsd_scan__events.host_map, "ctx", make_test_host())
+        monkeypatch.setitem(wsd_scan__events.token_map, "ctx", "token")
+        monkeypatch.setitem(wsd_scan__events.profile_map, "ctx", profile)
+        monkeypatch.setattr(wsd_scan__events.request_cache, "get", lambda *args: (ticket, None))
+        monkeypatch.setattr(wsd_scan__operations, "wsd_create_scan_job", fake_create_scan_job)
+        monkeypatch.setattr(wsd_scan__events, "retrieve_page", lambda *args: pages.pop(0))
+        wsd_scan__events.device_initiated_scan_worker("ctx", "scan-id", "scan")
+        assert tickets == ["RGB24"] * 3
+        with Image.open(str(tmp_path / "scan_0.jpeg")) as img:
+            assert img.mode == "L"
+        with Image.open(str(tmp_path / "scan_1.jpeg")) as img:
+            assert img.mode == "RGB"
+
+
+# --- Output codecs ---
+
+def make_photo_page(size=(620, 877)):
+    import numpy
+    from PIL import Image
+    rng = numpy.random.default_rng(2)
+    w, h = size
+    pixels = rng.integers(0, 256, (h // 8, w // 8, 3), dtype=numpy.uint8)
+    return Image.fromarray(pixels, "RGB").resize(size, Image.Resampling.BICUBIC)
+
+
+class TestPageCodecs:
+    """Verify the codec chosen per color mode, the size targets, and the PDF embedding without re-encoding."""
+
+    PROFILE = {"codec": "auto", "image_format": "jpeg", "quality": 90}
+
+    @pytest.fixture(autouse=True)
+    def numpy(self):
+        return pytest.importorskip("numpy")
+
+    @pytest.mark.parametrize("mode,image_format", [("1", "tiff"), ("L", "png"), ("RGB", "jpeg")])
+    def test_codec_per_mode(self, mode, image_format):
+        from wsd_scan import page_codecs
+        profile = page_codecs.page_profile(self.PROFILE, mode)
+        assert profile["image_format"] == image_format
+        assert self.PROFILE["image_format"] == "jpeg"
+
+    def test_no_codec_by_default(self):
+        from wsd_scan import page_codecs
+        profile = {"image_format": "png", "quality": 90}
+        assert page_codecs.page_profile(profile, "1") is profile
+        jpeg = page_codecs.page_profile(dict(profile, image_format="jpeg", max_page_bytes=1000), "L")
+        assert jpeg["page_codec"] == "jpeg"
+
+    def test_g4_for_bilevel_pages(self):
+        from wsd_scan import page_codecs
+        img = make_page_image("1", lines=10)
+        g4 = page_codecs.CODECS["g4"].encode(img)
+        assert len(g4) * 20 < len(encode_page(img, "tiff", compression="raw"))
+        assert len(g4) * 5 < len(encode_page(img, "jpeg", quality=90))
+
+    def test_quality_lowered_to_fit(self):
+        from wsd_scan import page_codecs
+        codec = page_codecs.CODECS["jpeg"]
+        img = make_photo_page()
+        target = len(codec.encode(img, 90)) // 2
+        data, quality = codec.fit(img, 90, target)
+        assert len(data) <= target
+        assert page_codecs.MIN_QUALITY <= quality < 90
+        # the highest quality that fits
+        assert len(codec.encode(img, quality + 1)) > target
+
+    def test_unreachable_target(self, tmp_path, caplog):
+        from wsd_scan import page_codecs
+        path = str(tmp_path / "page.jpeg")
+        profile = dict(page_codecs.page_profile(self.PROFILE, "RGB"), max_page_bytes=100)
+        page_codecs.save(make_photo_page(), path, profile)
+        assert os.path.getsize(path) > 100
+        assert "does not fit in 100 bytes" in caplog.text
+
+    def test_oversized_jpeg_not_passed_through(self):
+        data = make_test_jpeg()
+        profile = {"image_format": "jpeg"}
+        assert wsd_scan__events.is_passthrough_page(data, profile)
+        assert wsd_scan__events.is_passthrough_page(data, dict(profile, max_page_bytes=len(data)))
+        assert not wsd_scan__events.is_passthrough_page(data, dict(profile, max_page_bytes=len(data) - 1))
+
+    @pytest.mark.parametrize("codec,mode,pdf_filter", [
+        ("g4", "1", b"/CCITTFaxDecode"),
+        ("png", "1", b"/FlateDecode"),
+        ("png", "L", b"/FlateDecode"),
+        ("png", "RGB", b"/FlateDecode"),
+    ])
+    def test_embedded_in_pdf_as_is(self, tmp_path, codec, mode, pdf_filter):
+        import numpy
+        from wsd_scan import page_codecs, pdf_writer, raster
+        pikepdf = pytest.importorskip("pikepdf")
+        img = make_page_image(mode, lines=5, noise=100)
+        data = page_codecs.CODECS[codec].encode(img, dpi=(200, 200))
+        path = str(tmp_path / "out.pdf")
+        with pdf_writer.StreamingPdfWriter(path) as pdf:
+            pdf.add_page(data)
+        raw = open(path, "rb").read()
+        if codec == "g4":
+            info = raster.parse_tiff_header(data)
+            stream = data[info.strip_offsets[0]:info.strip_offsets[0] + info.strip_byte_counts[0]]
+        else:
+            stream = pdf_writer.parse_png(data).idat
+        assert stream in raw and pdf_filter in raw
+        assert b"/MediaBox [0 0 223.2" in raw
+        with pikepdf.open(path) as doc:
+            decoded = pikepdf.PdfImage(doc.pages[0].Resources.XObject["/Im0"]).as_pil_image()
+        assert (numpy.asarray(decoded.convert("L")) == numpy.asarray(img.convert("L"))).all()
+
+    def test_multi_strip_g4_decoded(self, tmp_path):
+        from wsd_scan import pdf_writer
+        img = make_page_image("1", lines=5)
+        data = encode_page(img, "tiff", compression="group4")
+        path = str(tmp_path / "out.pdf")
+        with pdf_writer.StreamingPdfWriter(path) as pdf:
+            pdf.add_page(data)
+        raw = open(path, "rb").read()
+        assert b"/CCITTFaxDecode" not in raw and b"/FlateDecode" in raw
+
+    def test_stage_names_files_after_codec(self, tmp_path):
+        from PIL import Image
+        pdf_file = str(tmp_path / "scan.pdf")
+        profile = dict(self.PROFILE, color="BlackAndWhite1", target_folder=str(tmp_path), resolution=300)
+        stage = wsd_scan__events.PageSaveStage(profile, "scan", pdf_file=pdf_file)
+        stage.put(0, encode_page(make_page_image("L", lines=5), "png"))
+        stage.put(1, encode_page(make_page_image("1", lines=5), "tiff", compression="raw"), (0, 0, 0))
+        stage.finish()
+        assert stage.picture_files == [str(tmp_path / "scan_0.tiff"), str(tmp_path / "scan_1.tiff")]
+        for picture_file in stage.picture_files:
+            with Image.open(picture_file) as img:
+                assert img.mode == "1" and img.info["compression"] == "group4"
+        assert open(pdf_file, "rb").read().count(b"/CCITTFaxDecode") == 2
@@ -7,10 +7,14 @@ import time
 
 import yaml
 
+from . import image_encoder
+from . import page_spool
 from . import wsd_common
 from . import wsd_discovery__operations
 from . import wsd_globals
+from . import wsd_scan__async_events
 from . import wsd_scan__events
+from . import wsd_scan__operations
 from . import wsd_transfer__operations
 from . import wsd_discovery__parsers
 from . import wsd_eventing__operations
@@ -58,6 +62,17 @@ def start(args):
 
     port = args.port
 
+    wsd_common.configure_session_pool(args.pool_size, args.pool_idle_timeout)
+    wsd_common.configure_message_ids(args.dedup_capacity, args.dedup_ttl)
+    wsd_common.configure_xml_limits(args.max_message_size, args.max_xml_depth)
+    wsd_scan__operations.scanner_elements_cache.ttl = args.elements_ttl
+    wsd_scan__events.pipeline_depth = args.pipeline_depth
+    wsd_scan__events.scan_scheduler.configure(args.max_scan_jobs, args.device_scan_jobs)
+    if args.encoder_workers:
+        wsd_scan__events.page_encoder = image_encoder.ProcessPoolEncoder(args.encoder_workers)
+    if args.spool_budget:
+        wsd_scan__events.spool_budget = page_spool.SpoolBudget(args.spool_budget * 1024 * 1024)
+
     if args.auto:
         scanners = wsd_discovery__operations.auto_discover_scanners(timeout=5)
         if not scanners:
@@ -100,7 +115,11 @@ def start(args):
     logger.info("Loaded %d profile(s).", len(wsd_globals.scan_profiles))
 
     logger.info("Starting HTTP listener on port %d...", port)
-    start_server_thread(port)
+    if args.async_listener:
+        start_async_server_thread(port, args.read_timeout, args.keepalive_timeout, args.keepalive_requests)
+    else:
+        start_server_thread(port, args.listener_workers, args.max_in_flight, args.read_timeout,
+                            args.keepalive_timeout, args.keepalive_requests)
 
     for hosted_service in hosted_services:
         if "wscn:ScannerServiceType" in hosted_service.types:
@@ -115,6 +134,13 @@ def start(args):
                         wsd_eventing__operations.wsd_unsubscribe(hosted_service, sub_id)
                     except Exception:
                         pass
+                for endpoint, st in wsd_common.session_pool.stats().items():
+                    logger.info("HTTP connections to %s: %d requests, %d reused",
+                                endpoint, st.requests, st.reused)
+                logger.info("Scan jobs:\n%s", wsd_scan__events.scan_scheduler.stats())
+                logger.info("Duplicate messages dropped: %d", wsd_common.message_ids.duplicates)
+                if wsd_scan__events.page_encoder is not None:
+                    wsd_scan__events.page_encoder.close()
                 logger.info("Done. Exiting.")
                 os._exit(0)
 
@@ -140,6 +166,13 @@ def start(args):
                     wsd_scan__events.token_map[client_context] = dest_token
                     wsd_scan__events.host_map[client_context] = hosted_service
 
+            # Cache the scanner elements, then pre-render the CreateScanJob request of every profile
+            try:
+                wsd_scan__operations.scanner_elements_cache.get(hosted_service)
+            except Exception as e:
+                logger.warning("GetScannerElements failed: %s", e)
+            build_scan_requests(hosted_service, list(wsd_scan__events.profile_map.keys()))
+
             # Subscribe once, then keep the process alive.
             # Subscriptions last 1 hour (PT1H). TODO: use WS-Eventing Renew
             # before expiry instead of re-subscribing from scratch.
@@ -158,27 +191,64 @@ def start(args):
                         logger.info("Profiles changed, reloading...")
                         new_profiles = read_profiles_from_yaml()
                         wsd_globals.scan_profiles = new_profiles
+                        updated = []
                         for p in new_profiles:
                             ctx = p["id"]
                             if ctx in wsd_scan__events.profile_map:
                                 wsd_scan__events.profile_map[ctx] = p
+                                wsd_scan__events.request_cache.invalidate(ctx)
+                                updated.append(ctx)
                                 logger.info("Updated profile: %s", ctx)
+                        build_scan_requests(hosted_service, updated)
                         logger.info("Profile reload complete (%d profiles).", len(new_profiles))
                 except Exception as e:
                     logger.debug("Profile reload check failed: %s", e)
 
 
-def start_server_thread(port=DEFAULT_PORT):
-    t = threading.Thread(target=start_server, args=(port,))
+def build_scan_requests(hosted_service, client_contexts):
+    """
+    Pre-render the CreateScanJob requests of the specified profiles, so that a scan
+    started from the panel doesn't have to build them. Profiles that fail are built
+    again on demand, when a scan is requested.
+    """
+    for ctx in client_contexts:
+        try:
+            wsd_scan__events.request_cache.build(ctx, hosted_service, wsd_scan__events.profile_map[ctx])
+        except Exception as e:
+            logger.warning("Could not pre-render scan requests for %s: %s", ctx, e)
+
+
+def start_server_thread(port=DEFAULT_PORT, workers=8, max_in_flight=32, read_timeout=10.0,
+                        keepalive_timeout=5.0, keepalive_requests=100):
+    t = threading.Thread(target=start_server, args=(port, workers, max_in_flight, read_timeout,
+                                                    keepalive_timeout, keepalive_requests))
     t.start()
 
 
-def start_server(port=DEFAULT_PORT):
-    context = {"queues": wsd_scan__events.QueuesSet()}
-    server = wsd_scan__events.HTTPServerWithContext(('', port), wsd_scan__events.RequestHandler, context)
+def start_server(port=DEFAULT_PORT, workers=8, max_in_flight=32, read_timeout=10.0,
+                 keepalive_timeout=5.0, keepalive_requests=100):
+    context = {"queues": wsd_scan__events.QueuesSet(),
+               "actions": wsd_scan__events.DAEMON_ACTIONS}
+    server = wsd_scan__events.HTTPServerWithContext(('', port), wsd_scan__events.RequestHandler, context,
+                                                    workers=workers,
+                                                    max_in_flight=max_in_flight,
+                                                    read_timeout=read_timeout,
+                                                    keepalive_timeout=keepalive_timeout,
+                                                    keepalive_requests=keepalive_requests)
     server.serve_forever()
 
 
+def start_async_server_thread(port=DEFAULT_PORT, read_timeout=10.0, keepalive_timeout=5.0, keepalive_requests=100):
+    context = {"queues": wsd_scan__events.QueuesSet(),
+               "actions": wsd_scan__events.DAEMON_ACTIONS}
+    listener = wsd_scan__async_events.AsyncEventListener(('', port), context,
+                                                         read_timeout=read_timeout,
+                                                         keepalive_timeout=keepalive_timeout,
+                                                         keepalive_requests=keepalive_requests)
+    t = threading.Thread(target=listener.serve_forever)
+    t.start()
+
+
 def list_devices(args):
     logger.info("Scanning for WSD devices on the network (timeout %ds)...", args.timeout)
     scanners = wsd_discovery__operations.auto_discover_scanners(timeout=args.timeout)
@@ -270,6 +340,46 @@ def main():
                               help="HTTP listener port (default: %d)" % DEFAULT_PORT)
     start_parser.add_argument('--auto', action="store_true", default=False,
                               help="Auto-discover WSD scanners via UDP multicast (no -t needed)")
+    start_parser.add_argument('--pool-size', action="store", type=int, default=4,
+                              help="Keep-alive connections kept open per device (default: 4)")
+    start_parser.add_argument('--pool-idle-timeout', action="store", type=float, default=60.0,
+                              help="Seconds before an idle device connection is closed (default: 60)")
+    start_parser.add_argument('--dedup-capacity', action="store", type=int, default=256,
+                              help="Message ids remembered to drop retransmitted messages (default: 256)")
+    start_parser.add_argument('--dedup-ttl', action="store", type=float, default=600.0,
+                              help="Seconds a message id is remembered (default: 600)")
+    start_parser.add_argument('--elements-ttl', action="store", type=float, default=None,
+                              help="Seconds before cached scanner elements are fetched again "
+                                   "(default: only on ScannerElementsChangeEvent)")
+    start_parser.add_argument('--max-scan-jobs', action="store", type=int, default=4,
+                              help="Scan jobs running at once, for all the devices (default: 4)")
+    start_parser.add_argument('--device-scan-jobs', action="store", type=int, default=1,
+                              help="Scan jobs running at once on the same device (default: 1)")
+    start_parser.add_argument('--pipeline-depth', action="store", type=int, default=2,
+                              help="Retrieved pages that can wait to be saved, per scan job (default: 2)")
+    start_parser.add_argument('--async-listener', action="store_true", default=False,
+                              help="Receive event notifications with an asyncio listener instead of worker threads")
+    start_parser.add_argument('--listener-workers', action="store", type=int, default=8,
+                              help="Threads handling event notifications concurrently (default: 8)")
+    start_parser.add_argument('--max-in-flight', action="store", type=int, default=32,
+                              help="Notifications handled or waiting at once, more are rejected (default: 32)")
+    start_parser.add_argument('--read-timeout', action="store", type=float, default=10.0,
+                              help="Seconds a device connection may stay silent before being dropped (default: 10)")
+    start_parser.add_argument('--keepalive-timeout', action="store", type=float, default=5.0,
+                              help="Seconds an idle device connection is kept open for the next notification "
+                                   "(default: 5)")
+    start_parser.add_argument('--keepalive-requests', action="store", type=int, default=100,
+                              help="Notifications received on a connection before closing it, "
+                                   "1 disables keep-alive (default: 100)")
+    start_parser.add_argument('--encoder-workers', action="store", type=int, default=0,
+                              help="Encode pages in a pool of N processes (default: 0, encode in the scan thread)")
+    start_parser.add_argument('--spool-budget', action="store", type=int, default=0,
+                              help="Spool retrieved pages to disk, with at most N MiB waiting to be saved "
+                                   "for all the scans (default: 0, keep pages in memory)")
+    start_parser.add_argument('--max-message-size', action="store", type=int, default=1024 * 1024,
+                              help="Largest SOAP message accepted from a device, in bytes (default: 1048576)")
+    start_parser.add_argument('--max-xml-depth', action="store", type=int, default=32,
+                              help="Deepest element nesting accepted in a SOAP message (default: 32)")
     start_parser.add_argument('-d', '--debug', action="store_true", default=False,
                               help="Enable debug output (SOAP exchanges)")
     start_parser.set_defaults(func=start)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import logging
+import threading
+import time
+import typing
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+
+logger = logging.getLogger("wsd_scan")
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.evictions = 0
+
+    @property
+    def reused(self):
+        return max(self.requests - self.connections, 0)
+
+    def __str__(self):
+        s = ""
+        s += "Requests:             %d\n" % self.requests
+        s += "New connections:      %d\n" % self.connections
+        s += "Reused connections:   %d\n" % self.reused
+        s += "Idle evictions:       %d\n" % self.evictions
+        return s
+
+
+class SessionPool:
+    """
+    A pool of keep-alive HTTP sessions, one per device endpoint (scheme + host + port).
+    All the SOAP traffic towards the same device goes through the same session, so
+    consecutive requests reuse the already established TCP connections instead of
+    paying a new handshake every time.
+    """
+
+    def __init__(self,
+                 pool_size: int = 4,
+                 idle_timeout: float = 60.0):
+        """
+        :param pool_size: the maximum number of idle connections kept open towards a single endpoint
+        :type pool_size: int
+        :param idle_timeout: the number of seconds after which an unused session is closed
+        :type idle_timeout: float
+        """
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._sessions = {}  # dict {endpoint, (session, last use timestamp)}
+        self._in_use = {}  # dict {session, number of requests whose response is still open}
+        self._closing = {}  # dict {session, endpoint} of the sessions closed by close() while in use
+        self._stats = {}  # dict {endpoint, EndpointStats}
+
+    @staticmethod
+    def endpoint_of(addr: str) \
+            -> str:
+        """
+        Obtain the key identifying the device endpoint an address belongs to.
+
+        :param addr: a full URL, like http://192.168.0.149:8018/wsd/scan
+        :type addr: str
+        :return: the URL reduced to scheme, host and port
+        :rtype: str
+        """
+        u = urlsplit(addr)
+        return "%s://%s" % (u.scheme, u.netloc)
+
+    def configure(self,
+                  pool_size: int = None,
+                  idle_timeout: float = None) \
+            -> None:
+        """
+        Change the pool parameters. Already open sessions are closed, so that the new
+        pool size is applied to every endpoint; the ones in use are closed once their
+        responses are.
+
+        :param pool_size: the maximum number of idle connections kept open towards a single endpoint
+        :type pool_size: int
+        :param idle_timeout: the number of seconds after which an unused session is closed
+        :type idle_timeout: float
+        """
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        self.close()
+
+    def _new_session(self) \
+            -> requests.Session:
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.pool_size)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        return s
+
+    @staticmethod
+    def _num_connections(session: requests.Session,
+                         endpoint: str) \
+            -> int:
+        pools = session.get_adapter(endpoint).poolmanager.pools
+        return sum(pools[k].num_connections for k in pools.keys())
+
+    def _retire(self,
+                endpoint: str,
+                session: requests.Session) \
+            -> None:
+        # must be called with the lock held
+        self._stats[endpoint].connections += self._num_connections(session, endpoint)
+        session.close()
+
+    def evict_idle(self) \
+            -> None:
+        """
+        Close the sessions that have not been used for more than idle_timeout seconds.
+        A session is never closed while a response obtained through post() is still open.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for endpoint, (session, last_use) in list(self._sessions.items()):
+                if now - last_use > self.idle_timeout and session not in self._in_use:
+                    logger.debug("Closing idle HTTP session to %s", endpoint)
+                    self._retire(endpoint, session)
+                    self._stats[endpoint].evictions += 1
+                    del self._sessions[endpoint]
+
+    def get(self,
+            addr: str) \
+            -> requests.Session:
+        """
+        Obtain the session to use to talk with the device owning the specified address.
+
+        :param addr: the address the request will be sent to
+        :type addr: str
+        :return: a keep-alive session dedicated to the device endpoint
+        :rtype: requests.Session
+        """
+        return self._acquire(addr, False)
+
+    def _acquire(self,
+                 addr: str,
+                 hold: bool) \
+            -> requests.Session:
+        self.evict_idle()
+        endpoint = self.endpoint_of(addr)
+        with self._lock:
+            if endpoint in self._sessions:
+                session = self._sessions[endpoint][0]
+            else:
+                session = self._new_session()
+                self._stats.setdefault(endpoint, EndpointStats())
+            self._sessions[endpoint] = (session, time.monotonic())
+            self._stats[endpoint].requests += 1
+            if hold:
+                self._in_use[session] = self._in_use.get(session, 0) + 1
+        return session
+
+    def _release(self,
+                 endpoint: str,
+                 session: requests.Session) \
+            -> None:
+        with self._lock:
+            self._in_use[session] -= 1
+            if self._in_use[session]:
+                return
+            del self._in_use[session]
+            if session in self._closing:
+                self._retire(self._closing.pop(session), session)
+            elif self._sessions.get(endpoint, (None,))[0] is session:
+                self._sessions[endpoint] = (session, time.monotonic())
+
+    def post(self,
+             addr: str,
+             **kwargs) \
+            -> requests.Response:
+        """
+        Send an HTTP POST request through the session of the targeted device.
+        The session is kept open until the response is closed: with stream=True, the body may take
+        much longer than idle_timeout to be read.
+
+        :param addr: the address to send the request to
+        :type addr: str
+        :param kwargs: the same keyword arguments accepted by requests.post()
+        :return: the response of the device
+        :rtype: requests.Response
+        """
+        endpoint = self.endpoint_of(addr)
+        session = self._acquire(addr, True)
+        released = threading.Event()
+
+        def release():
+            if not released.is_set():
+                released.set()
+                self._release(endpoint, session)
+
+        try:
+            r = session.post(addr, **kwargs)
+        except BaseException:
+            release()
+            raise
+        if not kwargs.get("stream"):
+            release()
+            return r
+
+        close = r.close
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                release()
+
+        r.close = close_and_release
+        return r
+
+    def stats(self) \
+            -> typing.Dict[str, EndpointStats]:
+        """
+        Collect connection reuse statistics for every endpoint contacted so far.
+
+        :return: a dictionary mapping each endpoint to its statistics
+        :rtype: {str: EndpointStats}
+        """
+        with self._lock:
+            result = {}
+            for endpoint, st in self._stats.items():
+                snapshot = EndpointStats()
+                snapshot.requests = st.requests
+                snapshot.connections = st.connections
+                snapshot.evictions = st.evictions
+                if endpoint in self._sessions:
+                    snapshot.connections += self._num_connections(self._sessions[endpoint][0], endpoint)
+                result[endpoint] = snapshot
+            return result
+
+    def close(self) \
+            -> None:
+        """
+        Close every open session. The ones in use are closed once their responses are: new
+        requests get new sessions meanwhile.
+        """
+        with self._lock:
+            for endpoint, (session, _) in self._sessions.items():
+                if session in self._in_use:
+                    self._closing[session] = endpoint
+                else:
+                    self._retire(endpoint, session)
+            self._sessions.clear()
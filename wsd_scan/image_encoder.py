@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import typing
+
+from PIL import Image
+
+from . import page_codecs, \
+    page_spool, \
+    raster
+
+logger = logging.getLogger("wsd_scan")
+
+
+def encode_file(src: str,
+                dst: str,
+                profile: dict,
+                mode: str = None) \
+        -> typing.Tuple[str, float]:
+    """
+    Decode the image stored in a file and encode it again in another format.
+    Runs inside the encoder processes, so it receives file paths only: the image data is
+    never pickled to cross the process boundary. The source file is removed once done.
+
+    :param src: the path of the image received from the device
+    :type src: str
+    :param dst: the path of the file to write
+    :type dst: str
+    :param profile: the page profile, with the format and codec to save the image with
+    :type profile: dict
+    :param mode: the PIL mode to convert the image to before saving it, or None to keep its mode
+    :type mode: str
+    :return: the path of the written file, and the CPU time spent, in seconds
+    :rtype: (str, float)
+    """
+    cpu_start = time.process_time()
+    try:
+        with Image.open(src) as img:
+            if mode is not None:
+                img = img.convert(mode, dither=Image.Dither.NONE)
+            page_codecs.save(img, dst, profile, img.info.get("dpi"))
+    finally:
+        os.remove(src)
+    return dst, time.process_time() - cpu_start
+
+
+class ProcessPoolEncoder:
+    """
+    Encodes scanned pages in a pool of worker processes, so that the PIL work of concurrent scans
+    is not serialized by the GIL. Pages are handed to the workers through temporary files written
+    next to their destination.
+    """
+
+    def __init__(self,
+                 workers: int = None):
+        """
+        :param workers: the number of worker processes, by default the number of CPUs
+        :type workers: int
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self) \
+            -> concurrent.futures.ProcessPoolExecutor:
+        # the pool is started on first use, "spawn" avoids forking a process full of threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def submit(self,
+               data: typing.Union[bytes, page_spool.PageHandle],
+               profile: dict,
+               picture_file: str,
+               mode: str = None) \
+            -> concurrent.futures.Future:
+        """
+        Schedule the encoding of a page.
+        A page already spooled to disk is handed to the worker as it is; the worker removes the spool
+        file, the caller still has to release the handle to give back its budget.
+
+        :param data: the image data received from the device, or the handle of the spooled page
+        :type data: bytes | page_spool.PageHandle
+        :param profile: the scan profile in use
+        :type profile: dict
+        :param picture_file: the path of the file to write
+        :type picture_file: str
+        :param mode: the PIL mode to store the page in, or None to keep the mode it was received in
+        :type mode: str
+        :return: a future resolving to the path of the written file and the CPU time spent by the worker
+        :rtype: concurrent.futures.Future
+        """
+        if mode is not None:
+            mode = raster.storable_mode(mode, profile["image_format"])
+        if isinstance(data, page_spool.PageHandle):
+            return self._get_executor().submit(encode_file, data.path, picture_file, profile, mode)
+
+        fd, src = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(picture_file) or None)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            return self._get_executor().submit(encode_file, src, picture_file, profile, mode)
+        except Exception:
+            os.remove(src)
+            raise
+
+    def close(self) \
+            -> None:
+        """
+        Stop the worker processes, after the pending pages are encoded.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
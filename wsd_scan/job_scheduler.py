@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import bisect
+import itertools
+import logging
+import threading
+import time
+import typing
+
+logger = logging.getLogger("wsd_scan")
+
+
+class SchedulerStats:
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.queued = 0
+        self.running = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def mean_wait(self):
+        started = self.completed + self.failed + self.running
+        return self.total_wait / started if started else 0.0
+
+    def __str__(self):
+        s = ""
+        s += "Submitted jobs:       %d\n" % self.submitted
+        s += "Completed jobs:       %d\n" % self.completed
+        s += "Failed jobs:          %d\n" % self.failed
+        s += "Queued jobs:          %d\n" % self.queued
+        s += "Running jobs:         %d\n" % self.running
+        s += "Mean wait:            %.3f s\n" % self.mean_wait
+        s += "Max wait:             %.3f s\n" % self.max_wait
+        return s
+
+
+class _Job:
+    def __init__(self, key, device, fn, args, enqueued):
+        self.key = key  # (-priority, sequence number)
+        self.device = device
+        self.fn = fn
+        self.args = args
+        self.enqueued = enqueued
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class ScanJobScheduler:
+    """
+    Runs scan jobs on a bounded set of worker threads.
+    Jobs wait in a queue ordered by priority, then by arrival. A worker takes the first job whose
+    device is running less than per_device jobs, so a device is never asked to serve more
+    concurrent scans than it can handle, while jobs for other devices can overtake it.
+    """
+
+    def __init__(self,
+                 max_workers: int = 4,
+                 per_device: int = 1):
+        """
+        :param max_workers: the maximum number of jobs running at once, for all the devices
+        :type max_workers: int
+        :param per_device: the maximum number of jobs running at once on the same device
+        :type per_device: int
+        """
+        self.max_workers = max_workers
+        self.per_device = per_device
+        self._cond = threading.Condition()
+        self._queue = []  # list [_Job], sorted
+        self._running = {}  # dict {device, number of running jobs}
+        self._workers = []
+        self._seq = itertools.count()
+        self._stats = SchedulerStats()
+
+    def configure(self,
+                  max_workers: int = None,
+                  per_device: int = None) \
+            -> None:
+        """
+        Change the scheduler limits. Jobs already running are not affected.
+
+        :param max_workers: the maximum number of jobs running at once, for all the devices
+        :type max_workers: int
+        :param per_device: the maximum number of jobs running at once on the same device
+        :type per_device: int
+        """
+        with self._cond:
+            if max_workers is not None:
+                self.max_workers = max_workers
+            if per_device is not None:
+                self.per_device = per_device
+            self._cond.notify_all()
+
+    def submit(self,
+               device: str,
+               fn: typing.Callable,
+               *args,
+               priority: int = 0) \
+            -> None:
+        """
+        Queue a job.
+
+        :param device: the key identifying the device the job talks to
+        :type device: str
+        :param fn: the function running the job
+        :type fn: callable
+        :param args: the arguments of the function
+        :param priority: jobs with a higher priority are started first
+        :type priority: int
+        """
+        with self._cond:
+            bisect.insort(self._queue, _Job((-priority, next(self._seq)), device, fn, args, time.monotonic()))
+            self._stats.submitted += 1
+            # the workers are started on demand, up to max_workers
+            active = [w for w in self._workers if w.is_alive()]
+            if len(active) < self.max_workers:
+                w = threading.Thread(target=self._worker, name="scan-worker-%d" % len(active), daemon=True)
+                active.append(w)
+                w.start()
+            self._workers = active
+            self._cond.notify_all()
+
+    def _next_job(self) \
+            -> typing.Union[_Job, None]:
+        # must be called with the lock held
+        if sum(self._running.values()) >= self.max_workers:
+            return None
+        for i, job in enumerate(self._queue):
+            if self._running.get(job.device, 0) < self.per_device:
+                del self._queue[i]
+                return job
+        return None
+
+    def _worker(self) \
+            -> None:
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running[job.device] = self._running.get(job.device, 0) + 1
+                wait = time.monotonic() - job.enqueued
+                self._stats.total_wait += wait
+                self._stats.max_wait = max(self._stats.max_wait, wait)
+                queued = len(self._queue)
+
+            logger.info("Starting scan job for %s (waited %.1f s, %d queued)", job.device, wait, queued)
+            failed = False
+            try:
+                job.fn(*job.args)
+            except Exception as e:
+                failed = True
+                logger.error("Scan job for %s failed: %s", job.device, e)
+
+            with self._cond:
+                self._running[job.device] -= 1
+                if failed:
+                    self._stats.failed += 1
+                else:
+                    self._stats.completed += 1
+                self._cond.notify_all()
+
+    def queue_depth(self,
+                    device: str = None) \
+            -> int:
+        """
+        Count the jobs waiting to be started.
+
+        :param device: count only the jobs for this device
+        :type device: str
+        :return: the number of queued jobs
+        :rtype: int
+        """
+        with self._cond:
+            if device is None:
+                return len(self._queue)
+            return sum(1 for job in self._queue if job.device == device)
+
+    def stats(self) \
+            -> SchedulerStats:
+        """
+        Collect the scheduler metrics.
+
+        :return: a snapshot of the counters, queue depth and wait times
+        :rtype: SchedulerStats
+        """
+        with self._cond:
+            snapshot = SchedulerStats()
+            snapshot.__dict__.update(self._stats.__dict__)
+            snapshot.queued = len(self._queue)
+            snapshot.running = sum(self._running.values())
+            return snapshot
+
+    def join(self,
+             timeout: float = None) \
+            -> bool:
+        """
+        Wait until no job is queued or running.
+
+        :param timeout: the maximum number of seconds to wait
+        :type timeout: float
+        :return: True if every job is done, False on timeout
+        :rtype: bool
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not any(self._running.values()), timeout)
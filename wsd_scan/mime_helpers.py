@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# https://www.w3.org/TR/xop10/
+# https://datatracker.ietf.org/doc/html/rfc2046#section-5.1.1
+
+import binascii
+import email.message
+import typing
+from email.parser import BytesHeaderParser
+
+
+def get_boundary(content_type: str) \
+        -> typing.Union[str, None]:
+    """
+    Extracts the boundary parameter from the Content-Type header of a multipart message.
+
+    :param content_type: the value of the Content-Type header
+    :type content_type: str
+    :return: the boundary string, if any
+    :rtype: str | None
+    """
+    m = email.message.Message()
+    m["Content-Type"] = content_type
+    return m.get_param("boundary")
+
+
+class Base64Writer:
+    """
+    Wraps a sink, decoding base64 encoded parts while they are written.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._pending = b""
+
+    def write(self, data):
+        data = self._pending + bytes(data).replace(b"\r", b"").replace(b"\n", b"")
+        n = len(data) - len(data) % 4
+        self._pending = data[n:]
+        if n:
+            self.sink.write(binascii.a2b_base64(data[:n]))
+        return len(data)
+
+    def flush(self):
+        if self._pending:
+            self.sink.write(binascii.a2b_base64(self._pending))
+            self._pending = b""
+
+
+class MultipartStreamParser:
+    """
+    Incremental parser for multipart/related (MTOM/XOP) HTTP bodies.
+    Data is fed chunk by chunk, boundaries are searched in a small window, and the content of
+    each part is handed to a sink as soon as it is known not to contain a boundary.
+    The payload is never accumulated in memory, unless the sink itself does it.
+    """
+
+    PREAMBLE, HEADERS, BODY, EPILOGUE = range(4)
+
+    def __init__(self,
+                 boundary: str,
+                 sink_factory: typing.Callable):
+        """
+        :param boundary: the boundary string, from the Content-Type header
+        :type boundary: str
+        :param sink_factory: a callable receiving the part index and its headers (an email.message.Message),
+                             returning a writable object for the part body, or None to discard it
+        :type sink_factory: callable
+        """
+        self.delimiter = b"--" + boundary.encode("ASCII")
+        self.sink_factory = sink_factory
+        self.parts = []  # list [(headers, sink)]
+        self._state = self.PREAMBLE
+        self._buf = bytearray()
+        self._sink = None
+
+    def _emit(self,
+              end: int) \
+            -> None:
+        # hand out a view on the buffer, released before the buffer is resized
+        if self._sink is not None and end > 0:
+            with memoryview(self._buf) as mv, mv[:end] as data:
+                self._sink.write(data)
+
+    def _end_part(self) \
+            -> None:
+        if self._sink is not None and hasattr(self._sink, "flush"):
+            self._sink.flush()
+        self._sink = None
+
+    def _start_part(self,
+                    raw_headers: bytes) \
+            -> None:
+        headers = BytesHeaderParser().parsebytes(raw_headers)
+        sink = self.sink_factory(len(self.parts), headers)
+        self.parts.append((headers, sink))
+        if sink is not None and headers.get("Content-Transfer-Encoding", "").lower() == "base64":
+            sink = Base64Writer(sink)
+        self._sink = sink
+
+    def feed(self,
+             chunk: bytes) \
+            -> None:
+        """
+        Processes a new chunk of the HTTP body.
+
+        :param chunk: the data received
+        :type chunk: bytes
+        """
+        self._buf += chunk
+        while True:
+            if self._state == self.EPILOGUE:
+                del self._buf[:]
+                return
+
+            if self._state == self.HEADERS:
+                # the line after the delimiter is either "--" (closing delimiter) or the end of the delimiter line
+                if len(self._buf) < 2:
+                    return
+                if self._buf[:2] == b"--":
+                    self._state = self.EPILOGUE
+                    continue
+                end = self._buf.find(b"\r\n\r\n")
+                if end == -1:
+                    return
+                self._start_part(bytes(self._buf[:end + 4]).lstrip(b" \t\r\n"))
+                del self._buf[:end + 4]
+                self._state = self.BODY
+                continue
+
+            idx = self._buf.find(self.delimiter)
+            if idx == -1:
+                # keep enough bytes to recognize a delimiter (and the CRLF before it) spanning two chunks
+                keep = len(self.delimiter) + 1
+                if len(self._buf) > keep:
+                    if self._state == self.BODY:
+                        self._emit(len(self._buf) - keep)
+                    del self._buf[:-keep]
+                return
+
+            if self._state == self.BODY:
+                # the CRLF preceding the delimiter belongs to the delimiter, not to the part content
+                end = idx
+                if self._buf[max(end - 2, 0):end] == b"\r\n":
+                    end -= 2
+                elif self._buf[max(end - 1, 0):end] == b"\n":
+                    end -= 1
+                self._emit(end)
+                self._end_part()
+            del self._buf[:idx + len(self.delimiter)]
+            self._state = self.HEADERS
+
+    def close(self) \
+            -> None:
+        """
+        Signals the end of the HTTP body.
+
+        :raises ValueError: if the body ended before the closing delimiter, as when the connection
+                            drops during the transfer; the content of the last part is then incomplete
+        """
+        complete = self._state == self.EPILOGUE
+        del self._buf[:]
+        self._sink = None
+        self._state = self.EPILOGUE
+        if not complete:
+            raise ValueError("truncated multipart body")
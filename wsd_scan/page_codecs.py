@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import logging
+import typing
+from io import BytesIO
+
+from PIL import Image
+
+logger = logging.getLogger("wsd_scan")
+
+# the lowest JPEG quality tried to fit a page in max_page_bytes
+MIN_QUALITY = 20
+
+TAG_ROWS_PER_STRIP = 278
+
+
+class Codec:
+    """
+    An output format for scanned pages, with the save parameters that suit it.
+    The files written can be embedded in a PDF as they are: JPEG (DCTDecode), PNG (FlateDecode
+    with PNG predictors) and single-strip CCITT Group 4 TIFF (CCITTFaxDecode).
+    """
+
+    def __init__(self,
+                 name: str,
+                 image_format: str,
+                 modes: typing.Tuple[str, ...],
+                 lossy: bool,
+                 params: dict):
+        """
+        :param name: the name of the codec in the profiles
+        :type name: str
+        :param image_format: the PIL format, also the extension of the files
+        :type image_format: str
+        :param modes: the PIL modes the format can store, the first one being used for the others
+        :type modes: (str, ...)
+        :param lossy: whether the size depends on the quality
+        :type lossy: bool
+        :param params: the PIL save parameters
+        :type params: dict
+        """
+        self.name = name
+        self.image_format = image_format
+        self.modes = modes
+        self.lossy = lossy
+        self.params = params
+
+    def encode(self,
+               img: Image.Image,
+               quality: int = None,
+               dpi: typing.Tuple[float, float] = None) \
+            -> bytes:
+        """
+        Encode an image, converting it first if the format cannot store its mode.
+
+        :param img: the image to encode
+        :type img: PIL.Image.Image
+        :param quality: the PIL save quality, for lossy codecs
+        :type quality: int
+        :param dpi: the resolution to record in the file
+        :type dpi: (float, float)
+        :return: the encoded image
+        :rtype: bytes
+        """
+        if img.mode not in self.modes:
+            img = img.convert("L" if img.mode == "1" and "L" in self.modes else self.modes[0],
+                              dither=Image.Dither.NONE)
+        params = dict(self.params)
+        if self.lossy and quality is not None:
+            params["quality"] = quality
+        if self.name == "g4":
+            # a single strip can be embedded in a PDF as one CCITT stream
+            params["tiffinfo"] = {TAG_ROWS_PER_STRIP: img.height}
+        if dpi:
+            params["dpi"] = dpi
+        buf = BytesIO()
+        img.save(buf, format=self.image_format, **params)
+        return buf.getvalue()
+
+    def fit(self,
+            img: Image.Image,
+            quality: int,
+            max_bytes: int,
+            dpi: typing.Tuple[float, float] = None) \
+            -> typing.Tuple[bytes, int]:
+        """
+        Encode an image at the highest quality, up to the one given, whose size is within max_bytes,
+        found by binary search. Lossless codecs, and pages that do not fit even at MIN_QUALITY, are
+        encoded once, at the quality given or at MIN_QUALITY.
+
+        :param img: the image to encode
+        :type img: PIL.Image.Image
+        :param quality: the highest PIL save quality
+        :type quality: int
+        :param max_bytes: the size target, 0 for none
+        :type max_bytes: int
+        :param dpi: the resolution to record in the file
+        :type dpi: (float, float)
+        :return: the encoded image and the quality used
+        :rtype: (bytes, int)
+        """
+        data = self.encode(img, quality, dpi)
+        if not max_bytes or len(data) <= max_bytes or not self.lossy or quality <= MIN_QUALITY:
+            return data, quality
+
+        # invariant: best is the highest quality known to fit, low..high are still untried
+        best, low, high = None, MIN_QUALITY, quality - 1
+        while low <= high:
+            q = (low + high) // 2
+            candidate = self.encode(img, q, dpi)
+            if len(candidate) <= max_bytes:
+                best = (candidate, q)
+                low = q + 1
+            else:
+                high = q - 1
+        if best is None:
+            return self.encode(img, MIN_QUALITY, dpi), MIN_QUALITY
+        return best
+
+
+CODECS = {"g4": Codec("g4", "tiff", ("1",), False, {"compression": "group4"}),
+          "png": Codec("png", "png", ("L", "1", "RGB"), False, {"compress_level": 6}),
+          "jpeg": Codec("jpeg", "jpeg", ("RGB", "L"), True, {"optimize": True})}
+
+# the codec of each mode, for the profiles with codec: auto
+AUTO_CODECS = {"1": "g4", "L": "png", "RGB": "jpeg"}
+
+
+def page_profile(profile: dict,
+                 mode: str) \
+        -> dict:
+    """
+    Resolve the output codec of a page, for the profiles with codec: auto or with a max_page_bytes
+    target. The page profile returned names the codec in page_codec, and its image_format.
+
+    :param profile: the scan profile in use
+    :type profile: dict
+    :param mode: the PIL mode the page is stored in
+    :type mode: str
+    :return: the profile to save the page with, the same one if no codec applies
+    :rtype: dict
+    """
+    if profile.get("codec") == "auto":
+        name = AUTO_CODECS.get(mode, "jpeg")
+    elif profile.get("max_page_bytes") and profile["image_format"].lower() in ("jpeg", "jpg"):
+        name = "jpeg"
+    else:
+        return profile
+    return dict(profile, page_codec=name, image_format=CODECS[name].image_format)
+
+
+def save(img: Image.Image,
+         picture_file: str,
+         profile: dict,
+         dpi: typing.Tuple[float, float] = None) \
+        -> None:
+    """
+    Write a page with the codec of its page profile, or with PIL's defaults for the image_format
+    of the profile.
+
+    :param img: the image of the page
+    :type img: PIL.Image.Image
+    :param picture_file: the path of the file to write
+    :type picture_file: str
+    :param profile: the page profile, as returned by page_profile()
+    :type profile: dict
+    :param dpi: the resolution to record in the file
+    :type dpi: (float, float)
+    """
+    codec = CODECS.get(profile.get("page_codec"))
+    if codec is None:
+        params = {"quality": profile["quality"]}
+        if dpi:
+            params["dpi"] = dpi
+        img.save(picture_file, format=profile["image_format"], **params)
+        return
+
+    max_bytes = profile.get("max_page_bytes") or 0
+    data, quality = codec.fit(img, profile["quality"], max_bytes, dpi)
+    if max_bytes and len(data) > max_bytes:
+        logger.warning("%s does not fit in %d bytes: %d bytes with %s", picture_file, max_bytes, len(data),
+                       "quality %d" % quality if codec.lossy else codec.name)
+    elif quality != profile["quality"]:
+        logger.info("%s fit in %d bytes at quality %d", picture_file, len(data), quality)
+    with open(picture_file, "wb") as f:
+        f.write(data)
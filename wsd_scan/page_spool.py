@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import typing
+
+from PIL import Image
+
+logger = logging.getLogger("wsd_scan")
+
+
+class SpoolBudget:
+    """
+    The number of bytes of retrieved pages that can wait on disk to be saved, for the whole process.
+    A new retrieval starts only while the budget is not exhausted, and the bytes of a page are
+    given back when the page is saved or discarded, so the pages that the save stages (and the
+    PDF writers) may have to load at once stay bounded whatever the number of concurrent scans.
+    A page being retrieved is never interrupted: the budget can be exceeded by the pages in flight.
+    """
+
+    def __init__(self,
+                 max_bytes: int):
+        """
+        :param max_bytes: the number of bytes above which new retrievals wait
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def wait(self,
+             timeout: float = None) \
+            -> bool:
+        """
+        Block until the budget is not exhausted.
+
+        :param timeout: the maximum number of seconds to wait
+        :type timeout: float
+        :return: True if a retrieval can start, False on timeout
+        :rtype: bool
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.used < self.max_bytes, timeout)
+
+    def charge(self,
+               size: int) \
+            -> None:
+        with self._cond:
+            self.used += size
+
+    def release(self,
+                size: int) \
+            -> None:
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+
+class PageHandle:
+    """
+    A page retrieved from the device and spooled to a file, instead of being held in memory.
+    The image is only read when asked for: opened lazily with PIL, memory-mapped, or read whole.
+    The spool file is removed and the budget given back on release(), unless the file was
+    moved to its final place first.
+    """
+
+    def __init__(self,
+                 path: str,
+                 size: int,
+                 content_type: str = None,
+                 budget: SpoolBudget = None):
+        """
+        :param path: the path of the spool file
+        :type path: str
+        :param size: the size of the image, in bytes
+        :type size: int
+        :param content_type: the MIME type of the image part
+        :type content_type: str
+        :param budget: the budget the page is charged to
+        :type budget: SpoolBudget
+        """
+        self.path = path
+        self.size = size
+        self.content_type = content_type
+        self._budget = budget
+        self._charged = size if budget is not None else 0
+        self._spooled = True
+        self._lock = threading.Lock()
+
+    def head(self,
+             length: int = 16) \
+            -> bytes:
+        """
+        Read the first bytes of the image, to recognize its format.
+
+        :param length: the number of bytes to read
+        :type length: int
+        :return: the first bytes of the image
+        :rtype: bytes
+        """
+        with open(self.path, "rb") as f:
+            return f.read(length)
+
+    def read(self) \
+            -> bytes:
+        """
+        Load the whole image data.
+
+        :return: the image data
+        :rtype: bytes
+        """
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def mmap(self) \
+            -> mmap.mmap:
+        """
+        Map the image data in memory, read-only. The pages are loaded by the OS as they are accessed.
+
+        :return: the mapped image data
+        :rtype: mmap.mmap
+        """
+        with open(self.path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def with_mmap(self,
+                  fn: typing.Callable[["mmap.mmap"], typing.Any]) \
+            -> typing.Any:
+        """
+        Call a function on the mapped image data, then unmap it.
+        The map can only be closed once no array views it: if the function fails, the traceback of
+        its exception, whose frames may hold such arrays, is dropped before the exception is raised again.
+
+        :param fn: the function to call, with the mapped image data
+        :type fn: (mmap.mmap) -> any
+        :return: the result of the function, which must not view the map
+        :rtype: any
+        """
+        mapped = self.mmap()
+        try:
+            result = fn(mapped)
+            error = None
+        except Exception as e:
+            error = e
+            while e is not None:
+                e.__traceback__ = None
+                e = e.__context__
+        # outside of the except clause, so that the exception being handled does not keep the frames alive
+        mapped.close()
+        if error is not None:
+            raise error
+        return result
+
+    def open(self) \
+            -> Image.Image:
+        """
+        Open the image with PIL. Only the header is read until the pixels are accessed.
+
+        :return: the image
+        :rtype: PIL.Image.Image
+        """
+        return Image.open(self.path)
+
+    def move_to(self,
+                path: str) \
+            -> str:
+        """
+        Move the spool file to its final place, without copying it, and give back its budget.
+
+        :param path: the destination path, on the same file system as the spool file
+        :type path: str
+        :return: the destination path
+        :rtype: str
+        """
+        os.replace(self.path, path)
+        with self._lock:
+            self.path = path
+            self._spooled = False
+        self._give_back()
+        return path
+
+    def _give_back(self) \
+            -> None:
+        with self._lock:
+            charged, self._charged = self._charged, 0
+        if charged:
+            self._budget.release(charged)
+
+    def release(self) \
+            -> None:
+        """
+        Remove the spool file, if it is still there, and give back its budget. Can be called more than once.
+        """
+        with self._lock:
+            spooled, self._spooled = self._spooled, False
+        if spooled:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                # already consumed, by an encoder process for instance
+                pass
+        self._give_back()
+
+    def __repr__(self):
+        return "<PageHandle %s (%d bytes)>" % (self.path, self.size)
+
+
+class PageSpooler:
+    """
+    A sink writing a retrieved page to a temporary file next to its destination, charging
+    the bytes to a budget as they are received.
+    """
+
+    def __init__(self,
+                 folder: str,
+                 budget: SpoolBudget = None):
+        """
+        :param folder: the folder of the spool file, the target folder of the scan
+        :type folder: str
+        :param budget: the budget to wait for and to charge, or None for an unbounded spool
+        :type budget: SpoolBudget
+        """
+        if budget is not None:
+            budget.wait()
+        self.budget = budget
+        self.size = 0
+        fd, self.path = tempfile.mkstemp(suffix=".part", dir=folder or None)
+        self._f = os.fdopen(fd, "wb")
+
+    def write(self,
+              data: bytes) \
+            -> int:
+        if self.budget is not None:
+            self.budget.charge(len(data))
+        self.size += len(data)
+        return self._f.write(data)
+
+    def close(self,
+              content_type: str = None) \
+            -> PageHandle:
+        """
+        Complete the spool file.
+
+        :param content_type: the MIME type of the image part
+        :type content_type: str
+        :return: the handle of the spooled page, owning the charged bytes
+        :rtype: PageHandle
+        """
+        self._f.close()
+        return PageHandle(self.path, self.size, content_type, self.budget)
+
+    def discard(self) \
+            -> None:
+        """
+        Remove the spool file and give back the charged bytes.
+        """
+        self._f.close()
+        os.remove(self.path)
+        if self.budget is not None:
+            self.budget.release(self.size)
+
+
+def page_head(page: typing.Union[bytes, PageHandle],
+              length: int = 16) \
+        -> bytes:
+    """
+    Get the first bytes of a page, held in memory or spooled.
+
+    :param page: the image data, or the handle of the spooled page
+    :type page: bytes | PageHandle
+    :param length: the number of bytes to get
+    :type length: int
+    :return: the first bytes of the image
+    :rtype: bytes
+    """
+    if isinstance(page, PageHandle):
+        return page.head(length)
+    return page[:length]
+
+
+def page_size(page: typing.Union[bytes, PageHandle]) \
+        -> int:
+    """
+    Get the size of a page, held in memory or spooled.
+
+    :param page: the image data, or the handle of the spooled page
+    :type page: bytes | PageHandle
+    :return: the size of the image, in bytes
+    :rtype: int
+    """
+    if isinstance(page, PageHandle):
+        return page.size
+    return len(page)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# https://opensource.adobe.com/dc-acrobat-sdk-docs/pdfstandards/PDF32000_2008.pdf
+# https://www.w3.org/Graphics/JPEG/itu-t81.pdf
+# https://www.w3.org/TR/png/
+
+import struct
+import typing
+import zlib
+from io import BytesIO
+
+from PIL import Image
+
+from . import raster
+
+# JPEG start of frame markers: SOF0..SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+JPEG_COLOR_SPACES = {1: "/DeviceGray", 3: "/DeviceRGB", 4: "/DeviceCMYK"}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG color types whose data can be embedded as it is, with their color space and number of components:
+# gray and RGB, without palette nor alpha
+PNG_COLOR_SPACES = {0: (b"/DeviceGray", 1), 2: (b"/DeviceRGB", 3)}
+
+TIFF_COMPRESSION_CCITT_G4 = 4
+
+
+class JpegInfo:
+    """
+    The properties of a JPEG image needed to embed it in a PDF as it is.
+    """
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.components = 0
+        self.dpi = None
+        self.adobe = False
+
+
+def parse_jpeg_header(data: bytes) \
+        -> JpegInfo:
+    """
+    Read the size, the number of components and the density of a JPEG image, walking
+    its marker segments up to the start of frame.
+
+    :param data: the JPEG image
+    :type data: bytes
+    :return: the image properties
+    :rtype: JpegInfo
+    """
+    info = JpegInfo()
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("Invalid JPEG marker at offset %d" % pos)
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        segment = data[pos + 4:pos + 2 + length]
+
+        if marker == 0xE0 and segment[:5] == b"JFIF\x00" and len(segment) >= 12:
+            units, x_density, y_density = struct.unpack(">BHH", segment[7:12])
+            if units == 1 and x_density:
+                info.dpi = (x_density, y_density or x_density)
+            elif units == 2 and x_density:
+                info.dpi = (x_density * 2.54, (y_density or x_density) * 2.54)
+        elif marker == 0xEE and segment[:5] == b"Adobe":
+            info.adobe = True
+        elif marker in SOF_MARKERS:
+            info.height, info.width, info.components = struct.unpack(">HHB", segment[1:6])
+            return info
+
+        pos += 2 + length
+    raise ValueError("No start of frame found in JPEG data")
+
+
+class PngInfo:
+    """
+    The properties of a PNG image needed to embed its compressed data in a PDF as it is.
+    """
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.bit_depth = 8
+        self.color_type = 0
+        self.interlace = 0
+        self.dpi = None
+        self.idat = b""
+
+    @property
+    def embeddable(self):
+        # PDF 1.4 reads up to 8 bits per component, and PNG predictors only for non-interlaced images
+        return self.color_type in PNG_COLOR_SPACES and self.bit_depth <= 8 and not self.interlace
+
+
+def parse_png(data: bytes) \
+        -> PngInfo:
+    """
+    Read the header, the density and the compressed data of a PNG image, walking its chunks.
+
+    :param data: the PNG image
+    :type data: bytes
+    :return: the image properties, with the concatenated IDAT data
+    :rtype: PngInfo
+    """
+    info = PngInfo()
+    idat = []
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        if chunk_type == b"IHDR":
+            info.width, info.height, info.bit_depth, info.color_type, _, _, info.interlace = \
+                struct.unpack(">IIBBBBB", chunk[:13])
+        elif chunk_type == b"pHYs" and len(chunk) >= 9:
+            x_ppu, y_ppu, unit = struct.unpack(">IIB", chunk[:9])
+            if unit == 1 and x_ppu:
+                info.dpi = (x_ppu * 0.0254, (y_ppu or x_ppu) * 0.0254)
+        elif chunk_type == b"IDAT":
+            idat.append(chunk)
+        elif chunk_type == b"IEND":
+            break
+        # length, type, data and CRC
+        pos += 12 + length
+    if not info.width:
+        raise ValueError("No header found in PNG data")
+    info.idat = b"".join(idat)
+    return info
+
+
+class StreamingPdfWriter:
+    """
+    Writes a PDF file incrementally, one page at a time.
+    Each page (image, content stream, page object) is appended to the file as soon as it is added,
+    and only the object offsets are kept in memory. The page tree, the cross-reference table and
+    the trailer are written when the writer is closed, so closing costs the same whatever the
+    number of pages.
+    JPEG images are embedded as they are (DCTDecode), and so are the compressed data of gray and RGB
+    PNG images (FlateDecode with PNG predictors) and of single-strip Group 4 TIFF images
+    (CCITTFaxDecode); other images are stored as deflated pixels.
+    """
+
+    CATALOG = 1
+    PAGES = 2
+
+    def __init__(self,
+                 path: str,
+                 default_dpi: float = 300):
+        """
+        :param path: the path of the PDF file to write
+        :type path: str
+        :param default_dpi: the resolution used for the page size when the image does not specify one
+        :type default_dpi: float
+        """
+        self.path = path
+        self.default_dpi = default_dpi
+        self._f = open(path, "wb")
+        self._offsets = {}  # dict {object number, offset in file}
+        self._next_obj = self.PAGES + 1
+        self._pages = []  # list [page object number]
+        self._f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def page_count(self):
+        return len(self._pages)
+
+    def _write_object(self,
+                      num: int,
+                      dictionary: bytes,
+                      stream: bytes = None) \
+            -> None:
+        self._offsets[num] = self._f.tell()
+        self._f.write(b"%d 0 obj\n" % num)
+        self._f.write(dictionary)
+        if stream is not None:
+            self._f.write(b"\nstream\n")
+            self._f.write(stream)
+            self._f.write(b"\nendstream")
+        self._f.write(b"\nendobj\n")
+
+    def _alloc(self) \
+            -> int:
+        num = self._next_obj
+        self._next_obj += 1
+        return num
+
+    @staticmethod
+    def _raster_of(img: Image.Image) \
+            -> typing.Tuple[bytes, bytes, int]:
+        # returns the color space, the bits per component and the pixels
+        if img.mode == "1":
+            return b"/DeviceGray", img.tobytes(), 1
+        if img.mode == "L":
+            return b"/DeviceGray", img.tobytes(), 8
+        if img.mode == "CMYK":
+            return b"/DeviceCMYK", img.tobytes(), 8
+        return b"/DeviceRGB", img.convert("RGB").tobytes(), 8
+
+    def _image_object(self,
+                      data: bytes) \
+            -> typing.Tuple[bytes, bytes, int, int, typing.Tuple[float, float]]:
+        # returns the image dictionary, the stream, the size in pixels and the resolution
+        if data[:3] == b"\xff\xd8\xff":
+            info = parse_jpeg_header(data)
+            decode = b""
+            if info.components == 4 and info.adobe:
+                # Adobe CMYK JPEGs are stored inverted
+                decode = b" /Decode [1 0 1 0 1 0 1 0]"
+            dictionary = b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s " \
+                         b"/BitsPerComponent 8 /Filter /DCTDecode%s /Length %d >>" \
+                         % (info.width, info.height, JPEG_COLOR_SPACES[info.components].encode(), decode, len(data))
+            return dictionary, data, info.width, info.height, info.dpi
+
+        if data[:8] == PNG_SIGNATURE:
+            info = parse_png(data)
+            if info.embeddable:
+                color_space, colors = PNG_COLOR_SPACES[info.color_type]
+                dictionary = b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s " \
+                             b"/BitsPerComponent %d /Filter /FlateDecode /DecodeParms << /Predictor 15 " \
+                             b"/Colors %d /BitsPerComponent %d /Columns %d >> /Length %d >>" \
+                             % (info.width, info.height, color_space, info.bit_depth,
+                                colors, info.bit_depth, info.width, len(info.idat))
+                return dictionary, info.idat, info.width, info.height, info.dpi
+        elif data[:4] in raster.TIFF_MAGIC:
+            info = raster.parse_tiff_header(data)
+            if info.compression == TIFF_COMPRESSION_CCITT_G4 and len(info.strip_offsets) == 1 \
+                    and info.bits_per_sample == 1 and info.samples_per_pixel == 1 and info.fill_order == 1 \
+                    and info.photometric in (raster.PHOTOMETRIC_WHITE_IS_ZERO, raster.PHOTOMETRIC_BLACK_IS_ZERO):
+                stream = bytes(data[info.strip_offsets[0]:info.strip_offsets[0] + info.strip_byte_counts[0]])
+                # the codes of white runs give 0 bits in TIFF, 1 bits (white) in PDF unless BlackIs1
+                black_is_1 = b" /BlackIs1 true" if info.photometric == raster.PHOTOMETRIC_BLACK_IS_ZERO else b""
+                dictionary = b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray " \
+                             b"/BitsPerComponent 1 /Filter /CCITTFaxDecode /DecodeParms << /K -1 /Columns %d " \
+                             b"/Rows %d%s >> /Length %d >>" \
+                             % (info.width, info.height, info.width, info.height, black_is_1, len(stream))
+                return dictionary, stream, info.width, info.height, info.dpi
+
+        with Image.open(BytesIO(data)) as img:
+            dpi = img.info.get("dpi")
+            color_space, pixels, bpc = self._raster_of(img)
+            width, height = img.size
+        stream = zlib.compress(pixels)
+        dictionary = b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s " \
+                     b"/BitsPerComponent %d /Filter /FlateDecode /Length %d >>" \
+                     % (width, height, color_space, bpc, len(stream))
+        return dictionary, stream, width, height, dpi
+
+    def add_page(self,
+                 image: typing.Union[bytes, str],
+                 dpi: float = None) \
+            -> None:
+        """
+        Append a page holding a single image, sized after the image resolution.
+
+        :param image: the image data, or the path of the image file
+        :type image: bytes | str
+        :param dpi: the image resolution, overriding the one stored in the image
+        :type dpi: float
+        """
+        if isinstance(image, str):
+            with open(image, "rb") as f:
+                image = f.read()
+
+        dictionary, stream, width, height, image_dpi = self._image_object(image)
+        x_dpi, y_dpi = (dpi, dpi) if dpi else (image_dpi or (self.default_dpi, self.default_dpi))
+        page_w = width * 72.0 / x_dpi
+        page_h = height * 72.0 / y_dpi
+
+        img_obj = self._alloc()
+        self._write_object(img_obj, dictionary, stream)
+
+        content = b"q\n%.4f 0 0 %.4f 0 0 cm\n/Im0 Do\nQ" % (page_w, page_h)
+        content_obj = self._alloc()
+        self._write_object(content_obj, b"<< /Length %d >>" % len(content), content)
+
+        page_obj = self._alloc()
+        self._write_object(page_obj,
+                           b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.4f %.4f] "
+                           b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+                           % (self.PAGES, page_w, page_h, img_obj, content_obj))
+        self._pages.append(page_obj)
+        self._f.flush()
+
+    def close(self) \
+            -> None:
+        """
+        Write the page tree, the cross-reference table and the trailer, then close the file.
+        """
+        if self._f.closed:
+            return
+        kids = b" ".join(b"%d 0 R" % p for p in self._pages)
+        self._write_object(self.PAGES, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._pages)))
+        self._write_object(self.CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES)
+
+        xref_offset = self._f.tell()
+        self._f.write(b"xref\n0 %d\n" % self._next_obj)
+        self._f.write(b"0000000000 65535 f \n")
+        for num in range(1, self._next_obj):
+            self._f.write(b"%010d 00000 n \n" % self._offsets[num])
+        self._f.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                      % (self._next_obj, self.CATALOG, xref_offset))
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
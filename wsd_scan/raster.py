@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# https://www.itu.int/itudoc/itu-t/com16/tiff-fx/docs/tiff6.pdf
+
+import logging
+import struct
+import typing
+from io import BytesIO
+
+from PIL import Image
+
+from . import page_codecs
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger("wsd_scan")
+
+TIFF_MAGIC = (b"II*\x00", b"MM\x00*")
+
+# the TIFF tags needed to locate the pixels of a single image
+TAG_WIDTH = 256
+TAG_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_FILL_ORDER = 266
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_X_RESOLUTION = 282
+TAG_Y_RESOLUTION = 283
+TAG_PLANAR_CONFIGURATION = 284
+TAG_RESOLUTION_UNIT = 296
+
+# field type: (struct format, size)
+TIFF_TYPES = {1: ("B", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8)}
+
+PHOTOMETRIC_WHITE_IS_ZERO = 0
+PHOTOMETRIC_BLACK_IS_ZERO = 1
+PHOTOMETRIC_RGB = 2
+
+# the PIL mode of the pixels sent by the device, for each WSD color mode
+COLOR_MODES = {"BlackAndWhite1": "1", "Grayscale8": "L", "RGB24": "RGB"}
+
+# the output formats that cannot store bilevel images
+NO_BILEVEL_FORMATS = {"jpeg", "jpg"}
+
+# the number of lines converted at once from RGB
+BAND_LINES = 64
+
+# blank page detection: the darkest paper tone expected, and the gray levels of paper grain ignored
+PAPER_MIN_LEVEL = 192
+NOISE_LEVELS = 16
+
+# color reduction: the chroma above which a pixel shows color, and the gray levels that are neither ink nor paper
+CHROMA_LEVEL = 48
+MIDTONE_RANGE = (64, 192)
+
+
+def is_available() \
+        -> bool:
+    """
+    Tell whether the raster path can be used, numpy being an optional dependency.
+
+    :return: True if numpy is installed
+    :rtype: bool
+    """
+    return numpy is not None
+
+
+def is_raw_tiff(head: bytes) \
+        -> bool:
+    """
+    Tell whether some data starts like a TIFF file.
+
+    :param head: the first bytes of the data
+    :type head: bytes
+    :return: True for a TIFF file, little or big endian
+    :rtype: bool
+    """
+    return head[:4] in TIFF_MAGIC
+
+
+class TiffInfo:
+    """
+    The properties of a single-image TIFF file needed to read its pixels, or its compressed strips, in place.
+    """
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.bits_per_sample = 1
+        self.samples_per_pixel = 1
+        self.compression = 1
+        self.photometric = PHOTOMETRIC_WHITE_IS_ZERO
+        self.fill_order = 1
+        self.planar = 1
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        self.dpi = None
+
+    @property
+    def row_bytes(self):
+        # rows start on a byte boundary
+        return (self.width * self.bits_per_sample * self.samples_per_pixel + 7) // 8
+
+
+def parse_tiff_header(data: typing.Union[bytes, memoryview]) \
+        -> TiffInfo:
+    """
+    Read the first image file directory of a TIFF file.
+
+    :param data: the TIFF file
+    :type data: bytes | memoryview
+    :return: the image properties
+    :rtype: TiffInfo
+    """
+    if bytes(data[:4]) not in TIFF_MAGIC:
+        raise ValueError("Not a TIFF file")
+    endian = "<" if bytes(data[:2]) == b"II" else ">"
+
+    def values(field_type, count, value_offset, entry):
+        fmt, size = TIFF_TYPES[field_type]
+        if size * count <= 4:
+            raw = data[entry + 8:entry + 8 + size * count]
+        else:
+            offset = struct.unpack(endian + "I", value_offset)[0]
+            raw = data[offset:offset + size * count]
+        return list(struct.unpack(endian + fmt * count, raw))
+
+    ifd = struct.unpack(endian + "I", data[4:8])[0]
+    count = struct.unpack(endian + "H", data[ifd:ifd + 2])[0]
+    tags = {}
+    for i in range(count):
+        entry = ifd + 2 + i * 12
+        tag, field_type, n = struct.unpack(endian + "HHI", data[entry:entry + 8])
+        if field_type in TIFF_TYPES:
+            tags[tag] = values(field_type, n, data[entry + 8:entry + 12], entry)
+
+    info = TiffInfo()
+    info.width = tags[TAG_WIDTH][0]
+    info.height = tags[TAG_LENGTH][0]
+    info.bits_per_sample = tags.get(TAG_BITS_PER_SAMPLE, [1])[0]
+    info.samples_per_pixel = tags.get(TAG_SAMPLES_PER_PIXEL, [1])[0]
+    info.compression = tags.get(TAG_COMPRESSION, [1])[0]
+    info.photometric = tags.get(TAG_PHOTOMETRIC, [PHOTOMETRIC_WHITE_IS_ZERO])[0]
+    info.fill_order = tags.get(TAG_FILL_ORDER, [1])[0]
+    info.planar = tags.get(TAG_PLANAR_CONFIGURATION, [1])[0]
+    info.strip_offsets = tags[TAG_STRIP_OFFSETS]
+    info.strip_byte_counts = tags[TAG_STRIP_BYTE_COUNTS]
+
+    if TAG_X_RESOLUTION in tags and tags.get(TAG_RESOLUTION_UNIT, [2])[0] in (2, 3):
+        scale = 2.54 if tags.get(TAG_RESOLUTION_UNIT, [2])[0] == 3 else 1
+        x_num, x_den = tags[TAG_X_RESOLUTION]
+        y_num, y_den = tags.get(TAG_Y_RESOLUTION, tags[TAG_X_RESOLUTION])
+        if x_den and y_den and x_num:
+            info.dpi = (x_num / x_den * scale, y_num / y_den * scale)
+    return info
+
+
+class Raster:
+    """
+    The pixels of a page, held in a numpy array: (lines, bytes per line) packed bits for bilevel
+    images, (lines, pixels) for grayscale ones and (lines, pixels, 3) for RGB ones.
+    PIL conventions apply: a 1 bit, or a 255 gray level, is white.
+    """
+
+    def __init__(self,
+                 pixels: "numpy.ndarray",
+                 width: int,
+                 mode: str,
+                 dpi: typing.Tuple[float, float] = None):
+        """
+        :param pixels: the pixels
+        :type pixels: numpy.ndarray
+        :param width: the number of pixels per line
+        :type width: int
+        :param mode: the PIL mode of the pixels, "1", "L" or "RGB"
+        :type mode: str
+        :param dpi: the horizontal and vertical resolution
+        :type dpi: (float, float)
+        """
+        self.pixels = pixels
+        self.width = width
+        self.mode = mode
+        self.dpi = dpi
+
+    @property
+    def height(self):
+        return self.pixels.shape[0]
+
+    def to_image(self) \
+            -> Image.Image:
+        """
+        Wrap the pixels in a PIL image, for the encoders. Grayscale pixels are shared, not copied.
+
+        :return: the image
+        :rtype: PIL.Image.Image
+        """
+        pixels = numpy.ascontiguousarray(self.pixels)
+        stride = pixels.strides[0]
+        return Image.frombuffer(self.mode, (self.width, self.height), pixels, "raw", self.mode, stride, 1)
+
+
+def decode_tiff_raster(data: typing.Union[bytes, memoryview],
+                       pixel_line: int = 0,
+                       num_lines: int = 0,
+                       byte_line: int = 0) \
+        -> Raster:
+    """
+    Map the strips of an uncompressed TIFF file into a numpy array, without decoding them.
+    When the strips are contiguous, as devices write them, the array is a view of the data.
+    The geometry announced in the CreateScanJobResponse is checked against the TIFF header;
+    a value of 0 (or less, for the number of lines of an ADF page of unknown length) is not checked.
+
+    :param data: the TIFF file, as bytes or a memory map
+    :type data: bytes | memoryview | mmap.mmap
+    :param pixel_line: the expected number of pixels per line
+    :type pixel_line: int
+    :param num_lines: the expected number of lines
+    :type num_lines: int
+    :param byte_line: the expected number of bytes per line
+    :type byte_line: int
+    :return: the raster of the page
+    :rtype: Raster
+    """
+    info = parse_tiff_header(data)
+    if info.compression != 1 or info.planar != 1:
+        raise ValueError("Compressed or planar TIFF files are not handled")
+    if (info.bits_per_sample, info.samples_per_pixel) not in ((1, 1), (8, 1), (8, 3)):
+        raise ValueError("Unsupported TIFF pixel layout: %d samples of %d bits"
+                         % (info.samples_per_pixel, info.bits_per_sample))
+    if pixel_line > 0 and info.width != pixel_line:
+        raise ValueError("TIFF width %d, %d pixels per line expected" % (info.width, pixel_line))
+    if num_lines > 0 and info.height != num_lines:
+        raise ValueError("TIFF height %d, %d lines expected" % (info.height, num_lines))
+    if byte_line > 0 and info.row_bytes != byte_line:
+        raise ValueError("TIFF rows of %d bytes, %d bytes per line expected" % (info.row_bytes, byte_line))
+
+    size = info.height * info.row_bytes
+    offsets, counts = info.strip_offsets, info.strip_byte_counts
+    contiguous = all(offsets[i] + counts[i] == offsets[i + 1] for i in range(len(offsets) - 1))
+    if sum(counts) < size or max(o + c for o, c in zip(offsets, counts)) > len(data):
+        raise ValueError("TIFF strips hold less than %d lines of %d bytes" % (info.height, info.row_bytes))
+
+    if contiguous:
+        flat = numpy.frombuffer(data, dtype=numpy.uint8, count=size, offset=offsets[0])
+    else:
+        flat = numpy.concatenate([numpy.frombuffer(data, dtype=numpy.uint8, count=c, offset=o)
+                                  for o, c in zip(offsets, counts)])[:size]
+    rows = flat.reshape(info.height, info.row_bytes)
+
+    if info.bits_per_sample == 1:
+        mode = "1"
+        pixels = rows
+    elif info.samples_per_pixel == 1:
+        mode = "L"
+        pixels = rows
+    else:
+        mode = "RGB"
+        pixels = rows.reshape(info.height, info.width, 3)
+
+    if info.photometric == PHOTOMETRIC_WHITE_IS_ZERO and mode != "RGB":
+        pixels = numpy.invert(pixels)
+    return Raster(pixels, info.width, mode, info.dpi)
+
+
+def _rgb_to_bands(rgb: "numpy.ndarray",
+                  mode: str) \
+        -> "numpy.ndarray":
+    # weighted sums need 32 bits per sample: they are accumulated in place, BAND_LINES lines at
+    # a time, so that the temporary array stays in the CPU cache whatever the page size
+    height, width = rgb.shape[:2]
+    out = numpy.empty((height, (width + 7) // 8 if mode == "1" else width), dtype=numpy.uint8)
+    weights = (299, 587, 114) if mode == "1" else (19595, 38470, 7471)
+    for y in range(0, height, BAND_LINES):
+        band = rgb[y:y + BAND_LINES]
+        # the products are computed in 32 bits whatever the promotion rules of the numpy version
+        acc = numpy.multiply(band[..., 0], weights[0], dtype=numpy.uint32)
+        acc += numpy.multiply(band[..., 1], weights[1], dtype=numpy.uint32)
+        acc += numpy.multiply(band[..., 2], weights[2], dtype=numpy.uint32)
+        if mode == "1":
+            # thresholded on the exact luma, as PIL does, not on the rounded gray level
+            out[y:y + BAND_LINES] = numpy.packbits(acc >= 128000, axis=1)
+        else:
+            acc += 0x8000
+            acc >>= 16
+            out[y:y + BAND_LINES] = acc
+    return out
+
+
+def convert(raster: Raster,
+            mode: str) \
+        -> Raster:
+    """
+    Convert a raster to another mode, with whole-array operations.
+    Grayscale levels use the ITU-R 601-2 luma weights, as PIL does; bilevel pages are
+    thresholded at half gray, not dithered, which keeps scanned text sharp.
+
+    :param raster: the raster to convert
+    :type raster: Raster
+    :param mode: the PIL mode to convert to, "1", "L" or "RGB"
+    :type mode: str
+    :return: the converted raster, or the same one if it already has this mode
+    :rtype: Raster
+    """
+    if raster.mode == mode:
+        return raster
+
+    if raster.mode == "RGB":
+        if mode == "1":
+            return Raster(_rgb_to_bands(raster.pixels, mode), raster.width, mode, raster.dpi)
+        gray = _rgb_to_bands(raster.pixels, "L")
+    elif raster.mode == "1":
+        gray = numpy.unpackbits(raster.pixels, axis=1, count=raster.width)
+        gray *= 255
+    else:
+        gray = raster.pixels
+
+    if mode == "L":
+        pixels = gray
+    elif mode == "1":
+        pixels = numpy.packbits(gray >= 128, axis=1)
+    else:
+        pixels = numpy.repeat(gray[..., numpy.newaxis], 3, axis=2)
+    return Raster(pixels, raster.width, mode, raster.dpi)
+
+
+def output_mode(raster: Raster,
+                profile: dict) \
+        -> str:
+    """
+    Choose the mode a page is saved in: the color mode of the profile, bilevel pages being
+    widened to grayscale for the formats that cannot store them.
+
+    :param raster: the raster received from the device
+    :type raster: Raster
+    :param profile: the scan profile in use
+    :type profile: dict
+    :return: the PIL mode to save the page in
+    :rtype: str
+    """
+    return storable_mode(COLOR_MODES.get(profile.get("color"), raster.mode), profile["image_format"])
+
+
+def storable_mode(mode: str,
+                  image_format: str) \
+        -> str:
+    """
+    Widen the bilevel mode to grayscale for the formats that cannot store bilevel images.
+
+    :param mode: the PIL mode a page should be saved in
+    :type mode: str
+    :param image_format: the PIL format the page is saved in
+    :type image_format: str
+    :return: the PIL mode the page can be saved in
+    :rtype: str
+    """
+    if mode == "1" and image_format.lower() in NO_BILEVEL_FORMATS:
+        return "L"
+    return mode
+
+
+def save_raster(data: typing.Union[bytes, memoryview],
+                profile: dict,
+                picture_file: str,
+                geometry: typing.Tuple[int, int, int] = (0, 0, 0),
+                mode: str = None) \
+        -> str:
+    """
+    Write an uncompressed TIFF page to disk, in the format requested by the profile, reading
+    the pixels in place instead of decoding the TIFF file with PIL.
+
+    :param data: the TIFF file received from the device, as bytes or a memory map
+    :type data: bytes | memoryview | mmap.mmap
+    :param profile: the scan profile in use
+    :type profile: dict
+    :param picture_file: the path of the file to write
+    :type picture_file: str
+    :param geometry: the pixels per line, lines and bytes per line announced by the device
+    :type geometry: (int, int, int)
+    :param mode: the PIL mode to save the page in, overriding the color mode of the profile
+    :type mode: str
+    :return: the mode the page was saved in
+    :rtype: str
+    """
+    raster = decode_tiff_raster(data, *geometry)
+    if mode is None:
+        mode = output_mode(raster, profile)
+    raster = convert(raster, storable_mode(mode, profile["image_format"]))
+    page_codecs.save(raster.to_image(), picture_file, profile, raster.dpi)
+    return raster.mode
+
+
+def _block_mean(pixels: "numpy.ndarray",
+                step: int) \
+        -> "numpy.ndarray":
+    # averages the step x step blocks of a (lines, pixels[, samples]) array, the incomplete ones dropped;
+    # the lines are summed first, along contiguous memory, then the columns of the much smaller result
+    h, w = pixels.shape[0] // step, pixels.shape[1] // step
+    samples = pixels.shape[2:]
+    rows = pixels[:h * step, :w * step].reshape((h, step, w * step) + samples).sum(axis=1, dtype=numpy.uint16)
+    return rows.reshape((h, w, step) + samples).sum(axis=2, dtype=numpy.uint32) // (step * step)
+
+
+def gray_thumbnail(data: typing.Union[bytes, memoryview, str],
+                   step: int = 8) \
+        -> "numpy.ndarray":
+    """
+    Get a grayscale view of a page, reduced step times in both directions by averaging the
+    pixels, so that thin strokes still show as darker areas.
+    Uncompressed TIFF files are reduced from their pixels in place; other images are reduced by
+    PIL, JPEG ones being decoded at reduced size from their DCT coefficients.
+
+    :param data: the image file received from the device, as bytes or a memory map, or its path:
+                 the files other than uncompressed TIFF are better opened by path, as reading a memory
+                 map through BytesIO would copy the whole file
+    :type data: bytes | memoryview | mmap.mmap | str
+    :param step: the reduction factor
+    :type step: int
+    :return: the gray levels of the reduced page, 255 being white
+    :rtype: numpy.ndarray
+    """
+    if not isinstance(data, str) and is_raw_tiff(bytes(data[:4])):
+        try:
+            r = decode_tiff_raster(data)
+        except ValueError:
+            r = None
+        if r is not None:
+            if r.mode == "1":
+                gray = numpy.unpackbits(r.pixels, axis=1, count=r.width)
+                gray *= 255
+                return _block_mean(gray, step).astype(numpy.uint8)
+            reduced = _block_mean(r.pixels, step).astype(numpy.uint8)
+            return convert(Raster(reduced, reduced.shape[1], r.mode), "L").pixels
+
+    with Image.open(data if isinstance(data, str) else BytesIO(data)) as img:
+        width = img.width
+        img.draft("L", (width // step, img.height // step))
+        img = img.convert("L")
+        # JPEG images are decoded at up to 1/8 scale, what remains of the step is averaged
+        rest = max(step * img.width // width, 1)
+        if rest > 1:
+            img = img.reduce(rest)
+        return numpy.asarray(img)
+
+
+def ink_coverage(gray: "numpy.ndarray",
+                 margin: float = 0.05) \
+        -> float:
+    """
+    Measure how much ink a page holds, as the share of the page that the same amount of black ink
+    would cover. The darkness of each pixel is taken relative to the paper tone, the median gray
+    level, less NOISE_LEVELS to ignore the paper grain and the compression noise. The margins,
+    where the edges of the sheet and the shadows of the feeder show, are ignored.
+
+    :param gray: the gray levels of the page, 255 being white
+    :type gray: numpy.ndarray
+    :param margin: the share of the width and of the height ignored on each side
+    :type margin: float
+    :return: the ink coverage, from 0 to 1
+    :rtype: float
+    """
+    h, w = gray.shape
+    dy, dx = int(h * margin), int(w * margin)
+    inner = gray[dy:h - dy, dx:w - dx]
+    if inner.size == 0:
+        return 0.0
+    # a page darker than PAPER_MIN_LEVEL is not paper, but a photo or a dark background
+    paper = max(int(numpy.median(inner)), PAPER_MIN_LEVEL)
+    darkness = paper - NOISE_LEVELS - inner.astype(numpy.int16)
+    numpy.clip(darkness, 0, None, out=darkness)
+    return float(darkness.sum()) / (255 * inner.size)
+
+
+def sample_pixels(data: typing.Union[bytes, memoryview, str],
+                  step: int = 4) \
+        -> "numpy.ndarray":
+    """
+    Get one RGB pixel every step pixels in both directions, not averaged: the sample keeps the
+    tones of the page as they are, where a reduced view would turn text into gray.
+    Uncompressed TIFF files are sampled in place; JPEG ones are decoded at half size, from their
+    DCT coefficients.
+
+    :param data: the image file received from the device, as bytes or a memory map, or its path,
+                 as for gray_thumbnail()
+    :type data: bytes | memoryview | mmap.mmap | str
+    :param step: the distance between the pixels sampled
+    :type step: int
+    :return: the sampled pixels, (lines, pixels, 3)
+    :rtype: numpy.ndarray
+    """
+    if not isinstance(data, str) and is_raw_tiff(bytes(data[:4])):
+        try:
+            r = decode_tiff_raster(data)
+        except ValueError:
+            r = None
+        if r is not None:
+            if r.mode == "1":
+                r = Raster(numpy.packbits(numpy.unpackbits(r.pixels[::step], axis=1, count=r.width)[:, ::step],
+                                          axis=1), (r.width + step - 1) // step, "1")
+            else:
+                r = Raster(r.pixels[::step, ::step], (r.width + step - 1) // step, r.mode)
+            return convert(r, "RGB").pixels
+
+    with Image.open(data if isinstance(data, str) else BytesIO(data)) as img:
+        width = img.width
+        img.draft("RGB", (width // 2, img.height // 2))
+        img = img.convert("RGB")
+        rest = max(step * img.width // width, 1)
+        return numpy.asarray(img)[::rest, ::rest]
+
+
+class ColorChoice:
+    """
+    The mode a color page can be stored in without visible loss, with the measures it was chosen on.
+    """
+
+    def __init__(self,
+                 mode: str,
+                 color_share: float,
+                 midtone_share: float):
+        """
+        :param mode: the PIL mode chosen, "RGB", "L" or "1"
+        :type mode: str
+        :param color_share: the share of the page showing color, from 0 to 1
+        :type color_share: float
+        :param midtone_share: the share of the page covered by areas of intermediate gray, from 0 to 1
+        :type midtone_share: float
+        """
+        self.mode = mode
+        self.color_share = color_share
+        self.midtone_share = midtone_share
+
+    def __str__(self):
+        return "%s (%.3f%% color, %.2f%% midtones)" % (self.mode, self.color_share * 100, self.midtone_share * 100)
+
+
+def choose_color_mode(rgb: "numpy.ndarray",
+                      max_color_share: float = 0.0005,
+                      max_midtone_share: float = 0.005) \
+        -> ColorChoice:
+    """
+    Choose how to store a color page, from a sample of its pixels.
+    A pixel shows color when its chroma, the spread between its strongest and weakest component,
+    exceeds CHROMA_LEVEL, which JPEG fringes and tinted paper stay below. A page with less color
+    than max_color_share is near-monochrome: it is stored bilevel if its gray levels are paper or
+    ink, otherwise in grayscale. Only the midtones surrounded by midtones count, so that the
+    blurred edges of the strokes do not turn text into a photo.
+
+    :param rgb: the sampled pixels, as returned by sample_pixels()
+    :type rgb: numpy.ndarray
+    :param max_color_share: the share of colored pixels above which the page stays in color
+    :type max_color_share: float
+    :param max_midtone_share: the share of midtone areas above which a monochrome page stays in grayscale
+    :type max_midtone_share: float
+    :return: the mode chosen and its measures
+    :rtype: ColorChoice
+    """
+    if rgb.shape[0] < 3 or rgb.shape[1] < 3:
+        return ColorChoice("RGB", 0.0, 0.0)
+    chroma = rgb.max(axis=2) - rgb.min(axis=2)
+    color_share = numpy.count_nonzero(chroma > CHROMA_LEVEL) / chroma.size
+
+    gray = convert(Raster(rgb, rgb.shape[1], "RGB"), "L").pixels
+    mid = (gray > MIDTONE_RANGE[0]) & (gray < MIDTONE_RANGE[1])
+    flat = mid[1:-1, 1:-1] & mid[:-2, 1:-1] & mid[2:, 1:-1] & mid[1:-1, :-2] & mid[1:-1, 2:]
+    midtone_share = numpy.count_nonzero(flat) / flat.size
+
+    if color_share >= max_color_share:
+        mode = "RGB"
+    elif midtone_share >= max_midtone_share:
+        mode = "L"
+    else:
+        mode = "1"
+    return ColorChoice(mode, color_share, midtone_share)
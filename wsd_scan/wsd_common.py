@@ -5,16 +5,20 @@ import datetime
 import logging
 import os
 import random
+import re
+import threading
 import time
 import typing
 import uuid
+from collections import OrderedDict
 
 logger = logging.getLogger("wsd_scan")
 
 import lxml.etree as etree
 import requests
 
-from . import wsd_globals
+from . import connection_pool, \
+    wsd_globals
 
 NSMAP = {"soap": "http://www.w3.org/2003/05/soap-envelope",
          "mex": "http://schemas.xmlsoap.org/ws/2004/09/mex",
@@ -31,7 +35,20 @@ NSMAP = {"soap": "http://www.w3.org/2003/05/soap-envelope",
 headers = {'user-agent': 'WSDAPI', 'content-type': 'application/soap+xml'}
 log_path = None
 
-parser = etree.XMLParser(remove_blank_text=True)
+# Settings of every parser reading inbound messages: no entity expansion, no DTD or network access,
+# and the default libxml2 limits on text size and entity amplification kept in force
+PARSER_OPTIONS = {"remove_blank_text": True,
+                  "resolve_entities": False,
+                  "load_dtd": False,
+                  "no_network": True,
+                  "huge_tree": False}
+
+# Kept for the callers re-parsing locally built messages (debug output, fixtures); inbound
+# messages go through parse_xml() and the per-thread parsers instead
+parser = etree.XMLParser(**PARSER_OPTIONS)
+
+# Keep-alive HTTP sessions shared by all the unicast SOAP traffic, one per device endpoint
+session_pool = connection_pool.SessionPool()
 
 
 def gen_urn() \
@@ -45,12 +62,169 @@ def gen_urn() \
     return "urn:uuid:" + str(uuid.uuid4())
 
 
-# TODO: replace dumb text substitution with xml tree manipulation
+class XmlFragment(str):
+    """
+    A template value that is already well-formed XML, and must be inserted verbatim
+    instead of being escaped as text.
+    """
+    pass
+
+
+def xml_escape(value) \
+        -> bytes:
+    """
+    Converts a template value into its XML text representation, ready to be sent.
+    Markup characters are replaced by entities, non-ASCII ones by character references.
+
+    :param value: the value to convert; XmlFragment instances are not escaped
+    :return: the encoded value
+    :rtype: bytes
+    """
+    if isinstance(value, XmlFragment):
+        return value.encode("ASCII", "xmlcharrefreplace")
+    return str(value).replace("&", "&amp;") \
+        .replace("<", "&lt;") \
+        .replace(">", "&gt;") \
+        .replace('"', "&quot;") \
+        .replace("'", "&apos;") \
+        .encode("ASCII", "xmlcharrefreplace")
+
+
+class MessageTemplate:
+    """
+    An XML template compiled into a list of literal chunks, alternated with named placeholder slots.
+    The template file is read and minified only once; filling it is then a single join.
+    """
+
+    placeholder = re.compile(r"\{\{(\w+)\}\}")
+
+    def __init__(self,
+                 text: str,
+                 name: str = ""):
+        """
+        :param text: the minified template, with {{NAME}} placeholders
+        :type text: str
+        :param name: the name of the template file, like "ws-scan__create_scan_job.xml"
+        :type name: str
+        """
+        self.name = name
+        parts = self.placeholder.split(text)
+        self.literals = [p.encode("ASCII", "xmlcharrefreplace") for p in parts[0::2]]
+        self.slots = parts[1::2]
+
+    @classmethod
+    def from_file(cls,
+                  fname: str) \
+            -> "MessageTemplate":
+        """
+        Loads an XML template file and minifies it.
+
+        :param fname: the path of the file to load
+        :type fname: str
+        :return: the compiled template
+        :rtype: MessageTemplate
+        """
+        with open(fname) as f:
+            return cls(''.join([l.strip() + '\n' for l in f.readlines()]).replace('\r', ''),
+                       os.path.basename(fname))
+
+    def bind(self,
+             **kwargs) \
+            -> "MessageTemplate":
+        """
+        Pre-renders some of the placeholders, obtaining a smaller template where only the remaining ones
+        are left to fill. MSG_ID is never bound implicitly, so every message rendered from the result
+        still gets its own id.
+
+        :param kwargs: the dictionary containing the values to render in advance
+        :return: a new compiled template
+        :rtype: MessageTemplate
+        """
+        t = MessageTemplate.__new__(MessageTemplate)
+        t.name = self.name
+        t.literals = [self.literals[0]]
+        t.slots = []
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            if slot in kwargs:
+                t.literals[-1] += xml_escape(kwargs[slot]) + literal
+            else:
+                t.slots.append(slot)
+                t.literals.append(literal)
+        return t
+
+    def render(self,
+               **kwargs) \
+            -> bytes:
+        """
+        Fills the template with the values passed in the kwargs map. MSG_ID is generated if not provided,
+        placeholders without a value are left untouched.
+
+        :param kwargs: the dictionary containing the values needed to fill the template
+        :return: the encoded xml message
+        :rtype: bytes
+        """
+        out = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            if slot in kwargs:
+                out.append(xml_escape(kwargs[slot]))
+            elif slot == "MSG_ID":
+                out.append(gen_urn().encode("ASCII"))
+            else:
+                out.append(b"{{" + slot.encode("ASCII") + b"}}")
+            out.append(literal)
+        return b"".join(out)
+
+
+templates = {}  # dict {file name, MessageTemplate}
+
+
+def load_templates() \
+        -> None:
+    """
+    Compiles all the XML templates shipped with the package, so that requests never touch the disk.
+    """
+    templates_dir = abs_path("templates")
+    for fname in os.listdir(templates_dir):
+        if fname.endswith(".xml"):
+            templates[fname] = MessageTemplate.from_file(os.path.join(templates_dir, fname))
+
+
+def get_template(xml_template: str) \
+        -> MessageTemplate:
+    """
+    Obtains a compiled template by name.
+
+    :param xml_template: the *name* of the template file, like "ws-scan__create_scan_job.xml"
+    :type xml_template: str
+    :return: the compiled template
+    :rtype: MessageTemplate
+    """
+    if xml_template not in templates:
+        templates[xml_template] = MessageTemplate.from_file(abs_path("templates/%s" % xml_template))
+    return templates[xml_template]
+
+
+def render_template(xml_template: str,
+                    **kwargs) \
+        -> bytes:
+    """
+    Fills a compiled template with values passed in the kwargs map.
+
+    :param xml_template: the *name* of the template file, like "ws-scan__create_scan_job.xml"
+    :type xml_template: str
+    :param kwargs: the dictionary containing the values needed to fill the template
+    :return: the encoded xml message
+    :rtype: bytes
+    """
+    return get_template(xml_template).render(**kwargs)
+
+
 def message_from_file(fname: str,
                       **kwargs) \
         -> str:
     """
     Loads an XML template file, minifies it, and fills it with values passed in the kwargs map.
+    Templates are compiled once and then cached: see render_template().
 
     :param fname: the path of the file to load
     :type fname: str
@@ -58,14 +232,11 @@ def message_from_file(fname: str,
     :return: a string representation of the processed xml file
     :rtype: str
     """
-    req = ''.join([l.strip() + '\n' for l in open(fname).readlines()]) \
-        .replace('\r', '')
-        #.replace('\n', '') \
-
-    for k in kwargs:
-        req = req.replace('{{' + k + '}}', str(kwargs[k]))
-    req = req.replace('{{MSG_ID}}', gen_urn())
-    return req
+    if os.path.dirname(os.path.abspath(fname)) == abs_path("templates"):
+        t = get_template(os.path.basename(fname))
+    else:
+        t = MessageTemplate.from_file(fname)
+    return t.render(**kwargs).decode("ASCII")
 
 
 def indent(text: str) \
@@ -94,7 +265,7 @@ def abs_path(relpath: str) \
 
 
 def soap_post_unicast(addr: str,
-                      data: str) \
+                      data: bytes) \
         -> typing.Union[str, None]:
     """
     Send a SOAP message as an HTTP POST request.
@@ -102,7 +273,7 @@ def soap_post_unicast(addr: str,
     :param addr: the address to send the message to
     :type addr: str
     :param data: the message content
-    :type data: str
+    :type data: bytes
     :return: the reply message, if any
     :rtype: str | None
     """
@@ -113,7 +284,7 @@ def soap_post_unicast(addr: str,
     t = random.uniform(min_delay, max_delay)
     while repeat:
         try:
-            return requests.post(addr, headers=headers, data=data, timeout=100).content
+            return session_pool.post(addr, headers=headers, data=data, timeout=100).content
         except requests.Timeout:
             logger.warning("Request to %s timed out (%d retries left)", addr, repeat - 1)
             time.sleep(t / 1000.0)
@@ -129,7 +300,7 @@ def soap_post_unicast(addr: str,
 
 
 def submit_request(addrs: typing.Set[str],
-                   xml_template: str,
+                   xml_template: typing.Union[str, MessageTemplate],
                    fields_map: typing.Dict[str, str]) \
         -> etree.ElementTree:
     """
@@ -140,18 +311,21 @@ def submit_request(addrs: typing.Set[str],
     :param addrs: the addresses of the wsd service
     :type addrs: {str}
     :param xml_template: the *name* of the template file to use as payload.\
-    Should be of the form "prefix__some_words_for_description.xml"
-    :type xml_template: str
+    Should be of the form "prefix__some_words_for_description.xml". An already compiled\
+    (and possibly partially bound) template is accepted too.
+    :type xml_template: str | MessageTemplate
     :param fields_map: the dictionary containing the values needed to fill the loaded XML template
     :type fields_map: {str: str}
     :return: the full XML response message
     :rtype: lxml.etree.ElementTree
     """
-    op_name = " ".join(xml_template.split("__")[1].split(".")[0].split("_")).upper()
-    data = message_from_file(abs_path("templates/%s" % xml_template), **fields_map)
+    if not isinstance(xml_template, MessageTemplate):
+        xml_template = get_template(xml_template)
+    op_name = " ".join(xml_template.name.split("__")[1].split(".")[0].split("_")).upper()
+    data = xml_template.render(**fields_map)
 
     if wsd_globals.debug:
-        r = etree.fromstring(data.encode("ASCII"), parser=parser)
+        r = etree.fromstring(data, parser=parser)
         logger.debug("##\n## %s REQUEST\n##\n%s", op_name,
                      etree.tostring(r, pretty_print=True, xml_declaration=True).decode("ASCII"))
 
@@ -162,7 +336,7 @@ def submit_request(addrs: typing.Set[str],
         if r is None:
             continue
 
-        x = etree.fromstring(r)
+        x = parse_xml(r)
 
         if wsd_globals.debug:
             logger.debug("##\n## %s RESPONSE\n##\n%s", op_name,
@@ -196,12 +370,70 @@ def check_fault(x: etree.ElementTree) \
         return False
 
 
+class CompiledQueries:
+    """
+    A registry of precompiled XPath expressions, keyed by the query strings used with xml_find()
+    and xml_findall(). Each query is compiled with the wsd namespaces the first time it is used,
+    instead of being tokenized again by lxml at every call.
+    The queries in use are ElementPath expressions like ".//sca:JobId", which are valid XPath too.
+    """
+
+    def __init__(self,
+                 namespaces: typing.Dict[str, str]):
+        """
+        :param namespaces: the namespace prefixes available to the queries
+        :type namespaces: {str: str}
+        """
+        self.namespaces = namespaces
+        self._first = {}  # dict {query, etree.XPath selecting the first match}
+        self._all = {}  # dict {query, etree.XPath selecting all the matches}
+
+    def first(self,
+              query: str) \
+            -> etree.XPath:
+        """
+        Obtain the compiled expression selecting the first node matching a query.
+
+        :param query: the XPath query
+        :type query: str
+        :return: the compiled expression, returning a list of at most one node
+        :rtype: etree.XPath
+        """
+        xp = self._first.get(query)
+        if xp is None:
+            xp = self._first[query] = etree.XPath("(%s)[1]" % query, namespaces=self.namespaces)
+        return xp
+
+    def all(self,
+            query: str) \
+            -> etree.XPath:
+        """
+        Obtain the compiled expression selecting all the nodes matching a query.
+
+        :param query: the XPath query
+        :type query: str
+        :return: the compiled expression, returning a list of nodes
+        :rtype: etree.XPath
+        """
+        xp = self._all.get(query)
+        if xp is None:
+            xp = self._all[query] = etree.XPath(query, namespaces=self.namespaces)
+        return xp
+
+    def __len__(self):
+        return len(self._first) + len(self._all)
+
+
+queries = CompiledQueries(NSMAP)
+
+
 def xml_find(xml_tree: etree.ElementTree,
              query: str) \
         -> typing.Union[etree.ElementTree, None]:
     """
     Wrapper for etree.find() method. When parsing wsd xml/soap messages, you should use this wrapper,
     because it encapsulates all the xml namespaces needed and avoids coding errors.
+    The query is compiled once, and reused from the queries registry afterwards.
 
     :param xml_tree: the etree element to search in
     :type xml_tree: lxml.etree.ElementTree
@@ -210,7 +442,8 @@ def xml_find(xml_tree: etree.ElementTree,
     :return: the searched etree if found, or None otherwise
     :rtype: lxml.etree.ElementTree | None
     """
-    return xml_tree.find(query, NSMAP)
+    r = queries.first(query)(xml_tree)
+    return r[0] if r else None
 
 
 def xml_findall(xml_tree: etree.ElementTree,
@@ -219,6 +452,7 @@ def xml_findall(xml_tree: etree.ElementTree,
     """
     Wrapper for etree.findall() method. When parsing wsd xml/soap messages, you should use this wrapper,
     because it encapsulates all the xml namespaces needed and avoids coding errors.
+    The query is compiled once, and reused from the queries registry afterwards.
 
     :param xml_tree: the etree element to search in
     :type xml_tree: lxml.etree.ElementTree
@@ -227,7 +461,7 @@ def xml_findall(xml_tree: etree.ElementTree,
     :return: a list of searched etrees if found, or None otherwise
     :rtype: lxml.etree.ElementTree | None
     """
-    return xml_tree.findall(query, NSMAP)
+    return queries.all(query)(xml_tree)
 
 
 def get_xml_str(xml_tree: etree.ElementTree,
@@ -338,6 +572,273 @@ def get_message_id(xml_tree: etree.ElementTree) \
     return get_xml_str(xml_tree, ".//wsa:MessageID")
 
 
+class XmlLimitError(ValueError):
+    """
+    An inbound message exceeds the size or the nesting depth allowed by the XML parsers.
+    """
+    pass
+
+
+class XmlParsers:
+    """
+    The lxml parsers reading inbound messages, one per thread.
+    A parser instance is not reentrant, and lxml serializes the threads sharing one, so the
+    listener threads, the scan workers and discovery each get their own, built on first use.
+    Every parse checks the size of the message before handing it to libxml2, and the nesting
+    depth of the resulting tree. The depth is checked after the parse, in libxml2 too, so that
+    the parse itself stays a single C call; while parsing, libxml2's own depth limit applies.
+    """
+
+    def __init__(self,
+                 max_size: int = 1024 * 1024,
+                 max_depth: int = 32):
+        """
+        :param max_size: the maximum size of a message, in bytes
+        :type max_size: int
+        :param max_depth: the maximum nesting depth of the elements, the root being at depth 1
+        :type max_depth: int
+        """
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self._local = threading.local()
+        self._depth_checks = {}  # dict {max depth, compiled XPath}
+
+    def parser(self) \
+            -> etree.XMLParser:
+        """
+        Get the parser of the calling thread.
+
+        :return: a parser configured with PARSER_OPTIONS
+        :rtype: lxml.etree.XMLParser
+        """
+        p = getattr(self._local, "parser", None)
+        if p is None:
+            p = self._local.parser = etree.XMLParser(**PARSER_OPTIONS)
+        return p
+
+    def pull_parser(self,
+                    **kwargs) \
+            -> etree.XMLPullParser:
+        """
+        Build an incremental parser with the same settings as the per-thread ones.
+
+        :param kwargs: the events and tag filter, as accepted by lxml.etree.XMLPullParser
+        :return: a new pull parser
+        :rtype: lxml.etree.XMLPullParser
+        """
+        return etree.XMLPullParser(**kwargs, **PARSER_OPTIONS)
+
+    def check_size(self,
+                   data: bytes) \
+            -> None:
+        """
+        Reject a message larger than max_size.
+
+        :param data: the message
+        :type data: bytes
+        """
+        if len(data) > self.max_size:
+            raise XmlLimitError("XML message of %d bytes exceeds the %d bytes limit" % (len(data), self.max_size))
+
+    def check_depth(self,
+                    x: etree.ElementTree) \
+            -> None:
+        """
+        Reject a tree, complete or still being parsed, nested deeper than max_depth.
+
+        :param x: any element of the tree
+        :type x: lxml.etree.ElementTree
+        """
+        max_depth = self.max_depth
+        check = self._depth_checks.get(max_depth)
+        if check is None:
+            # true if some element is nested below max_depth; evaluated in libxml2, faster than a Python walk
+            check = self._depth_checks[max_depth] = etree.XPath("boolean(/%s)" % "/".join(["*"] * (max_depth + 1)))
+        if check(x):
+            raise XmlLimitError("XML message nested deeper than %d elements" % max_depth)
+
+    def fromstring(self,
+                   data: bytes) \
+            -> etree.ElementTree:
+        """
+        Parse an inbound message with the parser of the calling thread.
+
+        :param data: the message
+        :type data: bytes
+        :return: the root of the message
+        :rtype: lxml.etree.ElementTree
+        """
+        self.check_size(data)
+        x = etree.fromstring(data, parser=self.parser())
+        self.check_depth(x)
+        return x
+
+    def configure(self,
+                  max_size: int = None,
+                  max_depth: int = None) \
+            -> None:
+        """
+        Change the limits, for all the threads.
+
+        :param max_size: the maximum size of a message, in bytes
+        :type max_size: int
+        :param max_depth: the maximum nesting depth of the elements
+        :type max_depth: int
+        """
+        if max_size is not None:
+            self.max_size = max_size
+        if max_depth is not None:
+            self.max_depth = max_depth
+
+
+# Parsers and limits for all the inbound SOAP traffic: event listeners, unicast responses, discovery
+xml_parsers = XmlParsers()
+
+
+def parse_xml(data: bytes) \
+        -> etree.ElementTree:
+    """
+    Parse an inbound message safely, with the parser of the calling thread.
+
+    :param data: the message
+    :type data: bytes
+    :return: the root of the message
+    :rtype: lxml.etree.ElementTree
+    :raises XmlLimitError: if the message is too large or too deeply nested
+    """
+    return xml_parsers.fromstring(data)
+
+
+def configure_xml_limits(max_size: int = None,
+                         max_depth: int = None) \
+        -> None:
+    """
+    Change the limits applied to inbound messages.
+
+    :param max_size: the maximum size of a message, in bytes
+    :type max_size: int
+    :param max_depth: the maximum nesting depth of the elements
+    :type max_depth: int
+    """
+    xml_parsers.configure(max_size, max_depth)
+
+
+class SoapHeaderSniffer:
+    """
+    Reads the WS-Addressing Action and MessageID of a SOAP message, parsing it incrementally only until
+    they are known, so that a large message can be rejected without building the tree of its body.
+    The ScanIdentifier of a ScanAvailableEvent is read as well, the parse going on into the body only
+    until it is found, so that a retransmitted scan request can be dropped as early.
+    The tree built while sniffing is kept: if the message is accepted, the parse goes on from there,
+    unless more than REPARSE_SIZE bytes are left. The pull parser takes about 1.5 times as long as
+    a single parse_xml() call on the same bytes, so beyond that size parsing the message again costs less.
+    Messages up to FULL_PARSE_SIZE bytes are parsed at once: below about that size, a full parse costs
+    less than sniffing, even to reject the message (see tests/bench_sniff.py).
+    """
+
+    CHUNK_SIZE = 2048
+    FULL_PARSE_SIZE = 8192
+    REPARSE_SIZE = 8 * 1024
+
+    ENVELOPE_TAG = "{%s}Envelope" % NSMAP["soap"]
+    ACTION_TAG = "{%s}Action" % NSMAP["wsa"]
+    MESSAGE_ID_TAG = "{%s}MessageID" % NSMAP["wsa"]
+    HEADER_TAG = "{%s}Header" % NSMAP["soap"]
+    SCAN_IDENTIFIER_TAG = "{%s}ScanIdentifier" % NSMAP["sca"]
+    SCAN_AVAILABLE_ACTION = "%s/ScanAvailableEvent" % NSMAP["sca"]
+
+    def __init__(self,
+                 message: bytes):
+        """
+        :param message: the SOAP message
+        :type message: bytes
+        """
+        self.message = message
+        self.action = None
+        self.message_id = None
+        self.scan_identifier = None
+        self.bytes_parsed = 0
+        self._tree = None
+        self._parser = None
+        xml_parsers.check_size(message)
+        if len(message) <= self.FULL_PARSE_SIZE:
+            self._tree = parse_xml(message)
+            header = xml_find(self._tree, "soap:Header")
+            if header is not None:
+                self._read(xml_find(header, "wsa:Action"))
+                self._read(xml_find(header, "wsa:MessageID"))
+            if self.action == self.SCAN_AVAILABLE_ACTION:
+                self._read(xml_find(self._tree, "soap:Body/sca:ScanAvailableEvent/sca:ScanIdentifier"))
+            self.bytes_parsed = len(message)
+        else:
+            # only the start of the envelope and the end of the interesting elements are reported
+            self._parser = xml_parsers.pull_parser(events=("start", "end"),
+                                                   tag=(self.ENVELOPE_TAG, self.ACTION_TAG, self.MESSAGE_ID_TAG,
+                                                        self.HEADER_TAG, self.SCAN_IDENTIFIER_TAG))
+            self._sniff()
+
+    def _read(self,
+              e: etree.ElementTree) \
+            -> None:
+        if e is None:
+            return
+        if e.tag == self.ACTION_TAG:
+            self.action = e.text.strip() if e.text else e.text
+        elif e.tag == self.MESSAGE_ID_TAG:
+            self.message_id = e.text
+        elif e.tag == self.SCAN_IDENTIFIER_TAG:
+            self.scan_identifier = e.text
+
+    def _sniff(self) \
+            -> None:
+        parser = self._parser
+        root = None
+        while self.bytes_parsed < len(self.message):
+            parser.feed(self.message[self.bytes_parsed:self.bytes_parsed + self.CHUNK_SIZE])
+            self.bytes_parsed = min(self.bytes_parsed + self.CHUNK_SIZE, len(self.message))
+            events = parser.read_events()
+            if root is None:
+                event = next(events, None)
+                if event is None or event[1].tag != self.ENVELOPE_TAG:
+                    # not a SOAP envelope, or one starting past the first chunk: nothing to sniff
+                    return
+                root = event[1]
+            # the part of the tree built so far is held to the same depth limit as a full parse
+            xml_parsers.check_depth(root)
+            for event, e in events:
+                if event == "start":
+                    continue
+                if e.tag == self.HEADER_TAG:
+                    if self.action != self.SCAN_AVAILABLE_ACTION:
+                        return
+                    continue
+                self._read(e)
+                if self.scan_identifier is not None:
+                    return
+            if self.action is not None and self.message_id is not None \
+                    and self.action != self.SCAN_AVAILABLE_ACTION:
+                return
+
+    def tree(self) \
+            -> etree.ElementTree:
+        """
+        Parse the whole message, if not done yet, going on from where the sniffing stopped.
+
+        :return: the root of the message
+        :rtype: lxml.etree.ElementTree
+        """
+        if self._tree is None:
+            if len(self.message) - self.bytes_parsed > self.REPARSE_SIZE:
+                self._tree = parse_xml(self.message)
+            else:
+                self._parser.feed(self.message[self.bytes_parsed:])
+                self._tree = self._parser.close()
+                xml_parsers.check_depth(self._tree)
+            self.bytes_parsed = len(self.message)
+            self._parser = None
+        return self._tree
+
+
 def register_message_parser(action: str,
                             msg_parser: typing.Callable) \
         -> None:
@@ -381,22 +882,123 @@ def parse(ws_msg: etree.ElementTree):
     raise NotImplementedError
 
 
-def record_message_id(msg_id: str) \
+class RecentIds:
+    """
+    A bounded, time-limited set of recently seen identifiers (message ids, scan identifiers...),
+    used to drop retransmitted messages.
+    Identifiers are kept in an OrderedDict ordered by last sighting, so lookups, insertions and
+    evictions of expired or least recently seen entries are all O(1). Thread-safe.
+    """
+
+    def __init__(self,
+                 capacity: int = 256,
+                 ttl: float = 600.0):
+        """
+        :param capacity: the maximum number of identifiers remembered
+        :type capacity: int
+        :param ttl: the number of seconds an identifier is remembered after it was last seen
+        :type ttl: float
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._ids = OrderedDict()  # {identifier, last sighting timestamp}, oldest first
+
+    def _evict(self,
+               now: float) \
+            -> None:
+        # must be called with the lock held
+        while self._ids:
+            key, seen = next(iter(self._ids.items()))
+            if now - seen <= self.ttl and len(self._ids) <= self.capacity:
+                break
+            self._ids.popitem(last=False)
+
+    def check_and_add(self,
+                      key: typing.Hashable) \
+            -> bool:
+        """
+        Record an identifier, telling whether it was already seen.
+
+        :param key: the identifier
+        :type key: hashable
+        :return: True if the identifier is new, False if it is a duplicate
+        :rtype: bool
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            new = key not in self._ids
+            if not new:
+                self.duplicates += 1
+                self._ids.move_to_end(key)
+            self._ids[key] = now
+            self._evict(now)
+            return new
+
+    def configure(self,
+                  capacity: int = None,
+                  ttl: float = None) \
+            -> None:
+        """
+        Change the store limits. Entries exceeding the new limits are evicted.
+
+        :param capacity: the maximum number of identifiers remembered
+        :type capacity: int
+        :param ttl: the number of seconds an identifier is remembered after it was last seen
+        :type ttl: float
+        """
+        with self._lock:
+            if capacity is not None:
+                self.capacity = capacity
+            if ttl is not None:
+                self.ttl = ttl
+            self._evict(time.monotonic())
+
+    def __len__(self):
+        with self._lock:
+            self._evict(time.monotonic())
+            return len(self._ids)
+
+    def clear(self) \
+            -> None:
+        with self._lock:
+            self._ids.clear()
+
+
+# Message ids (and scan identifiers) recently received, from discovery and event notifications
+message_ids = RecentIds()
+
+
+def record_message_id(msg_id: typing.Hashable) \
         -> bool:
     """
     Checks if the specified message is a duplicate, and records the id if not.
+    The ids are kept in the message_ids store, shared by discovery and the event listener.
 
     :param msg_id: the WSA message id to check
     :type msg_id: str
     :return: True if the message is not a duplicate, False otherwise.
     :rtype: bool
     """
-    if msg_id in wsd_globals.last_msg_ids:
-        return False
-    wsd_globals.last_msg_ids[wsd_globals.last_msg_idx] = msg_id
-    wsd_globals.last_msg_idx += 1
-    wsd_globals.last_msg_idx %= len(wsd_globals.last_msg_ids)
-    return True
+    if msg_id is None:
+        return True
+    return message_ids.check_and_add(msg_id)
+
+
+def configure_message_ids(capacity: int = None,
+                          ttl: float = None) \
+        -> None:
+    """
+    Change the size and the retention of the store of recently seen message ids.
+
+    :param capacity: the maximum number of ids remembered
+    :type capacity: int
+    :param ttl: the number of seconds an id is remembered after it was last seen
+    :type ttl: float
+    """
+    message_ids.configure(capacity, ttl)
 
 
 def log_xml(xml_tree: etree.ElementTree) \
@@ -413,6 +1015,20 @@ def log_xml(xml_tree: etree.ElementTree) \
     logfile.write(etree.tostring(xml_tree, pretty_print=True, xml_declaration=True).decode("ASCII"))
 
 
+def configure_session_pool(pool_size: int = None,
+                           idle_timeout: float = None) \
+        -> None:
+    """
+    Tunes the keep-alive sessions used to talk with the devices.
+
+    :param pool_size: the maximum number of idle connections kept open towards a single device
+    :type pool_size: int
+    :param idle_timeout: the number of seconds after which an unused session is closed
+    :type idle_timeout: float
+    """
+    session_pool.configure(pool_size, idle_timeout)
+
+
 def enable_debug(status: bool = True) \
         -> None:
     """
@@ -427,6 +1043,7 @@ def enable_debug(status: bool = True) \
 #######################
 
 wsd_globals.urn = gen_urn()
+load_templates()
 if log_path is not None:
     try:
         os.mkdir(log_path)
@@ -31,14 +31,13 @@ db_path = os.environ.get("WSD_CACHE_PATH", "")
 
 def send_unicast_soap_msg(target_address: str, xml_template: str,
                           fields_map: typing.Dict[str, str]) \
-        -> typing.Union[str, None]:
-    message = wsd_common.message_from_file(wsd_common.abs_path("templates/%s" % xml_template),
-                                           **fields_map)
+        -> typing.Union[bytes, None]:
+    message = wsd_common.render_template(xml_template, **fields_map)
 
     op_name = " ".join(xml_template.split("__")[1].split(".")[0].split("_")).upper()
 
     if wsd_globals.debug:
-        r = etree.fromstring(message.encode("ASCII"), parser=wsd_common.parser)
+        r = etree.fromstring(message, parser=wsd_common.parser)
         logger.debug("##\n## %s\n##\n%s", op_name,
                      etree.tostring(r, pretty_print=True, xml_declaration=True).decode("ASCII"))
 
@@ -68,7 +67,7 @@ def wsd_probe(target_address: str, probe_timeout: int = 3) \
     if r is None:
         return None
 
-    x = etree.fromstring(r)
+    x = wsd_common.parse_xml(r)
 
     if not wsd_common.record_message_id(wsd_common.get_message_id(x)):
         return None
@@ -105,7 +104,7 @@ def wsd_resolve(target_address: str, target_service: wsd_discovery__structures.T
     if r is None:
         return None
 
-    x = etree.fromstring(r)
+    x = wsd_common.parse_xml(r)
 
     if not wsd_common.record_message_id(wsd_common.get_message_id(x)):
         return None
@@ -148,12 +147,11 @@ def wsd_multicast_probe(timeout: int = 4) \
     :param timeout: seconds to wait for responses
     :return: list of discovered TargetService objects
     """
-    message = wsd_common.message_from_file(
-        wsd_common.abs_path("templates/ws-discovery__probe.xml"),
-        FROM=wsd_globals.urn)
+    message = wsd_common.render_template("ws-discovery__probe.xml",
+                                         FROM=wsd_globals.urn)
 
     if wsd_globals.debug:
-        r = etree.fromstring(message.encode("ASCII"), parser=wsd_common.parser)
+        r = etree.fromstring(message, parser=wsd_common.parser)
         logger.debug("##\n## MULTICAST PROBE\n##\n%s",
                      etree.tostring(r, pretty_print=True, xml_declaration=True).decode("ASCII"))
 
@@ -163,7 +161,7 @@ def wsd_multicast_probe(timeout: int = 4) \
     sock.settimeout(timeout)
 
     try:
-        sock.sendto(message.encode("ASCII"), (wsd_mcast_v4, wsd_udp_port))
+        sock.sendto(message, (wsd_mcast_v4, wsd_udp_port))
         devices = []
         deadline = socket.getdefaulttimeout()
         import time as _time
@@ -172,7 +170,7 @@ def wsd_multicast_probe(timeout: int = 4) \
             try:
                 sock.settimeout(end - _time.time())
                 data, addr = sock.recvfrom(65536)
-                x = etree.fromstring(data)
+                x = wsd_common.parse_xml(data)
                 action = wsd_common.get_action_id(x)
                 if action == "http://schemas.xmlsoap.org/ws/2005/04/discovery/ProbeMatches":
                     probe_matches = wsd_common.parse(x).get_target_services()
@@ -182,7 +180,7 @@ def wsd_multicast_probe(timeout: int = 4) \
                             devices.append(ts)
             except socket.timeout:
                 break
-            except etree.XMLSyntaxError:
+            except (etree.XMLSyntaxError, wsd_common.XmlLimitError):
                 continue
             except Exception as e:
                 logger.debug("Error parsing discovery response: %s", e)
@@ -45,7 +45,7 @@ def wsd_subscribe(hosted_service: wsd_transfer__structures.HostedService,
 
     expiration_tag = ""
     if expiration is not None:
-        expiration_tag = "<wse:Expires>%s</wse:Expires>" % expiration
+        expiration_tag = wsd_common.XmlFragment("<wse:Expires>%s</wse:Expires>" % expiration)
 
     fields_map = {"FROM": wsd_globals.urn,
                   "TO": hosted_service.ep_ref_addr,
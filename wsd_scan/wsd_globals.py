@@ -1,6 +1,4 @@
 message_parsers = dict()
 debug = False
 urn = ""
-last_msg_ids = ["" for i in range(0, 40)]
-last_msg_idx = 0
 scan_profiles = []
\ No newline at end of file
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import logging
+import threading
+import typing
+
+from . import wsd_common, \
+    wsd_scan__events
+
+logger = logging.getLogger("wsd_scan")
+
+RESPONSES = {202: b"Accepted",
+             400: b"Bad Request",
+             405: b"Method Not Allowed",
+             411: b"Length Required",
+             413: b"Payload Too Large"}
+
+
+def parse_request_head(head: bytes) \
+        -> typing.Tuple[str, str, str, typing.Dict[str, str]]:
+    """
+    Parse the request line and the headers of an HTTP/1.x request.
+
+    :param head: the request head, up to and including the empty line
+    :type head: bytes
+    :return: the method, the path, the HTTP version and the headers, with lowercase names
+    :rtype: (str, str, str, {str: str})
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, version = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return method, path, version, headers
+
+
+def make_response(status: int,
+                  keep_alive: bool) \
+        -> bytes:
+    """
+    Build an HTTP/1.1 response without body.
+
+    :param status: the status code
+    :type status: int
+    :param keep_alive: whether the connection stays open after the response
+    :type keep_alive: bool
+    :return: the response, ready to be written
+    :rtype: bytes
+    """
+    return b"HTTP/1.1 %d %s\r\nContent-Type: application/soap+xml\r\nContent-Length: 0\r\nConnection: %s\r\n\r\n" \
+           % (status, RESPONSES[status], b"keep-alive" if keep_alive else b"close")
+
+
+async def dispatch_event(context: dict,
+                         message: bytes,
+                         device_addr: str = None) \
+        -> None:
+    """
+    Coroutine handing an event notification to the handler of its action.
+    The handlers only parse the notification and queue its content, starting a scan worker
+    thread for ScanAvailableEvents, so they run directly on the event loop.
+
+    :param context: the listener context, holding the event queues
+    :type context: dict
+    :param message: the body of the notification
+    :type message: bytes
+    :param device_addr: the address of the device that sent the notification
+    :type device_addr: str
+    """
+    try:
+        wsd_scan__events.RequestHandler.dispatch_event(context, message, device_addr)
+    except Exception as e:
+        logger.error("Cannot handle event from %s: %s", device_addr, e)
+
+
+class AsyncEventListener:
+    """
+    The event notification listener, built on asyncio instead of one thread per connection.
+    Implements the minimal HTTP/1.1 framing the devices need: POST requests with a Content-Length,
+    keep-alive connections, and an immediate 202 reply, the notification being dispatched afterwards.
+    Connections are kept alive for up to keepalive_requests requests, as long as the next request
+    starts within keepalive_timeout seconds.
+    """
+
+    MAX_HEAD = 16 * 1024
+    MAX_BODY = 1024 * 1024
+
+    def __init__(self,
+                 server_address: typing.Tuple[str, int],
+                 context: dict,
+                 read_timeout: float = 10.0,
+                 keepalive_timeout: float = 5.0,
+                 keepalive_requests: int = 100):
+        """
+        :param server_address: the address and port to listen on
+        :type server_address: (str, int)
+        :param context: the listener context, holding the event queues
+        :type context: dict
+        :param read_timeout: the number of seconds a connection may stay silent before being closed
+        :type read_timeout: float
+        :param keepalive_timeout: the number of seconds to wait for the next request on an open connection
+        :type keepalive_timeout: float
+        :param keepalive_requests: the maximum number of requests served on a connection
+        :type keepalive_requests: int
+        """
+        self.server_address = server_address
+        self.context = context
+        self.read_timeout = read_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_requests = keepalive_requests
+        self.handled = 0
+        self.started = threading.Event()
+        self._loop = None
+        self._stop = None
+        self._tasks = set()
+
+    async def _read_request(self,
+                            reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter,
+                            device_addr: str,
+                            served: int) \
+            -> bool:
+        # handles one request, returns whether the connection can be reused
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+                                          self.keepalive_timeout if served else self.read_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return False
+        except asyncio.LimitOverrunError:
+            writer.write(make_response(400, False))
+            return False
+
+        try:
+            method, _, version, headers = parse_request_head(head)
+            length = int(headers.get("content-length", -1))
+        except ValueError:
+            writer.write(make_response(400, False))
+            return False
+        if method != "POST":
+            writer.write(make_response(405, False))
+            return False
+        if length < 0:
+            writer.write(make_response(411, False))
+            return False
+        if length > min(self.MAX_BODY, wsd_common.xml_parsers.max_size):
+            writer.write(make_response(413, False))
+            return False
+
+        try:
+            message = await asyncio.wait_for(reader.readexactly(length), self.read_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out reading the request body from %s", device_addr)
+            return False
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning("Connection from %s closed before the end of the request body", device_addr)
+            return False
+
+        self.handled += 1
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close" \
+            and served + 1 < self.keepalive_requests
+        writer.write(make_response(202, keep_alive))
+        await writer.drain()
+
+        task = self._loop.create_task(dispatch_event(self.context, message, device_addr))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return keep_alive
+
+    async def _handle_connection(self,
+                                 reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter) \
+            -> None:
+        peer = writer.get_extra_info("peername")
+        device_addr = peer[0] if peer else None
+        served = 0
+        try:
+            while await self._read_request(reader, writer, device_addr, served):
+                served += 1
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self) \
+            -> None:
+        """
+        Coroutine accepting and serving connections until shutdown() is called.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        server = await asyncio.start_server(self._handle_connection,
+                                            self.server_address[0] or None, self.server_address[1],
+                                            limit=self.MAX_HEAD, backlog=1024)
+        self.server_address = server.sockets[0].getsockname()[:2]
+        self.started.set()
+        logger.info("Listening for events on port %d (asyncio)", self.server_address[1])
+        try:
+            await self._stop.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def serve_forever(self) \
+            -> None:
+        """
+        Run the listener on a new event loop, in the calling thread.
+        """
+        asyncio.run(self.serve())
+
+    def shutdown(self) \
+            -> None:
+        """
+        Stop the listener. Can be called from any thread.
+        """
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
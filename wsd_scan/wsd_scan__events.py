@@ -1,24 +1,36 @@
 #!/usr/bin/env python3
 # -*- encoding: utf-8 -*-
 
+import concurrent.futures
 import copy
 import http.server
 import logging
+import os
 import queue
+import socket
 import threading
+import time
 import typing
 from datetime import datetime, timedelta
+from io import BytesIO
 
-import img2pdf as img2pdf
 import lxml.etree as etree
 from PIL import Image
 
+from . import connection_pool
+from . import image_encoder
+from . import job_scheduler
 from . import mail_service
+from . import page_codecs
+from . import page_spool
+from . import pdf_writer
+from . import raster
 from . import wsd_common
 from . import wsd_eventing__operations
 from . import wsd_globals
 from . import wsd_scan__operations
 from . import wsd_scan__parsers
+from . import wsd_scan__structures
 from . import wsd_transfer__structures
 from . import xml_helpers
 
@@ -28,6 +40,134 @@ token_map = {}
 host_map = {}
 profile_map = {}
 
+# maximum number of retrieved pages waiting to be saved, per scan job
+pipeline_depth = 2
+# process pool shared by all the scan jobs to encode pages, None to encode them in the save thread
+page_encoder = None
+# bytes of retrieved pages spooled to disk shared by all the scan jobs, None to retrieve pages in memory
+spool_budget = None
+# default ink coverage, in percent, below which a page is blank, for the profiles with skip_blank_pages
+BLANK_PAGE_THRESHOLD = 0.05
+# runs the scan jobs, limiting the concurrent jobs per device and in total
+scan_scheduler = job_scheduler.ScanJobScheduler()
+
+# the WS-Scan events RequestHandler.dispatch_event() has a handler for
+EVENT_ACTIONS = frozenset({"ScanAvailableEvent",
+                           "ScannerElementsChangeEvent",
+                           "ScannerStatusSummaryEvent",
+                           "ScannerStatusConditionEvent",
+                           "ScannerStatusConditionClearedEvent",
+                           "JobStatusEvent",
+                           "JobEndStateEvent"})
+# the events the scan daemon uses, the other ones are dropped as soon as their action is known
+DAEMON_ACTIONS = frozenset({"ScanAvailableEvent",
+                            "ScannerElementsChangeEvent"})
+
+
+def resolve_input_source(tkt_input_src: str,
+                         event_input_src: str = None) \
+        -> str:
+    """
+    Choose the input source to scan from.
+    The device knows what's available (paper in ADF vs Platen), so the input source reported by the
+    ScanAvailableEvent wins. Fall back to the profile's input_src if the event doesn't specify it.
+
+    :param tkt_input_src: the input source of the ticket, after profile overrides
+    :type tkt_input_src: str
+    :param event_input_src: the input source from the ScanAvailableEvent, if any
+    :type event_input_src: str
+    :return: the input source to put in CreateScanJob
+    :rtype: str
+    """
+    if event_input_src is not None:
+        return event_input_src
+    if tkt_input_src == "Auto":
+        return "ADF"
+    return tkt_input_src
+
+
+class ProfileRequestCache:
+    """
+    Pre-rendered CreateScanJob requests, one set per profile (client context).
+    The ticket of a profile only depends on the device default ticket and on the profile itself,
+    so the request is rendered once and only SCAN_ID, DEST_TOKEN and MSG_ID are filled per scan.
+    Entries are rebuilt when the default ticket in wsd_scan__operations.scanner_elements_cache
+    is replaced, and must be dropped when the profile is reloaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # dict {client context, (device ticket, base ticket, dict {input source, variant})}
+
+    def build(self,
+              client_context: str,
+              host: wsd_transfer__structures.HostedService,
+              profile: dict) \
+            -> None:
+        """
+        Compile the requests of a profile, for both the Platen and the ADF.
+
+        :param client_context: the client context identifying the profile
+        :param host: the scan service the requests will be sent to
+        :param profile: the scan profile
+        """
+        std_ticket = wsd_scan__operations.scanner_elements_cache.get(host)[3]
+        base = copy.deepcopy(std_ticket)
+        base.override_params(profile)
+        with self._lock:
+            self._entries[client_context] = (std_ticket, base, {})
+        for input_src in ("Platen", "ADF"):
+            self.get(client_context, input_src)
+
+    def get(self,
+            client_context: str,
+            input_source: str = None) \
+            -> typing.Tuple[wsd_scan__structures.ScanTicket, wsd_common.MessageTemplate]:
+        """
+        Obtain the ticket and the pre-rendered CreateScanJob request to use for a scan.
+        Missing or outdated entries are built on the fly.
+
+        :param client_context: the client context identifying the profile
+        :param input_source: the input source from the ScanAvailableEvent, if any
+        :return: a tuple of the form (ScanTicket, MessageTemplate)
+        """
+        host = host_map[client_context]
+        std_ticket = wsd_scan__operations.scanner_elements_cache.get(host)[3]
+        with self._lock:
+            entry = self._entries.get(client_context)
+        if entry is None or entry[0] is not std_ticket:
+            self.build(client_context, host, profile_map[client_context])
+            with self._lock:
+                entry = self._entries[client_context]
+        _, base, variants = entry
+        input_src = resolve_input_source(base.doc_params.input_src, input_source)
+        with self._lock:
+            if input_src in variants:
+                return variants[input_src]
+        tkt = copy.deepcopy(base)
+        tkt.doc_params.input_src = input_src
+        variant = (tkt, wsd_scan__operations.wsd_prepare_create_scan_job(host, tkt))
+        with self._lock:
+            variants[input_src] = variant
+        return variant
+
+    def invalidate(self,
+                   client_context: str = None) \
+            -> None:
+        """
+        Drop the requests of a profile, or of all the profiles.
+
+        :param client_context: the client context identifying the profile; None to drop everything
+        """
+        with self._lock:
+            if client_context is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(client_context, None)
+
+
+request_cache = ProfileRequestCache()
+
 
 def wsd_scanner_all_events_subscribe(hosted_scan_service: wsd_transfer__structures.HostedService,
                                      notify_addr: str,
@@ -219,7 +359,7 @@ def wsd_scan_available_event_subscribe(hosted_scan_service: wsd_transfer__struct
 
     expiration_tag = ""
     if expiration is not None:
-        expiration_tag = "<wse:Expires>%s</wse:Expires>" % expiration
+        expiration_tag = wsd_common.XmlFragment("<wse:Expires>%s</wse:Expires>" % expiration)
 
     fields_map = {"FROM": wsd_globals.urn,
                   "TO": hosted_scan_service.ep_ref_addr,
@@ -251,53 +391,191 @@ class QueuesSet:
 
 
 class HTTPServerWithContext(http.server.HTTPServer):
-    def __init__(self, server_address, request_handler_class, context, *args, **kw):
+    """
+    The HTTP server receiving the event notifications.
+    Requests are handled concurrently by a bounded pool of worker threads, so a slow client or
+    a large event body does not delay the other notifications. Connections that stay silent
+    for longer than the read timeout are dropped, and when too many requests are already
+    in flight new ones are rejected with 503 instead of piling up.
+    Connections are kept alive between notifications, for up to keepalive_requests requests,
+    as long as the next request starts within keepalive_timeout seconds. A connection waiting for
+    its next request holds a worker, so one is only kept alive while some worker is left for the
+    other connections.
+    """
+
+    def __init__(self, server_address, request_handler_class, context, *args,
+                 workers: int = 8,
+                 max_in_flight: int = 32,
+                 read_timeout: float = 10.0,
+                 keepalive_timeout: float = 5.0,
+                 keepalive_requests: int = 100,
+                 **kw):
+        # let bursts of connections wait in the accept queue rather than being dropped by the kernel
+        self.request_queue_size = max(max_in_flight, self.request_queue_size)
         super().__init__(server_address, request_handler_class, *args, **kw)
         self.context = context
+        self.read_timeout = read_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_requests = keepalive_requests
+        self.max_in_flight = max_in_flight
+        self.workers = workers
+        self.rejected = 0
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._connections_lock = threading.Lock()
+        self._connections = 0  # accepted connections, handled or waiting for a worker
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                               thread_name_prefix="wsd-listener")
+
+    def process_request(self, request, client_address):
+        if not self._in_flight.acquire(blocking=False):
+            self.rejected += 1
+            logger.warning("Too many requests in flight, rejecting request from %s", client_address[0])
+            try:
+                request.settimeout(1.0)
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n"
+                                b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        with self._connections_lock:
+            self._connections += 1
+        self._executor.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._connections_lock:
+                self._connections -= 1
+            self._in_flight.release()
+
+    def may_keep_alive(self) \
+            -> bool:
+        """
+        Tell whether a connection can wait for its next request, holding its worker.
+
+        :return: True if a worker is left for the other connections
+        :rtype: bool
+        """
+        with self._connections_lock:
+            return self._connections < self.workers
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
 
 
 class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 framing: connections persist unless the client or the server asks to close them
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        # applied by StreamRequestHandler to every read on the connection
+        self.timeout = self.server.read_timeout
+        self.requests_served = 0
+        super().setup()
+
+    def send_empty_response(self, code):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/soap+xml")
+        self.send_header("Content-Length", "0")
+        self.send_header("Connection", "close" if self.close_connection else "keep-alive")
+        self.end_headers()
 
     def do_POST(self):
         context = self.server.context
         # request_path = self.path
         request_headers = self.headers
+        self.requests_served += 1
+        # the head of the request has been read, the body must come without pauses
+        self.connection.settimeout(self.server.read_timeout)
+
+        if request_headers["content-length"] is None:
+            self.close_connection = True
+            self.send_empty_response(411)
+            return
         length = int(request_headers["content-length"])
+        if length > wsd_common.xml_parsers.max_size:
+            self.close_connection = True
+            self.send_empty_response(413)
+            return
 
-        message = self.rfile.read(length)
+        try:
+            message = self.rfile.read(length)
+        except socket.timeout:
+            logger.warning("Timed out reading the request body from %s", self.client_address[0])
+            self.close_connection = True
+            return
+        if len(message) < length:
+            logger.warning("Connection from %s closed before the end of the request body", self.client_address[0])
+            self.close_connection = True
+            return
 
-        self.protocol_version = "HTTP/1.1"
-        self.send_response(202)
-        self.send_header("Content-Type", "application/soap+xml")
-        self.send_header("Content-Length", "0")
-        self.send_header("Connection", "close")
-        self.end_headers()
+        if self.requests_served >= self.server.keepalive_requests or not self.server.may_keep_alive():
+            self.close_connection = True
+        self.send_empty_response(202)
+        if not self.close_connection:
+            # wait for the next notification on the same connection, for a limited time
+            self.connection.settimeout(self.server.keepalive_timeout)
+
+        self.dispatch_event(context, message, self.client_address[0])
 
-        x = etree.fromstring(message)
-        action = wsd_common.xml_find(x, ".//wsa:Action").text
-        (prefix, _, action) = action.rpartition('/')
-        if prefix != 'http://schemas.microsoft.com/windows/2006/08/wdp/scan':
+    @classmethod
+    def dispatch_event(cls, context, message, device_addr=None):
+        """
+        Parse an event notification and hand it to the handler of its action.
+
+        :param context: the listener context, holding the event queues, and optionally in "actions"
+                        the names of the events to handle, by default EVENT_ACTIONS
+        :type context: dict
+        :param message: the body of the notification
+        :type message: bytes
+        :param device_addr: the address of the device that sent the notification
+        :type device_addr: str
+        """
+        # only the SOAP header is parsed until the message is known to be wanted, and not a duplicate
+        sniffer = wsd_common.SoapHeaderSniffer(message)
+        if sniffer.action is None:
+            logger.debug("Dropping event without action from %s", device_addr)
             return
+        (prefix, _, action) = sniffer.action.rpartition('/')
+        if prefix != 'http://schemas.microsoft.com/windows/2006/08/wdp/scan' \
+                or action not in context.get("actions", EVENT_ACTIONS):
+            logger.debug("Dropping unhandled event %s from %s", sniffer.action, device_addr)
+            return
+        if not wsd_common.record_message_id(sniffer.message_id):
+            logger.debug("Dropping duplicate event %s from %s", sniffer.message_id, device_addr)
+            return
+        # a retransmitted scan request with a new MessageID still carries the same ScanIdentifier
+        if sniffer.scan_identifier is not None \
+                and not wsd_common.record_message_id(("ScanIdentifier", sniffer.scan_identifier)):
+            logger.info("Dropping duplicate scan request %s", sniffer.scan_identifier)
+            return
+        x = sniffer.tree()
         if action == 'ScanAvailableEvent':
-            self.handle_scan_available_event(x)
+            cls.handle_scan_available_event(x)
 
         elif action == 'ScannerElementsChangeEvent':
-            self.handle_scanner_elements_change_event(context['queues'], x)
+            cls.handle_scanner_elements_change_event(context['queues'], x, device_addr)
 
         elif action == 'ScannerStatusSummaryEvent':
-            self.handle_scanner_status_summary_event(context['queues'], x)
+            cls.handle_scanner_status_summary_event(context['queues'], x)
 
         elif action == 'ScannerStatusConditionEvent':
-            self.handle_scanner_status_condition_event(context['queues'], x)
+            cls.handle_scanner_status_condition_event(context['queues'], x)
 
         elif action == 'ScannerStatusConditionClearedEvent':
-            self.handle_scanner_status_condition_cleared_event(context['queues'], x)
+            cls.handle_scanner_status_condition_cleared_event(context['queues'], x)
 
         elif action == 'JobStatusEvent':
-            self.handle_job_status_event(context['queues'], x)
+            cls.handle_job_status_event(context['queues'], x)
 
         elif action == 'JobEndStateEvent':
-            self.handle_job_end_state_event(context['queues'], x)
+            cls.handle_job_end_state_event(context['queues'], x)
 
     @staticmethod
     def handle_scan_available_event(xml_tree):
@@ -309,15 +587,20 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         input_source_el = wsd_common.xml_find(xml_tree, ".//sca:InputSource")
         input_source = input_source_el.text if input_source_el is not None else None
         logger.info("Scan requested: context=%s source=%s", client_context, input_source)
-        t = threading.Thread(target=device_initiated_scan_worker,
-                             args=(client_context,
-                                   scan_identifier,
-                                   "scan-" + datetime.now().strftime("%Y-%m-%d_%H_%M_%S"),
-                                   input_source))
-        t.start()
+        if client_context not in host_map:
+            logger.warning("Scan requested for unknown context %s, ignoring", client_context)
+            return
+        # scans towards the same device are serialized, the scheduler caps the total as well
+        scan_scheduler.submit(connection_pool.SessionPool.endpoint_of(host_map[client_context].ep_ref_addr),
+                              device_initiated_scan_worker,
+                              client_context,
+                              scan_identifier,
+                              "scan-" + datetime.now().strftime("%Y-%m-%d_%H_%M_%S"),
+                              input_source,
+                              priority=profile_map.get(client_context, {}).get("priority", 0))
 
     @staticmethod
-    def handle_scanner_elements_change_event(queues, xml_tree):
+    def handle_scanner_elements_change_event(queues, xml_tree, device_addr=None):
         if wsd_globals.debug is True:
             logger.debug("SCANNER ELEMENTS CHANGE EVENT\n%s", etree.tostring(xml_tree, pretty_print=True, xml_declaration=True).decode("ASCII"))
 
@@ -325,13 +608,19 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         sca_descr = wsd_common.xml_find(xml_tree, ".//sca:ScannerDescription")
         std_ticket = wsd_common.xml_find(xml_tree, ".//sca:DefaultScanTicket")
 
-        description = wsd_scan__parsers.parse_scan_description(sca_descr)
-        configuration = wsd_scan__parsers.parse_scan_configuration(sca_config)
-        std_ticket = wsd_scan__parsers.parse_scan_ticket(std_ticket)
+        # the event only carries the elements that changed; each one is parsed when first used
+        description = configuration = None
+        if sca_descr is not None:
+            description = wsd_scan__parsers.ParsedView(wsd_scan__parsers.parse_scan_description, sca_descr)
+            queues.sc_descr_q.put(description)
+        if sca_config is not None:
+            configuration = wsd_scan__parsers.ParsedView(wsd_scan__parsers.parse_scan_configuration, sca_config)
+            queues.sc_conf_q.put(configuration)
+        if std_ticket is not None:
+            std_ticket = wsd_scan__parsers.ParsedView(wsd_scan__parsers.parse_scan_ticket, std_ticket)
+            queues.sc_ticket_q.put(std_ticket)
 
-        queues.sc_descr_q.put(description)
-        queues.sc_conf_q.put(configuration)
-        queues.sc_ticket_q.put(std_ticket)
+        wsd_scan__operations.scanner_elements_cache.update(device_addr, description, configuration, std_ticket)
 
     @staticmethod
     def handle_scanner_status_summary_event(queues, xml_tree):
@@ -543,6 +832,483 @@ class WSDScannerMonitor:
                     and self.queues.job_ended_q.empty())
 
 
+def is_passthrough_page(data: typing.Union[bytes, page_spool.PageHandle],
+                        profile: dict) \
+        -> bool:
+    """
+    Tell whether a page received from the device can be written as it is, without decoding it.
+    This is the case when the device sent a JPEG image and the profile asks for JPEG files,
+    within its max_page_bytes if any: decoding and re-encoding would only burn CPU time and lose quality.
+
+    :param data: the image data received from the device, or the handle of the spooled page
+    :type data: bytes | page_spool.PageHandle
+    :param profile: the scan profile in use
+    :type profile: dict
+    :return: True if the data can be saved and embedded in the PDF as it is
+    :rtype: bool
+    """
+    if profile.get("max_page_bytes") and page_spool.page_size(data) > profile["max_page_bytes"]:
+        return False
+    return profile["image_format"].lower() in ("jpeg", "jpg") and page_spool.page_head(data, 3) == b"\xff\xd8\xff"
+
+
+def measure_page(data: typing.Union[bytes, page_spool.PageHandle],
+                 measure: typing.Callable) \
+        -> typing.Any:
+    """
+    Apply a raster measure to a page. Spooled uncompressed TIFF pages are read in place, through a
+    memory map; the other spooled pages are given by path, for PIL to read them from their file.
+
+    :param data: the image data received from the device, or the handle of the spooled page
+    :type data: bytes | page_spool.PageHandle
+    :param measure: a function of the image file, as bytes, memory map or path, as the raster functions accept it
+    :type measure: callable
+    :return: the result of the measure
+    """
+    if not isinstance(data, page_spool.PageHandle):
+        return measure(data)
+    if raster.is_raw_tiff(page_spool.page_head(data, 4)):
+        return data.with_mmap(measure)
+    return measure(data.path)
+
+
+def blank_page_coverage(data: typing.Union[bytes, page_spool.PageHandle],
+                        profile: dict) \
+        -> typing.Union[float, None]:
+    """
+    Tell whether a page must be dropped as blank, for the profiles with skip_blank_pages.
+    The ink coverage is measured on a downsampled gray view of the page, before it is encoded,
+    and compared to the blank_page_threshold of the profile (in percent), by default BLANK_PAGE_THRESHOLD.
+
+    :param data: the image data received from the device, or the handle of the spooled page
+    :type data: bytes | page_spool.PageHandle
+    :param profile: the scan profile in use
+    :type profile: dict
+    :return: the ink coverage of the page, from 0 to 1, if it is blank, otherwise None
+    :rtype: float | None
+    """
+    if not profile.get("skip_blank_pages"):
+        return None
+    if not raster.is_available():
+        logger.warning("skip_blank_pages needs numpy, keeping the page")
+        return None
+
+    try:
+        coverage = measure_page(data, lambda page: raster.ink_coverage(raster.gray_thumbnail(page)))
+    except Exception as e:
+        logger.warning("Cannot measure the ink coverage of the page, keeping it: %s", e)
+        return None
+
+    threshold = profile.get("blank_page_threshold", BLANK_PAGE_THRESHOLD)
+    if coverage * 100 >= threshold:
+        logger.debug("Page kept, ink coverage %.3f%%", coverage * 100)
+        return None
+    return coverage
+
+
+def color_reduction(data: typing.Union[bytes, page_spool.PageHandle],
+                    profile: dict) \
+        -> typing.Union[raster.ColorChoice, None]:
+    """
+    Choose the mode to store a color page in, for the RGB24 profiles with reduce_color.
+    The chroma and the gray levels are measured on a sample of the pixels: a page without color
+    is stored in grayscale, or bilevel if it only holds text and lines. The device still scans in
+    color, as the ticket asks: only the saved file is reduced.
+
+    :param data: the image data received from the device, or the handle of the spooled page
+    :type data: bytes | page_spool.PageHandle
+    :param profile: the scan profile in use
+    :type profile: dict
+    :return: the mode chosen and its measures, or None if the page is saved as the profile says
+    :rtype: raster.ColorChoice | None
+    """
+    if not profile.get("reduce_color") or profile.get("color") != "RGB24":
+        return None
+    if not raster.is_available():
+        logger.warning("reduce_color needs numpy, keeping the page in color")
+        return None
+
+    try:
+        choice = measure_page(data, lambda page: raster.choose_color_mode(raster.sample_pixels(page)))
+    except Exception as e:
+        logger.warning("Cannot measure the colors of the page, keeping it in color: %s", e)
+        return None
+    return choice
+
+
+def is_raster_page(data: typing.Union[bytes, page_spool.PageHandle],
+                   geometry: typing.Tuple[int, int, int] = None) \
+        -> bool:
+    """
+    Tell whether a page can take the raster path: an uncompressed TIFF file whose geometry was
+    announced by the device, numpy being installed.
+
+    :param data: the image data received from the device, or the handle of the spooled page
+    :type data: bytes | page_spool.PageHandle
+    :param geometry: the pixels per line, lines and bytes per line of the job, or None if unknown
+    :type geometry: (int, int, int)
+    :return: True if the pixels can be read in place with raster.save_raster()
+    :rtype: bool
+    """
+    return geometry is not None and raster.is_available() and raster.is_raw_tiff(page_spool.page_head(data, 4))
+
+
+def save_raster_page(data: typing.Union[bytes, page_spool.PageHandle],
+                     profile: dict,
+                     picture_file: str,
+                     geometry: typing.Tuple[int, int, int],
+                     mode: str = None) \
+        -> bool:
+    """
+    Write an uncompressed TIFF page with raster.save_raster(), reading its pixels in place.
+
+    :param data: the image data received from the device, or the handle of the spooled page
+    :type data: bytes | page_spool.PageHandle
+    :param profile: the page profile, as returned by page_codecs.page_profile()
+    :type profile: dict
+    :param picture_file: the path of the file to write
+    :type picture_file: str
+    :param geometry: the pixels per line, lines and bytes per line announced by the device for the job
+    :type geometry: (int, int, int)
+    :param mode: the PIL mode to save the page in, or None to follow the profile
+    :type mode: str
+    :return: False if the TIFF file does not match the geometry, so that PIL decodes it instead
+    :rtype: bool
+    """
+    try:
+        if isinstance(data, page_spool.PageHandle):
+            mode = data.with_mmap(lambda mapped: raster.save_raster(mapped, profile, picture_file, geometry, mode))
+        else:
+            mode = raster.save_raster(data, profile, picture_file, geometry, mode)
+    except ValueError as e:
+        logger.warning("Cannot read %s in place, decoding it: %s", picture_file, e)
+        return False
+    logger.info("Raster received: %d x %d, saved as %s", geometry[0], geometry[1], mode)
+    return True
+
+
+def save_page(data: typing.Union[bytes, page_spool.PageHandle],
+              profile: dict,
+              picture_file: str,
+              geometry: typing.Tuple[int, int, int] = None,
+              mode: str = None) \
+        -> typing.Union[bytes, str]:
+    """
+    Write a page received from the device to disk, in the format requested by the profile.
+    The image is decoded with PIL only if a conversion is needed, and uncompressed TIFF pages
+    of a known geometry not even then: their pixels are read in place. A spooled passthrough
+    page is renamed to its final name, without being read; the spool file is released in any case.
+    A page given a mode, by color_reduction(), is always converted to it.
+
+    :param data: the image data received from the device, or the handle of the spooled page
+    :type data: bytes | page_spool.PageHandle
+    :param profile: the scan profile in use
+    :type profile: dict
+    :param picture_file: the path of the file to write
+    :type picture_file: str
+    :param geometry: the pixels per line, lines and bytes per line announced by the device for the job
+    :type geometry: (int, int, int)
+    :param mode: the PIL mode to save the page in, or None to follow the profile
+    :type mode: str
+    :return: the data to feed to the PDF stage: the original bytes for passthrough pages held in memory,\
+    otherwise the file path
+    :rtype: bytes | str
+    """
+    if isinstance(data, page_spool.PageHandle):
+        try:
+            if mode is None and is_passthrough_page(data, profile):
+                return data.move_to(picture_file)
+            if is_raster_page(data, geometry) and save_raster_page(data, profile, picture_file, geometry, mode):
+                return picture_file
+            with data.open() as img:
+                save_image(img, profile, picture_file, mode)
+            return picture_file
+        finally:
+            data.release()
+
+    if mode is None and is_passthrough_page(data, profile):
+        with open(picture_file, "wb") as f:
+            f.write(data)
+        return data
+
+    if is_raster_page(data, geometry) and save_raster_page(data, profile, picture_file, geometry, mode):
+        return picture_file
+
+    save_image(Image.open(BytesIO(data)), profile, picture_file, mode)
+    return picture_file
+
+
+def save_image(img: Image.Image,
+               profile: dict,
+               picture_file: str,
+               mode: str = None) \
+        -> None:
+    """
+    Write a page decoded by PIL, converting it first to the mode chosen by color_reduction(), if any.
+
+    :param img: the image of the page
+    :type img: PIL.Image.Image
+    :param profile: the page profile, as returned by page_codecs.page_profile()
+    :type profile: dict
+    :param picture_file: the path of the file to write
+    :type picture_file: str
+    :param mode: the PIL mode to save the page in, or None to follow the profile
+    :type mode: str
+    """
+    logger.info("Image received: %s %s %s", img.format, img.size, img.mode)
+    dpi = img.info.get("dpi")
+    if mode is not None:
+        img = img.convert(raster.storable_mode(mode, profile["image_format"]), dither=Image.Dither.NONE)
+    page_codecs.save(img, picture_file, profile, dpi)
+
+
+class SavedPage:
+    """
+    The record of a page written by the save stage: its sizes, and the mode chosen by color reduction.
+    """
+
+    def __init__(self,
+                 picture_file: str,
+                 received_bytes: int,
+                 color: raster.ColorChoice = None):
+        """
+        :param picture_file: the path of the file written
+        :type picture_file: str
+        :param received_bytes: the size of the image received from the device
+        :type received_bytes: int
+        :param color: the mode chosen for the page by color_reduction(), or None
+        :type color: raster.ColorChoice
+        """
+        self.picture_file = picture_file
+        self.received_bytes = received_bytes
+        self.saved_bytes = None
+        self.color = color
+
+    @property
+    def saving(self) \
+            -> float:
+        """
+        The share of the received size not written to disk, from 0 to 1, negative if the file grew.
+        """
+        if not self.received_bytes or self.saved_bytes is None:
+            return 0.0
+        return 1 - self.saved_bytes / self.received_bytes
+
+
+class PageSaveStage:
+    """
+    The save/encode stage of the scan pipeline. Pages retrieved from the device are queued and
+    written to disk by a dedicated thread, so the next page can be requested to the device while
+    the previous one is encoded.
+    The queue is bounded: when the save stage falls behind, the retrieval stage blocks, so the
+    pages held in memory never exceed the queue depth.
+    If an encoder is given, the pages to convert are encoded by its worker processes instead.
+    If a PDF file is given, every page is appended to it as soon as it is saved.
+    Pages can be queued as data or, when they were spooled to disk, as page handles.
+    The save thread also measures the pages, before saving them: blank pages are dropped, for the
+    profiles with skip_blank_pages, and the mode of color pages is chosen, for the profiles with
+    reduce_color. The files are numbered in the order of the pages kept.
+    Every page saved is recorded in saved_pages, in page order.
+    """
+
+    def __init__(self,
+                 profile: dict,
+                 file_name: str,
+                 depth: int = 2,
+                 encoder: image_encoder.ProcessPoolEncoder = None,
+                 pdf_file: str = None):
+        """
+        :param profile: the scan profile in use
+        :type profile: dict
+        :param file_name: the prefix name of the files to write
+        :type file_name: str
+        :param depth: the maximum number of pages waiting to be saved
+        :type depth: int
+        :param encoder: the process pool to encode pages with, or None to encode them in the save thread
+        :type encoder: image_encoder.ProcessPoolEncoder
+        :param pdf_file: the path of the PDF file to write, or None to write single images only
+        :type pdf_file: str
+        """
+        self.profile = profile
+        self.file_name = file_name
+        self.encoder = encoder
+        self.pdf_file = pdf_file
+        self.picture_files = []
+        self.saved_pages = []
+        self.blank_pages = 0
+        self._kept_pages = 0
+        self._pdf = None
+        self._finished = False
+        self._pending = []  # list [(saved page, future, passthrough, spooled page)], in page order
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self,
+            image_id: int,
+            data: typing.Union[bytes, page_spool.PageHandle],
+            geometry: typing.Tuple[int, int, int] = None) \
+            -> None:
+        """
+        Queue a page for saving. Blocks while the queue is full.
+
+        :param image_id: the index of the page among the ones received in the job
+        :type image_id: int
+        :param data: the image data received from the device, or the handle of the spooled page
+        :type data: bytes | page_spool.PageHandle
+        :param geometry: the pixels per line, lines and bytes per line announced by the device, if known
+        :type geometry: (int, int, int)
+        """
+        self._queue.put((image_id, data, geometry))
+
+    def finish(self) \
+            -> None:
+        """
+        Wait for every queued page to be saved, then stop the save thread and complete the PDF.
+        Only the first call does so, even if it failed: the next ones return at once.
+        """
+        if self._finished:
+            return
+        self._finished = True
+
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+        self._collect(wait=True)
+        if self._pdf is not None:
+            self._pdf.close()
+            logger.info("Saved PDF: %s (%d pages)", self.pdf_file, self._pdf.page_count)
+
+    def _collect(self,
+                 wait: bool = False) \
+            -> None:
+        # complete the saved pages in page order, appending them to the PDF
+        while self._pending and (wait or self._pending[0][1].done()):
+            saved, future, passthrough, spooled = self._pending.pop(0)
+            picture_file = saved.picture_file
+            try:
+                page, cpu_time = future.result()
+            except Exception as e:
+                logger.error("Cannot save %s: %s", picture_file, e)
+                continue
+            finally:
+                if spooled is not None:
+                    spooled.release()
+            logger.info("Saved: %s (%s, %.1f ms CPU)", picture_file,
+                        "passthrough" if passthrough else "re-encoded", cpu_time * 1000)
+            try:
+                saved.saved_bytes = os.path.getsize(picture_file)
+            except OSError:
+                pass
+            if saved.color is not None:
+                logger.info("Color reduced: %s stored as %s, %d bytes received, %s saved (%.1f%%)",
+                            picture_file, saved.color, saved.received_bytes,
+                            saved.saved_bytes, saved.saving * 100)
+            self.picture_files.append(picture_file)
+            self.saved_pages.append(saved)
+
+            if self.pdf_file is None:
+                continue
+            try:
+                if self._pdf is None:
+                    self._pdf = pdf_writer.StreamingPdfWriter(self.pdf_file, self.profile.get("resolution", 300))
+                self._pdf.add_page(page)
+            except Exception as e:
+                logger.error("Cannot add %s to %s: %s", picture_file, self.pdf_file, e)
+
+    def _save(self,
+              data: typing.Union[bytes, page_spool.PageHandle],
+              picture_file: str,
+              profile: dict,
+              geometry: typing.Tuple[int, int, int] = None,
+              mode: str = None) \
+            -> concurrent.futures.Future:
+        # raster pages are converted with whole-array operations, cheaper than a trip to the pool
+        if self.encoder is not None and (mode is not None or not is_passthrough_page(data, profile)) \
+                and not is_raster_page(data, geometry):
+            return self.encoder.submit(data, profile, picture_file, mode)
+
+        future = concurrent.futures.Future()
+        # the CPU time of the save thread only, the retrieval and the other scans run alongside
+        cpu_start = time.thread_time()
+        try:
+            future.set_result((save_page(data, profile, picture_file, geometry, mode),
+                               time.thread_time() - cpu_start))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _run(self) \
+            -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            image_id, data, geometry = item
+            # measured here rather than in the retrieval thread, so that the next page is retrieved meanwhile
+            coverage = blank_page_coverage(data, self.profile)
+            if coverage is not None:
+                self.blank_pages += 1
+                logger.info("Dropping blank page %d of %s: ink coverage %.3f%%",
+                            image_id + 1, self.file_name, coverage * 100)
+                if isinstance(data, page_spool.PageHandle):
+                    data.release()
+                self._collect()
+                continue
+            color = color_reduction(data, self.profile)
+            mode = color.mode if color is not None else None
+            # the codec, and so the file extension, can depend on the mode of the page
+            profile = page_codecs.page_profile(self.profile, mode or raster.COLOR_MODES.get(self.profile.get("color")))
+            picture_file = "%s/%s_%d.%s" % (profile["target_folder"], self.file_name, self._kept_pages,
+                                            profile["image_format"])
+            self._kept_pages += 1
+            try:
+                passthrough = mode is None and is_passthrough_page(data, profile)
+                spooled = data if isinstance(data, page_spool.PageHandle) else None
+                saved = SavedPage(picture_file, page_spool.page_size(data), color)
+                future = self._save(data, picture_file, profile, geometry, mode)
+                if spooled is not None:
+                    # give back the budget as soon as the page is saved, not when the save thread
+                    # collects it: the retrieval of the next page may be waiting for it
+                    future.add_done_callback(lambda f, page=spooled: page.release())
+                self._pending.append((saved, future, passthrough, spooled))
+            except Exception as e:
+                logger.error("Cannot save %s: %s", picture_file, e)
+                if isinstance(data, page_spool.PageHandle):
+                    data.release()
+            self._collect()
+
+
+def retrieve_page(host: wsd_transfer__structures.HostedService,
+                  job: wsd_scan__structures.ScanJob,
+                  file_name: str,
+                  folder: str) \
+        -> typing.Union[bytes, page_spool.PageHandle, None]:
+    """
+    Retrieve the next page of a job, spooled to a file of the target folder when a spool budget is
+    configured, otherwise in memory.
+
+    :param host: the wsd scan service to query
+    :type host: wsd_transfer__structures.HostedService
+    :param job: the job to retrieve the page of
+    :type job: wsd_scan__structures.ScanJob
+    :param file_name: the name assigned to the image to retrieve
+    :type file_name: str
+    :param folder: the target folder of the scan
+    :type folder: str
+    :return: the image data or the handle of the spooled page, or None if the job has no more images to send
+    :rtype: bytes | page_spool.PageHandle | None
+    """
+    if spool_budget is not None:
+        return wsd_scan__operations.wsd_retrieve_image_to_file(host, job, file_name, folder, spool_budget)
+
+    buf = BytesIO()
+    if wsd_scan__operations.wsd_retrieve_image_data(host, job, file_name, buf) is None:
+        return None
+    return buf.getvalue()
+
+
 def device_initiated_scan_worker(client_context: str,
                                  scan_identifier: str,
                                  file_name: str,
@@ -563,29 +1329,19 @@ def device_initiated_scan_worker(client_context: str,
     host = host_map[client_context]
     dest_token = token_map[client_context]
     profile = profile_map[client_context]
-    description, config, status, std_ticket = wsd_scan__operations.wsd_get_scanner_elements(host)
-
-    std_ticket.override_params(profile)
-
-    # Use the input source from the ScanAvailableEvent if provided.
-    # The device knows what's available (paper in ADF vs Platen).
-    # Fall back to the profile's input_src if the event doesn't specify.
-    if input_source is not None:
-        std_ticket.doc_params.input_src = input_source
-    elif std_ticket.doc_params.input_src == "Auto":
-        std_ticket.doc_params.input_src = "ADF"
-
-    save_format = profile["image_format"]
+    std_ticket, create_request = request_cache.get(client_context, input_source)
 
     image_id = 0
-    picture_files = []
+    pdf_file_name = "%s/%s.pdf" % (profile["target_folder"], file_name) if profile["use_pdf"] else None
+    save_stage = PageSaveStage(profile, file_name, pipeline_depth, page_encoder, pdf_file_name)
 
     more_images_available = True
 
     try:
         while more_images_available:
             try:
-                job = wsd_scan__operations.wsd_create_scan_job(host, std_ticket, scan_identifier, dest_token)
+                job = wsd_scan__operations.wsd_create_scan_job(host, std_ticket, scan_identifier, dest_token,
+                                                               prepared=create_request)
             except RuntimeError as e:
                 logger.error("CreateScanJob failed: %s", e)
                 break
@@ -594,30 +1350,27 @@ def device_initiated_scan_worker(client_context: str,
                 break
 
             try:
-                img = wsd_scan__operations.wsd_retrieve_image(host, job, file_name)
+                page = retrieve_page(host, job, file_name, profile["target_folder"])
             except Exception as e:
                 logger.error("RetrieveImage failed: %s", e)
                 break
 
-            if img == Image.NONE:
+            if page is None:
                 more_images_available = False
                 break
 
-            picture_file = "%s/%s_%d.%s" % (profile["target_folder"], file_name, image_id, save_format)
-            img.save(picture_file, format=save_format, quality=profile["quality"])
-            logger.info("Saved: %s", picture_file)
-            picture_files.append(picture_file)
+            # the page is measured and saved by the save stage, while the next one is retrieved
+            save_stage.put(image_id, page, (job.f_pixel_line, job.f_num_lines, job.f_byte_line))
             image_id += 1
 
             # Only check for more images if the ADF is used
             if std_ticket.doc_params.input_src == "Platen":
                 more_images_available = False
 
-        if picture_files and profile["use_pdf"]:
-            pdf_file_name = "%s/%s.pdf" % (profile["target_folder"], file_name)
-            with open(pdf_file_name, "wb") as f:
-                f.write(img2pdf.convert(picture_files))
-            logger.info("Saved PDF: %s", pdf_file_name)
+        save_stage.finish()
+        picture_files = save_stage.picture_files
+
+        if picture_files and pdf_file_name:
             attachments = [pdf_file_name]
         else:
             attachments = picture_files
@@ -627,3 +1380,5 @@ def device_initiated_scan_worker(client_context: str,
 
     except Exception as e:
         logger.error("Scan worker error: %s", e)
+    finally:
+        save_stage.finish()
@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 # -*- encoding: utf-8 -*-
 
-import email
+import ipaddress
 import logging
+import socket
+import threading
+import time
 import typing
 from io import BytesIO
+from urllib.parse import urlsplit
 
 import lxml.etree as etree
-import requests
 from PIL import Image, ImageSequence
 
-from . import wsd_common, \
+from . import mime_helpers, \
+    page_spool, \
+    wsd_common, \
     wsd_discovery__operations, \
     wsd_scan__parsers, \
     wsd_scan__structures, \
@@ -25,7 +30,8 @@ def wsd_get_scanner_elements(hosted_scan_service: wsd_transfer__structures.Hoste
     """
     Submit a GetScannerElements request, and parse the response.
     The device should reply with informations about itself,
-    its configuration, its status and the defalt scan ticket
+    its configuration, its status and the defalt scan ticket.
+    Each element is parsed only when first used: see wsd_scan__parsers.ParsedView.
 
     :param hosted_scan_service: the wsd scan service to query
     :type hosted_scan_service: wsd_transfer__structures.HostedService
@@ -43,14 +49,168 @@ def wsd_get_scanner_elements(hosted_scan_service: wsd_transfer__structures.Hoste
     sca_descr = wsd_common.xml_find(re, ".//sca:ScannerDescription")
     std_ticket = wsd_common.xml_find(re, ".//sca:DefaultScanTicket")
 
-    description = wsd_scan__parsers.parse_scan_description(sca_descr)
-    status = wsd_scan__parsers.parse_scan_status(sca_status)
-    config = wsd_scan__parsers.parse_scan_configuration(sca_config)
-    std_ticket = wsd_scan__parsers.parse_scan_ticket(std_ticket)
+    description = wsd_scan__parsers.ParsedView(wsd_scan__parsers.parse_scan_description, sca_descr)
+    status = wsd_scan__parsers.ParsedView(wsd_scan__parsers.parse_scan_status, sca_status)
+    config = wsd_scan__parsers.ParsedView(wsd_scan__parsers.parse_scan_configuration, sca_config)
+    std_ticket = wsd_scan__parsers.ParsedView(wsd_scan__parsers.parse_scan_ticket, std_ticket)
 
+    scanner_elements_cache.put(hosted_scan_service, description, config, status, std_ticket)
     return description, config, status, std_ticket
 
 
+def _host_addresses(hostname: str) \
+        -> typing.FrozenSet[str]:
+    """
+    Resolve the host of an endpoint to the IP addresses its notifications can come from.
+
+    :param hostname: an IP address or a host name
+    :type hostname: str
+    :return: the normalized IP addresses of the host, none if it cannot be resolved
+    :rtype: frozenset[str]
+    """
+    if not hostname:
+        return frozenset()
+    try:
+        return frozenset({_normalize_address(hostname)})
+    except ValueError:
+        pass
+    try:
+        infos = socket.getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as e:
+        logger.warning("cannot resolve %s: %s", hostname, e)
+        return frozenset()
+    return frozenset(_normalize_address(info[4][0]) for info in infos)
+
+
+def _normalize_address(addr: str) \
+        -> str:
+    """
+    Give an IP address the form it is compared in: without a scope, and as IPv4 if it is an IPv4-mapped one.
+
+    :param addr: an IP address
+    :type addr: str
+    :return: the normalized address
+    :rtype: str
+    :raises ValueError: if addr is not an IP address
+    """
+    ip = ipaddress.ip_address(addr.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return str(ip)
+
+
+class ScannerElementsCache:
+    """
+    The last known scanner elements (description, configuration, status and default ticket) of each device.
+    Entries are filled by GetScannerElements and replaced by ScannerElementsChangeEvent notifications,
+    so a scan doesn't need to query the device first. An optional TTL forces a periodic refresh, in case
+    some change event gets lost.
+    """
+
+    def __init__(self,
+                 ttl: float = None):
+        """
+        :param ttl: the number of seconds after which an entry is fetched again from the device; None to never expire
+        :type ttl: float | None
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # dict {ep_ref_addr, (elements tuple, timestamp)}
+        self._addresses = {}  # dict {ep_ref_addr, frozenset of the IP addresses of its host}
+
+    def put(self,
+            hosted_scan_service: wsd_transfer__structures.HostedService,
+            description: wsd_scan__structures.ScannerDescription,
+            config: wsd_scan__structures.ScannerConfiguration,
+            status: wsd_scan__structures.ScannerStatus,
+            std_ticket: wsd_scan__structures.ScanTicket) \
+            -> None:
+        """
+        Store the scanner elements of a device, replacing the previous ones.
+        """
+        addr = hosted_scan_service.ep_ref_addr
+        with self._lock:
+            addresses = self._addresses.get(addr)
+        if not addresses:
+            addresses = _host_addresses(urlsplit(addr).hostname)
+        with self._lock:
+            self._entries[addr] = ((description, config, status, std_ticket), time.monotonic())
+            self._addresses[addr] = addresses
+
+    def get(self,
+            hosted_scan_service: wsd_transfer__structures.HostedService):
+        """
+        Obtain the scanner elements of a device, querying it only if they are unknown or expired.
+
+        :param hosted_scan_service: the wsd scan service to query
+        :type hosted_scan_service: wsd_transfer__structures.HostedService
+        :return: a tuple of the form (ScannerDescription, ScannerConfiguration, ScannerStatus, ScanTicket)
+        """
+        with self._lock:
+            entry = self._entries.get(hosted_scan_service.ep_ref_addr)
+        if entry is not None and (self.ttl is None or time.monotonic() - entry[1] < self.ttl):
+            return entry[0]
+        return wsd_get_scanner_elements(hosted_scan_service)
+
+    def update(self,
+               device_addr: str = None,
+               description: wsd_scan__structures.ScannerDescription = None,
+               config: wsd_scan__structures.ScannerConfiguration = None,
+               std_ticket: wsd_scan__structures.ScanTicket = None) \
+            -> None:
+        """
+        Apply the content of a ScannerElementsChangeEvent to the devices at the specified network address.
+        The host of each cached endpoint is resolved when the entry is stored, so devices known by their
+        host name match too. If no cached device matches the address, only the entries whose host could
+        not be resolved are dropped, as they may be the one the event came from.
+
+        :param device_addr: the IP address the event came from
+        :type device_addr: str
+        :param description: the new scanner description, if included in the event
+        :param config: the new scanner configuration, if included in the event
+        :param std_ticket: the new default scan ticket, if included in the event
+        """
+        try:
+            device_addr = _normalize_address(device_addr)
+        except (ValueError, AttributeError):
+            pass
+        with self._lock:
+            matching = [a for a in self._entries if device_addr in self._addresses.get(a, ())]
+            if not matching:
+                unresolved = [a for a in self._entries if not self._addresses.get(a)]
+                logger.warning("ScannerElementsChangeEvent from unknown device %s, dropping %d unresolved entries",
+                               device_addr, len(unresolved))
+                for a in unresolved:
+                    del self._entries[a]
+                return
+            for a in matching:
+                (old_descr, old_config, status, old_ticket), _ = self._entries[a]
+                self._entries[a] = ((description if description is not None else old_descr,
+                                     config if config is not None else old_config,
+                                     status,
+                                     std_ticket if std_ticket is not None else old_ticket),
+                                    time.monotonic())
+
+    def invalidate(self,
+                   hosted_scan_service: wsd_transfer__structures.HostedService = None) \
+            -> None:
+        """
+        Drop the cached elements of a device, or of all the devices.
+
+        :param hosted_scan_service: the wsd scan service to forget; None to drop everything
+        """
+        with self._lock:
+            if hosted_scan_service is None:
+                self._entries.clear()
+                self._addresses.clear()
+            else:
+                self._entries.pop(hosted_scan_service.ep_ref_addr, None)
+                self._addresses.pop(hosted_scan_service.ep_ref_addr, None)
+
+
+scanner_elements_cache = ScannerElementsCache()
+
+
 def wsd_validate_scan_ticket(hosted_scan_service: wsd_transfer__structures.HostedService,
                              tkt: wsd_scan__structures.ScanTicket) \
         -> typing.Tuple[bool, wsd_scan__structures.ScanTicket]:
@@ -93,10 +253,31 @@ def wsd_validate_scan_ticket(hosted_scan_service: wsd_transfer__structures.Hoste
             return False, tkt
 
 
+def wsd_prepare_create_scan_job(hosted_scan_service: wsd_transfer__structures.HostedService,
+                                tkt: wsd_scan__structures.ScanTicket) \
+        -> wsd_common.MessageTemplate:
+    """
+    Pre-render a CreateScanJob request for a certain ticket.
+    Only the scan identifier, the destination token and the message id are left to fill,
+    so the returned template can be reused for every scan sharing the same ticket.
+
+    :param hosted_scan_service: the wsd scan service the request will be sent to
+    :type hosted_scan_service: wsd_transfer__structures.HostedService
+    :param tkt: the ScanTicket to embed in the request
+    :type tkt: wsd_scan__structures.ScanTicket
+    :return: the partially rendered request
+    :rtype: wsd_common.MessageTemplate
+    """
+    fields = {"FROM": wsd_globals.urn,
+              "TO": hosted_scan_service.ep_ref_addr}
+    return wsd_common.get_template("ws-scan__create_scan_job.xml").bind(**fields, **tkt.as_map())
+
+
 def wsd_create_scan_job(hosted_scan_service: wsd_transfer__structures.HostedService,
                         tkt: wsd_scan__structures.ScanTicket,
                         scan_identifier: str = "",
-                        dest_token: str = "") \
+                        dest_token: str = "",
+                        prepared: wsd_common.MessageTemplate = None) \
         -> wsd_scan__structures.ScanJob:
     """
     Submit a CreateScanJob request, and parse the response.
@@ -110,17 +291,19 @@ def wsd_create_scan_job(hosted_scan_service: wsd_transfer__structures.HostedServ
     :type scan_identifier: str
     :param dest_token: a token assigned by the scanner to this client, needed for device-initiated scans
     :type dest_token: str
+    :param prepared: the request pre-rendered for tkt by wsd_prepare_create_scan_job(), if available
+    :type prepared: wsd_common.MessageTemplate
     :return: a ScanJob instance
     :rtype: wsd_scan__structures.ScanJob
     """
 
-    fields = {"FROM": wsd_globals.urn,
-              "TO": hosted_scan_service.ep_ref_addr,
-              "SCAN_ID": scan_identifier,
+    if prepared is None:
+        prepared = wsd_prepare_create_scan_job(hosted_scan_service, tkt)
+    fields = {"SCAN_ID": scan_identifier,
               "DEST_TOKEN": dest_token}
     x = wsd_common.submit_request({hosted_scan_service.ep_ref_addr},
-                                  "ws-scan__create_scan_job.xml",
-                                  {**fields, **tkt.as_map()})
+                                  prepared,
+                                  fields)
 
     if wsd_common.check_fault(x):
         subcode = wsd_common.get_xml_str(x, ".//soap:Subcode/soap:Value")
@@ -239,15 +422,15 @@ def wsd_get_job_history(hosted_scan_service: wsd_transfer__structures.HostedServ
     return jsl
 
 
-def wsd_retrieve_image(hosted_scan_service: wsd_transfer__structures.HostedService,
-                       job: wsd_scan__structures.ScanJob,
-                       docname: str) \
-        -> Image.Image:
+def wsd_retrieve_image_data(hosted_scan_service: wsd_transfer__structures.HostedService,
+                            job: wsd_scan__structures.ScanJob,
+                            docname: str,
+                            sink: typing.BinaryIO) \
+        -> typing.Union[str, None]:
     """
-    Submit a RetrieveImage request, and parse the response.
-    Retrieves a single image from the scanner, if the job has available images to send. If the file format
-    selected in the scan ticket was multipage, retrieves a batch of images instead.
-    Usually the client has approx. 60 seconds to start images acquisition after the creation of a job.
+    Submit a RetrieveImage request, and stream the image contained in the response into a sink.
+    The MTOM/XOP response is parsed while it is received, so the image is never held in memory
+    as a whole, unless the sink does it.
 
     :param hosted_scan_service: the wsd scan service to query
     :type hosted_scan_service: wsd_transfer__structures.HostedService
@@ -255,53 +438,127 @@ def wsd_retrieve_image(hosted_scan_service: wsd_transfer__structures.HostedServi
     :type job: wsd_scan__structures.ScanJob
     :param docname: the name assigned to the image to retrieve.
     :type docname: str
-    :return: the number of images retrieved, and an array of images
-    :rtype: (int, list[PIL.Image])
+    :param sink: a writable binary object (a file, a BytesIO...) receiving the image data
+    :return: the content type of the image part, or None if the job has no more images to send
+    :rtype: str | None
     """
 
-    data = wsd_common.message_from_file(wsd_common.abs_path("templates/ws-scan__retrieve_image.xml"),
-                                        FROM=wsd_globals.urn,
-                                        TO=hosted_scan_service.ep_ref_addr,
-                                        JOB_ID=job.id,
-                                        JOB_TOKEN=job.token,
-                                        DOC_DESCR=docname)
+    data = wsd_common.render_template("ws-scan__retrieve_image.xml",
+                                      FROM=wsd_globals.urn,
+                                      TO=hosted_scan_service.ep_ref_addr,
+                                      JOB_ID=job.id,
+                                      JOB_TOKEN=job.token,
+                                      DOC_DESCR=docname)
 
     if wsd_globals.debug:
-        r = etree.fromstring(data.encode("ASCII"), parser=wsd_common.parser)
+        r = etree.fromstring(data, parser=wsd_common.parser)
         logger.debug("##\n## RETRIEVE IMAGE REQUEST\n##\n%s",
                      etree.tostring(r, pretty_print=True, xml_declaration=True).decode("ASCII"))
 
-    r = requests.post(hosted_scan_service.ep_ref_addr, headers=wsd_common.headers, data=data)
+    with wsd_common.session_pool.post(hosted_scan_service.ep_ref_addr,
+                                      headers=wsd_common.headers,
+                                      data=data,
+                                      stream=True) as r:
+        boundary = mime_helpers.get_boundary(r.headers.get("Content-Type", ""))
+
+        if boundary is None:
+            x = wsd_common.parse_xml(r.content)
+            q = wsd_common.xml_find(x, ".//soap:Fault")
+            if q is not None:
+                e = wsd_common.get_xml_str(q, ".//soap:Code/soap:Subcode/soap:Value")
+                if e == "wscn:ClientErrorNoImagesAvailable":
+                    return None
+                reason = wsd_common.get_xml_str(q, ".//soap:Reason/soap:Text")
+                raise RuntimeError("RetrieveImage rejected: %s — %s" % (e, reason))
+            raise RuntimeError("RetrieveImage: the response contains no image")
+
+        envelope = BytesIO()
+
+        def part_sink(index, headers):
+            if index == 0:
+                return envelope
+            if index == 1:
+                return sink
+            logger.warning("RetrieveImage: ignoring unexpected MIME part #%d", index)
+            return None
+
+        mp = mime_helpers.MultipartStreamParser(boundary, part_sink)
+        for chunk in r.iter_content(chunk_size=64 * 1024):
+            mp.feed(chunk)
+        mp.close()
 
-    try:
-        x = etree.XML(r.content)
-        q = wsd_common.xml_find(x, ".//soap:Fault")
-        if q is not None:
-            e = wsd_common.xml_find(q, ".//soap:Code/soap:Subcode/soap:Value").text
-            if e == "wscn:ClientErrorNoImagesAvailable":
-                return Image.NONE
-    except etree.ParseError:
-        boundaryValue = ""
-        msgHeaders = r.headers['Content-Type'].split(";")
-        for msgHeader in msgHeaders:
-            msgHeaderParts = msgHeader.split("=")
-            if msgHeaderParts[0] == "boundary":
-                boundaryValue = msgHeaderParts[1]
-                break
+    if wsd_globals.debug:
+        logger.debug("##\n## RETRIEVE IMAGE RESPONSE\n##\n%s", envelope.getvalue().decode("utf-8", "replace"))
+
+    if len(mp.parts) < 2:
+        raise RuntimeError("RetrieveImage: the response contains no image")
+    return mp.parts[1][0].get_content_type()
 
-        boundaryValueBytes = ("--"+boundaryValue).encode("utf-8")
-        boundaryValueBytesWithLineBreak = ("\r\n--"+boundaryValue).encode("utf-8")
 
-        content_with_header = b'MIME-Version: 1.0\r\nContent-type: ' + r.headers['Content-Type'].encode('ascii') + b'\r\n' + r.content.replace(boundaryValueBytes, boundaryValueBytesWithLineBreak)
-        m = email.message_from_bytes(content_with_header)
+def wsd_retrieve_image_to_file(hosted_scan_service: wsd_transfer__structures.HostedService,
+                              job: wsd_scan__structures.ScanJob,
+                              docname: str,
+                              folder: str,
+                              budget: page_spool.SpoolBudget = None) \
+        -> typing.Union[page_spool.PageHandle, None]:
+    """
+    Submit a RetrieveImage request, and spool the image contained in the response to a temporary file.
+    Waits first for the budget to allow a new retrieval; the received bytes are charged to it until
+    the returned page is released or moved to its final place.
+
+    :param hosted_scan_service: the wsd scan service to query
+    :type hosted_scan_service: wsd_transfer__structures.HostedService
+    :param job: the ScanJob instance representing the queried job.
+    :type job: wsd_scan__structures.ScanJob
+    :param docname: the name assigned to the image to retrieve.
+    :type docname: str
+    :param folder: the folder of the spool file, usually the target folder of the scan
+    :type folder: str
+    :param budget: the byte budget shared by the retrievals of the process, or None for no limit
+    :type budget: page_spool.SpoolBudget
+    :return: the handle of the spooled page, or None if the job has no more images to send
+    :rtype: page_spool.PageHandle | None
+    """
+    spooler = page_spool.PageSpooler(folder, budget)
+    try:
+        content_type = wsd_retrieve_image_data(hosted_scan_service, job, docname, spooler)
+    except BaseException:
+        spooler.discard()
+        raise
+
+    if content_type is None:
+        spooler.discard()
+        return None
+    page = spooler.close(content_type)
+    logger.info("Image spooled: %s (%d bytes)", content_type, page.size)
+    return page
 
-        ls = list(m.walk())
 
-        if wsd_globals.debug:
-            logger.debug("##\n## RETRIEVE IMAGE RESPONSE\n##\n%s", ls[1])
+def wsd_retrieve_image(hosted_scan_service: wsd_transfer__structures.HostedService,
+                       job: wsd_scan__structures.ScanJob,
+                       docname: str) \
+        -> Image.Image:
+    """
+    Submit a RetrieveImage request, and parse the response.
+    Retrieves a single image from the scanner, if the job has available images to send. If the file format
+    selected in the scan ticket was multipage, retrieves a batch of images instead.
+    Usually the client has approx. 60 seconds to start images acquisition after the creation of a job.
 
-        img = Image.open(BytesIO(ls[2].get_payload(decode=True)))
-        logger.info("Image received: %s %s %s", img.format, img.size, img.mode)
+    :param hosted_scan_service: the wsd scan service to query
+    :type hosted_scan_service: wsd_transfer__structures.HostedService
+    :param job: the ScanJob instance representing the queried job.
+    :type job: wsd_scan__structures.ScanJob
+    :param docname: the name assigned to the image to retrieve.
+    :type docname: str
+    :return: the image retrieved, or PIL.Image.NONE if the job has no more images to send
+    :rtype: PIL.Image.Image
+    """
+    buf = BytesIO()
+    if wsd_retrieve_image_data(hosted_scan_service, job, docname, buf) is None:
+        return Image.NONE
 
-        return img
+    buf.seek(0)
+    img = Image.open(buf)
+    logger.info("Image received: %s %s %s", img.format, img.size, img.mode)
 
+    return img
@@ -2,6 +2,7 @@
 # -*- encoding: utf-8 -*-
 
 import copy
+import threading
 
 from . import wsd_common, \
     wsd_scan__structures
@@ -10,92 +11,202 @@ from . import wsd_common, \
 # try to use declxml https://github.com/gatkin/declxml
 # NB: declxml do not support namespaces AFAIK
 
+# The ticket and configuration parsers walk each subtree once, dispatching every element on its tag
+# through a table of rules that fill the structures. When a tag has no rule, the walk goes on with
+# the descendants of the element, like the ".//" searches the rules replace: the first match in
+# document order sets a value, every match is appended to a list. The rules of the steps of a path,
+# like sca:Resolution/sca:Width, only look at the direct children.
+
+def _text(text):
+    return text
+
+
+def _bool(text):
+    return True if text == 'true' or text == '1' else False
+
+
+def _tag(name):
+    prefix, _, local = name.rpartition(":")
+    return "{%s}%s" % (wsd_common.NSMAP[prefix], local)
+
+
+def _table(rules):
+    # dict {prefix:name, rule} -> dict {Clark tag, rule}
+    return {_tag(name): rule for name, rule in rules.items()}
+
+
+def _walk(elem, table, dest, seen, deep=True):
+    # seen holds the keys of the values already set on dest
+    for child in elem:
+        rule = table.get(child.tag)
+        if rule is not None:
+            rule(child, dest, seen)
+        elif deep and len(child):
+            _walk(child, table, dest, seen)
+
+
+def _field(attr, convert=_text):
+    def rule(e, dest, seen):
+        if attr not in seen:
+            seen.add(attr)
+            setattr(dest, attr, convert(e.text))
+    return rule
+
+
+def _item(attr, i):
+    # an integer member of a tuple, like the width of a (width, height) pair
+    key = (attr, i)
+
+    def rule(e, dest, seen):
+        if key not in seen:
+            seen.add(key)
+            v = list(getattr(dest, attr))
+            v[i] = int(e.text)
+            setattr(dest, attr, tuple(v))
+    return rule
+
+
+def _values(attr):
+    def rule(e, dest, seen):
+        if attr not in seen:
+            seen.add(attr)
+            setattr(dest, attr, [])
+        getattr(dest, attr).append(e.text)
+    return rule
+
+
+def _children(rules, deep=False):
+    table = _table(rules)
+
+    def rule(e, dest, seen):
+        _walk(e, table, dest, seen, deep)
+    return rule
+
+
+def _object(attr, factory, rules, finish=None):
+    table = _table(rules)
+
+    def rule(e, dest, seen):
+        if attr not in seen:
+            seen.add(attr)
+            obj = factory()
+            _walk(e, table, obj, set())
+            if finish is not None:
+                finish(obj)
+            setattr(dest, attr, obj)
+    return rule
+
+
+def _size(attr, name):
+    return _children({"sca:%s" % name: _children({"sca:Width": _item(attr, 0), "sca:Height": _item(attr, 1)})})
+
+
+def _finish_document_params(dest):
+    if dest.front is not None and dest.back is None:
+        dest.back = copy.deepcopy(dest.front)
+
+
+MEDIA_SIDE_RULES = {
+    "sca:ScanRegion": _children({"sca:ScanRegionXOffset": _item("offset", 0),
+                                 "sca:ScanRegionYOffset": _item("offset", 1),
+                                 "sca:ScanRegionWidth": _item("size", 0),
+                                 "sca:ScanRegionHeight": _item("size", 1)}, deep=True),
+    "sca:ColorProcessing": _field("color"),
+    "sca:Resolution": _children({"sca:Width": _item("res", 0),
+                                 "sca:Height": _item("res", 1)})}
+
+DOCUMENT_PARAMS_RULES = {
+    "sca:Format": _field("format"),
+    "sca:CompressionQualityFactor": _field("compression_factor"),
+    "sca:ImagesToTransfer": _field("images_num", int),
+    "sca:InputSource": _field("input_src"),
+    "sca:ContentType": _field("content_type"),
+    "sca:InputSize": _children({"sca:DocumentAutoDetect": _field("size_autodetect", _bool),
+                                "sca:InputMediaSize": _children({"sca:Width": _item("input_size", 0),
+                                                                 "sca:Height": _item("input_size", 1)})},
+                               deep=True),
+    "sca:Exposure": _children({"sca:AutoExposure": _field("auto_exposure", _bool),
+                               "sca:ExposureSettings": _children({"sca:Contrast": _field("contrast", int),
+                                                                  "sca:Brightness": _field("brightness", int),
+                                                                  "sca:Sharpness": _field("sharpness", int)})},
+                              deep=True),
+    "sca:Scaling": _children({"sca:ScalingWidth": _item("scaling", 0),
+                              "sca:ScalingHeight": _item("scaling", 1)}, deep=True),
+    "sca:Rotation": _field("rotation", int),
+    "sca:MediaSides": _children({"sca:MediaFront": _object("front", wsd_scan__structures.MediaSide,
+                                                           MEDIA_SIDE_RULES),
+                                 "sca:MediaBack": _object("back", wsd_scan__structures.MediaSide,
+                                                          MEDIA_SIDE_RULES)}, deep=True)}
+
+SCAN_TICKET_RULES = {
+    "sca:JobDescription": _children({"sca:JobName": _field("job_name"),
+                                     "sca:JobOriginatingUserName": _field("job_user_name"),
+                                     "sca:JobInformation": _field("job_info")}, deep=True),
+    "sca:DocumentParameters": _object("doc_params", wsd_scan__structures.DocumentParams,
+                                      DOCUMENT_PARAMS_RULES, _finish_document_params)}
+
+SCANNER_SETTINGS_RULES = {
+    "sca:FormatsSupported": _children({"sca:FormatValue": _values("formats")}),
+    "sca:CompressionQualityFactorSupported": _children({"sca:MinValue": _item("compression_factor", 0),
+                                                        "sca:MaxValue": _item("compression_factor", 1)}),
+    "sca:ContentTypesSupported": _children({"sca:ContentTypeValue": _values("content_types")}),
+    "sca:DocumentSizeAutoDetectSupported": _field("size_autodetect_sup", _bool),
+    "sca:AutoExposureSupported": _field("auto_exposure_sup", _bool),
+    "sca:BrightnessSupported": _field("brightness_sup", _bool),
+    "sca:ContrastSupported": _field("contrast_sup", _bool),
+    "sca:ScalingRangeSupported": _children({"sca:ScalingWidth": _children({"sca:MinValue": _item("scaling_range_w", 0),
+                                                                           "sca:MaxValue": _item("scaling_range_w", 1)}),
+                                            "sca:ScalingHeight": _children({"sca:MinValue": _item("scaling_range_h", 0),
+                                                                            "sca:MaxValue": _item("scaling_range_h", 1)})}),
+    "sca:RotationsSupported": _children({"sca:RotationValue": _values("rotations")})}
+
+
+def _source_settings_rules(name):
+    # name is the source: Platen, ADF or Film
+    return {"sca:%sOpticalResolution" % name: _children({"sca:Width": _item("optical_res", 0),
+                                                         "sca:Height": _item("optical_res", 1)}),
+            "sca:%sResolutions" % name: _children({"sca:Widths": _children({"sca:Width": _values("width_res")}),
+                                                   "sca:Heights": _children({"sca:Height": _values("height_res")})}),
+            "sca:%sColor" % name: _children({"sca:ColorEntry": _values("color_modes")}),
+            "sca:%sMinimumSize" % name: _children({"sca:Width": _item("min_size", 0),
+                                                   "sca:Height": _item("min_size", 1)}),
+            "sca:%sMaximumSize" % name: _children({"sca:Width": _item("max_size", 0),
+                                                   "sca:Height": _item("max_size", 1)})}
+
+
+# sca:Film omitted
+SCAN_CONFIGURATION_RULES = {
+    "sca:DeviceSettings": _object("settings", wsd_scan__structures.ScannerSettings, SCANNER_SETTINGS_RULES),
+    "sca:Platen": _object("platen", wsd_scan__structures.ScannerSourceSettings, _source_settings_rules("Platen")),
+    "sca:ADF": _children({"sca:ADFSupportsDuplex": _field("adf_duplex", _bool),
+                          "sca:ADFFront": _object("front_adf", wsd_scan__structures.ScannerSourceSettings,
+                                                  _source_settings_rules("ADF")),
+                          "sca:ADFBack": _object("back_adf", wsd_scan__structures.ScannerSourceSettings,
+                                                 _source_settings_rules("ADF"))}, deep=True)}
+
+_tables = {"media_side": _table(MEDIA_SIDE_RULES),
+           "document_params": _table(DOCUMENT_PARAMS_RULES),
+           "scan_ticket": _table(SCAN_TICKET_RULES),
+           "scan_configuration": _table(SCAN_CONFIGURATION_RULES)}
+_source_settings_tables = {}  # dict {source name, table}
+
+
 def parse_scan_ticket(std_ticket):
     st = wsd_scan__structures.ScanTicket()
-    st.job_name = wsd_common.xml_find(std_ticket, ".//sca:JobDescription/sca:JobName").text
-    st.job_user_name = wsd_common.xml_find(std_ticket, ".//sca:JobDescription/sca:JobOriginatingUserName").text
-    q = wsd_common.xml_find(std_ticket, ".//sca:JobDescription/sca:JobInformation")
-    if q is not None:
-        st.job_info = q.text
-    dps = wsd_common.xml_find(std_ticket, ".//sca:DocumentParameters")
-    st.doc_params = parse_document_params(dps)
+    _walk(std_ticket, _tables["scan_ticket"], st, set())
     return st
 
 
 def parse_media_side(ms):
     s = wsd_scan__structures.MediaSide()
-    r = wsd_common.xml_find(ms, ".//sca:ScanRegion")
-    if r is not None:
-        q = wsd_common.xml_find(r, ".//sca:ScanRegionXOffset")
-        if q is not None:
-            s.offset = (int(q.text), s.offset[1])
-        q = wsd_common.xml_find(r, ".//sca:ScanRegionYOffset")
-        if q is not None:
-            s.offset = (s.offset[0], int(q.text))
-        v1 = wsd_common.xml_find(r, ".//sca:ScanRegionWidth")
-        v2 = wsd_common.xml_find(r, ".//sca:ScanRegionHeight")
-        s.size = (int(v1.text), int(v2.text))
-    q = wsd_common.xml_find(ms, ".//sca:ColorProcessing")
-    if q is not None:
-        s.color = q.text
-    q = wsd_common.xml_find(ms, ".//sca:Resolution/sca:Width")
-    s.res = (int(q.text), s.res[1])
-    q = wsd_common.xml_find(ms, ".//sca:Resolution/sca:Height")
-    s.res = (s.res[0], int(q.text))
+    _walk(ms, _tables["media_side"], s, set())
     return s
 
 
 def parse_document_params(dps):
     dest = wsd_scan__structures.DocumentParams()
-    q = wsd_common.xml_find(dps, ".//sca:Format")
-    if q is not None:
-        dest.format = q.text
-    q = wsd_common.xml_find(dps, ".//sca:CompressionQualityFactor")
-    if q is not None:
-        dest.compression_factor = q.text
-    q = wsd_common.xml_find(dps, ".//sca:ImagesToTransfer")
-    if q is not None:
-        dest.images_num = int(q.text)
-    q = wsd_common.xml_find(dps, ".//sca:InputSource")
-    if q is not None:
-        dest.input_src = q.text
-    q = wsd_common.xml_find(dps, ".//sca:ContentType")
-    if q is not None:
-        dest.content_type = q.text
-    q = wsd_common.xml_find(dps, ".//sca:InputSize")
-    if q is not None:
-        autod = wsd_common.xml_find(q, ".//sca:DocumentAutoDetect")
-        if autod is not None:
-            dest.size_autodetect = True if autod.text == 'true' or autod.text == '1' else False
-        v1 = wsd_common.xml_find(q, ".//sca:InputMediaSize/sca:Width")
-        v2 = wsd_common.xml_find(q, ".//sca:InputMediaSize/sca:Height")
-        dest.input_size = (int(v1.text), int(v2.text))
-    q = wsd_common.xml_find(dps, ".//sca:Exposure")
-    if q is not None:
-        autod = wsd_common.xml_find(q, ".//sca:AutoExposure")
-        if autod is not None:
-            dest.auto_exposure = True if autod.text == 'true' or autod.text == '1' else False
-        dest.contrast = int(wsd_common.xml_find(q, ".//sca:ExposureSettings/sca:Contrast").text)
-        dest.brightness = int(wsd_common.xml_find(q, ".//sca:ExposureSettings/sca:Brightness").text)
-        dest.sharpness = int(wsd_common.xml_find(q, ".//sca:ExposureSettings/sca:Sharpness").text)
-    q = wsd_common.xml_find(dps, ".//sca:Scaling")
-    if q is not None:
-        v1 = wsd_common.xml_find(q, ".//sca:ScalingWidth")
-        v2 = wsd_common.xml_find(q, ".//sca:ScalingHeight")
-        dest.scaling = (int(v1.text), int(v2.text))
-    q = wsd_common.xml_find(dps, ".//sca:Rotation")
-    if q is not None:
-        dest.rotation = int(q.text)
-    q = wsd_common.xml_find(dps, ".//sca:MediaSides")
-    if q is not None:
-        f = wsd_common.xml_find(q, ".//sca:MediaFront")
-        dest.front = parse_media_side(f)
-
-        f = wsd_common.xml_find(q, ".//sca:MediaBack")
-        if f is not None:
-            dest.back = parse_media_side(f)
-        else:
-            dest.back = copy.deepcopy(dest.front)
+    _walk(dps, _tables["document_params"], dest, set())
+    _finish_document_params(dest)
     return dest
 
 
@@ -110,22 +221,11 @@ def parse_scanner_condition(scond):
 
 
 def parse_scanner_source_settings(se, name):
+    table = _source_settings_tables.get(name)
+    if table is None:
+        table = _source_settings_tables[name] = _table(_source_settings_rules(name))
     sss = wsd_scan__structures.ScannerSourceSettings()
-    v1 = wsd_common.xml_find(se, ".//sca:%sOpticalResolution/sca:Width" % name)
-    v2 = wsd_common.xml_find(se, ".//sca:%sOpticalResolution/sca:Height" % name)
-    sss.optical_res = (int(v1.text), int(v2.text))
-    q = wsd_common.xml_findall(se, ".//sca:%sResolutions/sca:Widths/sca:Width" % name)
-    sss.width_res = [x.text for x in q]
-    q = wsd_common.xml_findall(se, ".//sca:%sResolutions/sca:Heights/sca:Height" % name)
-    sss.height_res = [x.text for x in q]
-    q = wsd_common.xml_findall(se, ".//sca:%sColor/sca:ColorEntry" % name)
-    sss.color_modes = [x.text for x in q]
-    v1 = wsd_common.xml_find(se, ".//sca:%sMinimumSize/sca:Width" % name)
-    v2 = wsd_common.xml_find(se, ".//sca:%sMinimumSize/sca:Height" % name)
-    sss.min_size = (int(v1.text), int(v2.text))
-    v1 = wsd_common.xml_find(se, ".//sca:%sMaximumSize/sca:Width" % name)
-    v2 = wsd_common.xml_find(se, ".//sca:%sMaximumSize/sca:Height" % name)
-    sss.max_size = (int(v1.text), int(v2.text))
+    _walk(se, table, sss, set())
     return sss
 
 
@@ -154,47 +254,7 @@ def parse_job_status(q):
 
 def parse_scan_configuration(sca_config):
     config = wsd_scan__structures.ScannerConfiguration()
-    ds = wsd_common.xml_find(sca_config, ".//sca:DeviceSettings")
-    pla = wsd_common.xml_find(sca_config, ".//sca:Platen")
-    adf = wsd_common.xml_find(sca_config, ".//sca:ADF")
-    # .//sca:Film omitted
-
-    s = wsd_scan__structures.ScannerSettings()
-    q = wsd_common.xml_findall(ds, ".//sca:FormatsSupported/sca:FormatValue")
-    s.formats = [x.text for x in q]
-    v1 = wsd_common.xml_find(ds, ".//sca:CompressionQualityFactorSupported/sca:MinValue")
-    v2 = wsd_common.xml_find(ds, ".//sca:CompressionQualityFactorSupported/sca:MaxValue")
-    s.compression_factor = (int(v1.text), int(v2.text))
-    q = wsd_common.xml_findall(ds, ".//sca:ContentTypesSupported/sca:ContentTypeValue")
-    s.content_types = [x.text for x in q]
-    q = wsd_common.xml_find(ds, ".//sca:DocumentSizeAutoDetectSupported")
-    s.size_autodetect_sup = True if q.text == 'true' or q.text == '1' else False
-    q = wsd_common.xml_find(ds, ".//sca:AutoExposureSupported")
-    s.auto_exposure_sup = True if q.text == 'true' or q.text == '1' else False
-    q = wsd_common.xml_find(ds, ".//sca:BrightnessSupported")
-    s.brightness_sup = True if q.text == 'true' or q.text == '1' else False
-    q = wsd_common.xml_find(ds, ".//sca:ContrastSupported")
-    s.contrast_sup = True if q.text == 'true' or q.text == '1' else False
-    v1 = wsd_common.xml_find(ds, ".//sca:ScalingRangeSupported/sca:ScalingWidth/sca:MinValue")
-    v2 = wsd_common.xml_find(ds, ".//sca:ScalingRangeSupported/sca:ScalingWidth/sca:MaxValue")
-    s.scaling_range_w = (int(v1.text), int(v2.text))
-    v1 = wsd_common.xml_find(ds, ".//sca:ScalingRangeSupported/sca:ScalingHeight/sca:MinValue")
-    v2 = wsd_common.xml_find(ds, ".//sca:ScalingRangeSupported/sca:ScalingHeight/sca:MaxValue")
-    s.scaling_range_h = (int(v1.text), int(v2.text))
-    q = wsd_common.xml_findall(ds, ".//sca:RotationsSupported/sca:RotationValue")
-    s.rotations = [x.text for x in q]
-    config.settings = s
-    if pla is not None:
-        config.platen = parse_scanner_source_settings(pla, "Platen")
-    if adf is not None:
-        q = wsd_common.xml_find(adf, ".//sca:ADFSupportsDuplex")
-        config.adf_duplex = True if q.text == 'true' or q.text == '1' else False
-        f = wsd_common.xml_find(adf, ".//sca:ADFFront")
-        bk = wsd_common.xml_find(adf, ".//sca:ADFBack")
-        if f is not None:
-            config.front_adf = parse_scanner_source_settings(f, "ADF")
-        if bk is not None:
-            config.back_adf = parse_scanner_source_settings(bk, "ADF")
+    _walk(sca_config, _tables["scan_configuration"], config, set())
     return config
 
 
@@ -252,3 +312,67 @@ def parse_scan_job(x):
     dpf = wsd_common.xml_find(x, ".//sca:DocumentFinalParameters")
     scnj.doc_params = parse_document_params(dpf)
     return scnj
+
+
+class ParsedView:
+    """
+    A structure parsed from its XML subtree only when one of its attributes is first read or written.
+    The view holds the lxml subtree until then, and forwards every attribute access to the parsed
+    structure, which is cached. The subtree is released once parsed. Copying a view copies the
+    parsed structure itself.
+    """
+
+    __slots__ = ("_parser", "_xml", "_parsed", "_lock")
+
+    def __init__(self,
+                 parser,
+                 xml_tree):
+        """
+        :param parser: the function parsing the subtree, like parse_scan_ticket
+        :type parser: callable
+        :param xml_tree: the subtree to parse
+        :type xml_tree: lxml.etree.ElementTree
+        """
+        object.__setattr__(self, "_parser", parser)
+        object.__setattr__(self, "_xml", xml_tree)
+        object.__setattr__(self, "_parsed", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    @property
+    def is_parsed(self):
+        return self._parsed is not None
+
+    def materialize(self):
+        """
+        Parse the subtree, if not done yet.
+
+        :return: the parsed structure
+        """
+        parsed = self._parsed
+        if parsed is None:
+            with self._lock:
+                parsed = self._parsed
+                if parsed is None:
+                    parsed = self._parser(self._xml)
+                    object.__setattr__(self, "_parsed", parsed)
+                    object.__setattr__(self, "_xml", None)
+        return parsed
+
+    def __getattr__(self, name):
+        return getattr(self.materialize(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.materialize(), name, value)
+
+    def __str__(self):
+        return str(self.materialize())
+
+    def __repr__(self):
+        return "<ParsedView of %s: %s>" % (self._parser.__name__, "parsed" if self.is_parsed else "not parsed")
+
+    def __copy__(self):
+        return copy.copy(self.materialize())
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.materialize(), memo)
+